@@ -0,0 +1,48 @@
+"""Benchmark do RateLimiter: `python bench/bench_rate_limit.py [usuários]`"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def benchmark_rate_limit(total=1_000_000, bloco=100_000):
+    """Custo por chamada e memória do RateLimiter com `total` usuários distintos.
+
+    O relógio é simulado: os usuários chegam ao longo de 10 minutos, então só
+    ~1/10 deles está dentro da janela de um minuto a cada momento.
+    """
+    bloco = min(bloco, total)
+    duracao = 600.0
+    for medir_memoria in (False, True):
+        agora = [0.0]
+        limiter = main.RateLimiter(relogio=lambda: agora[0])
+        if medir_memoria:
+            tracemalloc.start()
+            print(f"{'usuários':>10} {'ativos':>8} {'memória MB':>11} {'pico MB':>8}")
+        else:
+            print(f"{'usuários':>10} {'ativos':>8} {'ns/chamada':>11}")
+        for inicio in range(0, total, bloco):
+            t0 = time.perf_counter()
+            for user_id in range(inicio, inicio + bloco):
+                agora[0] = user_id * duracao / total
+                limiter.verificar(user_id)
+                limiter.verificar(user_id)
+            decorrido = time.perf_counter() - t0
+            fim = inicio + bloco
+            if medir_memoria:
+                atual, pico = tracemalloc.get_traced_memory()
+                print(f"{fim:>10} {len(limiter._baldes):>8} {atual / 1024 / 1024:>11.1f} {pico / 1024 / 1024:>8.1f}")
+            else:
+                print(f"{fim:>10} {len(limiter._baldes):>8} {decorrido / (2 * bloco) * 1e9:>11.0f}")
+        if medir_memoria:
+            tracemalloc.stop()
+        print(limiter.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_rate_limit(int(sys.argv[1])) if len(sys.argv) > 1 else benchmark_rate_limit())
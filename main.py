@@ -8,8 +8,15 @@ import random
 import string
 import json
 import urllib.parse
+import re
+import bisect
 import threading
 import time
+import queue
+from abc import ABC, abstractmethod, update_abstractmethods
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 # Importação específica para contornar conflito de namespace
 import sys
@@ -34,9 +41,16 @@ except ImportError:
         
         from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
         from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from collections import defaultdict
+from telegram.error import RetryAfter, TelegramError
+from collections import defaultdict, deque, OrderedDict
 from functools import wraps
 
+# Driver do PostgreSQL é opcional: só é necessário com DATABASE_URL configurada
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
 # Configurações dos logs melhoradas
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -45,30 +59,170 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Rate limiting global - configurações mais flexíveis
-user_rate_limits = defaultdict(list)
 RATE_LIMIT_SECONDS = 0.5  # Máximo 1 comando a cada 0.5 segundos por usuário
 MAX_REQUESTS_PER_MINUTE = 30  # Máximo 30 requests por minuto por usuário
+RATE_LIMIT_CUSTOS = os.getenv("RATE_LIMIT_CUSTOS", "")  # Custos extras por callback, ex.: "pais_=5,moeda_=5"
+
+class _BaldeUsuario:
+    """Estado do rate limit de um usuário: fichas, último reabastecimento e último comando aceito"""
+    __slots__ = ("tokens", "atualizado", "ultimo")
+
+class RateLimiter:
+    """Token bucket por usuário com custo O(1) por verificação.
+
+    Cada usuário tem até `capacidade` fichas, repostas a `capacidade / janela`
+    por segundo; cada comando aceito gasta uma ficha e precisa respeitar
+    `intervalo_minimo` desde o anterior. Os baldes ficam em um OrderedDict na
+    ordem do último acesso: um balde parado há `janela` segundos já estaria
+    cheio, então removê-lo não muda nenhuma decisão. Cada verificação remove
+    alguns ociosos do início da fila, e a memória acompanha só os usuários
+    ativos no último minuto. Roda apenas no event loop, sem lock.
+    """
+
+    REMOCOES_POR_CHAMADA = 2
+
+    def __init__(self, capacidade=MAX_REQUESTS_PER_MINUTE, janela=60.0, intervalo_minimo=RATE_LIMIT_SECONDS, relogio=time.monotonic):
+        self.capacidade = capacidade
+        self.taxa = capacidade / janela
+        self.intervalo_minimo = intervalo_minimo
+        self.ocioso_apos = max(janela, intervalo_minimo)
+        self.relogio = relogio
+        self._baldes = OrderedDict()
+        self.stats = {"permitidos": 0, "bloqueados_minuto": 0, "bloqueados_intervalo": 0, "removidos": 0}
+
+    def verificar(self, user_id, custo=1):
+        """Retorna "ok", "minuto" (fichas < custo) ou "intervalo" (comando rápido demais).
+
+        Custo 0 não é limitado; custo acima da capacidade vale como a capacidade inteira.
+        """
+        if custo <= 0:
+            return "ok"
+        custo = min(custo, self.capacidade)
+        agora = self.relogio()
+        self._remover_ociosos(agora, self.REMOCOES_POR_CHAMADA)
+
+        balde = self._baldes.get(user_id)
+        if balde is None:
+            balde = _BaldeUsuario()
+            balde.tokens = self.capacidade
+            balde.ultimo = float("-inf")
+            self._baldes[user_id] = balde
+        else:
+            self._baldes.move_to_end(user_id)
+            balde.tokens = min(self.capacidade, balde.tokens + (agora - balde.atualizado) * self.taxa)
+        balde.atualizado = agora
+
+        if balde.tokens < custo:
+            self.stats["bloqueados_minuto"] += 1
+            return "minuto"
+        if agora - balde.ultimo < self.intervalo_minimo:
+            self.stats["bloqueados_intervalo"] += 1
+            return "intervalo"
+        balde.tokens -= custo
+        balde.ultimo = agora
+        self.stats["permitidos"] += 1
+        return "ok"
+
+    def _remover_ociosos(self, agora, limite=None):
+        removidos = 0
+        while self._baldes and (limite is None or removidos < limite):
+            balde = next(iter(self._baldes.values()))
+            if agora - balde.atualizado < self.ocioso_apos:
+                break
+            self._baldes.popitem(last=False)
+            removidos += 1
+        self.stats["removidos"] += removidos
+        return removidos
+
+    def limpar(self):
+        """Remove todos os baldes ociosos (também acontece aos poucos em `verificar`)"""
+        return self._remover_ociosos(self.relogio())
+
+    def metrics(self):
+        """Métricas para /status"""
+        self.limpar()
+        return {"usuarios_ativos": len(self._baldes), **self.stats}
+
+rate_limiter = RateLimiter()
+
+# Fichas gastas por callback (chaves terminadas em "_" valem como prefixo).
+# Compra de número e criação de fatura chamam APIs pagas; admin não é limitado.
+CUSTO_CALLBACK_PADRAO = 1
+CUSTOS_CALLBACK = {
+    "pais_": 5,
+    "moeda_": 5,
+    "recarga_": 2,
+    "compartilhar_": 2,
+    "copiar_texto_": 2,
+    "copiar_link_": 2,
+    "admin_": 0,
+}
+
+def ler_custos_callback(texto, capacidade=MAX_REQUESTS_PER_MINUTE):
+    """Lê "rota=custo,..." (RATE_LIMIT_CUSTOS). Entradas inválidas são ignoradas com aviso.
 
-# Cache global para preços de crypto
-crypto_price_cache = {}
-CACHE_EXPIRY_SECONDS = 300  # Cache de 5 minutos
+    O custo fica entre 0 e `capacidade`: acima disso o balde nunca teria fichas
+    suficientes e a rota ficaria bloqueada para sempre.
+    """
+    custos = {}
+    for item in filter(None, (parte.strip() for parte in texto.split(","))):
+        rota, _, valor = item.partition("=")
+        rota = rota.strip()
+        try:
+            custo = float(valor)
+        except ValueError:
+            custo = None
+        if not rota or custo is None or custo != custo:
+            logger.warning(f"RATE_LIMIT_CUSTOS: entrada inválida ignorada: {item!r}")
+            continue
+        if not 0 <= custo <= capacidade:
+            logger.warning(f"RATE_LIMIT_CUSTOS: custo de {rota} ajustado para o intervalo [0, {capacidade}]")
+            custo = min(max(custo, 0), capacidade)
+        custos[rota] = custo
+    return custos
+
+CUSTOS_CALLBACK.update(ler_custos_callback(RATE_LIMIT_CUSTOS))
+
+def custo_do_callback(data):
+    """Custo em fichas de uma rota de callback: rota exata, senão o prefixo mais longo"""
+    custo = CUSTOS_CALLBACK.get(data)
+    if custo is not None:
+        return custo
+    prefixos = [rota for rota in CUSTOS_CALLBACK if rota.endswith("_") and data.startswith(rota)]
+    return CUSTOS_CALLBACK[max(prefixos, key=len)] if prefixos else CUSTO_CALLBACK_PADRAO
+
+async def admitir_callback(query, custo):
+    """Admissão no despacho de callbacks, antes de qualquer acesso ao banco ou HTTP.
+
+    Usuário limitado recebe só o `query.answer` (sem editar a mensagem).
+    """
+    resultado = rate_limiter.verificar(query.from_user.id, custo)
+    if resultado == "ok":
+        return True
+    try:
+        if resultado == "minuto":
+            logger.warning(f"Rate limit por minuto atingido para usuário {query.from_user.id} ({query.data})")
+            await query.answer("⚠️ Aguarde um momento antes de tentar novamente.", show_alert=False)
+        else:
+            await query.answer()
+    except Exception as e:
+        logger.error(f"Erro ao enviar mensagem de rate limit: {e}")
+    return False
 
 def rate_limit(func):
-    """Decorator para rate limiting por usuário"""
+    """Decorator para rate limiting por usuário (comandos; callbacks passam por admitir_callback)"""
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not update.effective_user:
             return
+        if update.callback_query:
+            return await func(update, context)
 
         user_id = update.effective_user.id
-        now = time.time()
-
-        # Limpar requests antigos (mais de 1 minuto)
-        user_rate_limits[user_id] = [req_time for req_time in user_rate_limits[user_id] 
-                                    if now - req_time < 60]
+        resultado = rate_limiter.verificar(user_id)
 
         # Verificar rate limit por minuto (mais flexível)
-        if len(user_rate_limits[user_id]) >= MAX_REQUESTS_PER_MINUTE:
+        if resultado == "minuto":
             logger.warning(f"Rate limit por minuto atingido para usuário {user_id}")
             try:
                 if hasattr(update, 'message') and update.message:
@@ -84,13 +238,10 @@ def rate_limit(func):
             return
 
         # Verificar intervalo mínimo (mais flexível)
-        if user_rate_limits[user_id] and now - user_rate_limits[user_id][-1] < RATE_LIMIT_SECONDS:
+        if resultado == "intervalo":
             logger.info(f"Rate limit por segundo atingido para usuário {user_id}")
             return  # Silencioso para não irritar o usuário
 
-        # Adicionar timestamp atual
-        user_rate_limits[user_id].append(now)
-
         return await func(update, context)
     return wrapper
 
@@ -101,6 +252,54 @@ FIVESIM_API_TOKEN = os.getenv("FIVESIM_API_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 RENDER_URL = os.getenv("RENDER_URL", "https://n6m3r6.onrender.com")
 
+# Configurações do banco de dados
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))  # Conexões SQLite mantidas abertas
+DB_POOL_HEALTHCHECK_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "60"))  # Ociosidade antes de validar a conexão
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))  # Threads dedicadas ao SQLite
+DB_MAX_QUEUE = int(os.getenv("DB_MAX_QUEUE", "200"))  # Máximo de chamadas ao banco pendentes
+DB_QUEUE_WARN_SECONDS = float(os.getenv("DB_QUEUE_WARN_SECONDS", "0.5"))  # Espera na fila que gera alerta no log
+STARTS_FLUSH_SECONDS = float(os.getenv("STARTS_FLUSH_SECONDS", "5"))  # Intervalo de gravação do contador de starts
+STARTS_FLUSH_MAX = int(os.getenv("STARTS_FLUSH_MAX", "500"))  # Usuários pendentes que antecipam a gravação
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))  # Usuários mantidos no cache em memória
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # Segundos até uma entrada do cache expirar
+LEDGER_COMPACTAR_SECONDS = float(os.getenv("LEDGER_COMPACTAR_SECONDS", "300"))  # Intervalo de consolidação dos saldos
+DATABASE_URL = os.getenv("DATABASE_URL")  # postgresql://... usa PostgreSQL no lugar do SQLite local
+ARQUIVO_RETENCAO_DIAS = int(os.getenv("ARQUIVO_RETENCAO_DIAS", "90"))  # Idade mínima para mover transações/números ao arquivo
+ARQUIVO_INTERVALO_SECONDS = float(os.getenv("ARQUIVO_INTERVALO_SECONDS", "3600"))  # Intervalo entre rodadas do arquivamento
+ARQUIVO_LOTE = int(os.getenv("ARQUIVO_LOTE", "1000"))  # Linhas movidas por transação (mantém o lock de escrita curto)
+NUMERO_EXPIRACAO_MINUTOS = int(os.getenv("NUMERO_EXPIRACAO_MINUTOS", "60"))  # Número ainda "aguardando_sms" depois disso vira "expirado" (a ativação na 5sim dura 20 min)
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")  # Pasta dos snapshots do SQLite
+BACKUP_INTERVALO_SECONDS = float(os.getenv("BACKUP_INTERVALO_SECONDS", "21600"))  # Intervalo entre backups automáticos (0 desliga)
+BACKUP_MANTER = int(os.getenv("BACKUP_MANTER", "7"))  # Snapshots mantidos na rotação
+BACKUP_PAGINAS = int(os.getenv("BACKUP_PAGINAS", "256"))  # Páginas copiadas por passo do backup
+BACKUP_PAUSA_SECONDS = float(os.getenv("BACKUP_PAUSA_SECONDS", "0.01"))  # Pausa entre passos do backup
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))  # Consultas acima disso vão para o log
+DB_METRICS_AMOSTRAS = int(os.getenv("DB_METRICS_AMOSTRAS", "1000"))  # Latências guardadas por consulta para os percentis
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))  # Conexões PostgreSQL mantidas abertas
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))  # Limite de conexões PostgreSQL por processo
+PG_USER_CACHE_TTL = float(os.getenv("PG_USER_CACHE_TTL", "2"))  # TTL do cache com PostgreSQL: escritas de outros hosts não o invalidam (0 desliga)
+SESSAO_TTL_SECONDS = float(os.getenv("SESSAO_TTL_SECONDS", "1800"))  # Inatividade até perder o fluxo de compra/recarga
+SESSAO_MAX = int(os.getenv("SESSAO_MAX", "50000"))  # Usuários com sessão em memória (LRU acima disso)
+MENSAGENS_TTL_SECONDS = float(os.getenv("MENSAGENS_TTL_SECONDS", "172800"))  # O Telegram só apaga mensagens com menos de 48h
+SESSOES_ARQUIVO = os.getenv("SESSOES_ARQUIVO", "sessions.json")  # Snapshot das sessões no desligamento (vazio desliga)
+LIMPEZA_FILA_MAX = int(os.getenv("LIMPEZA_FILA_MAX", "10000"))  # Exclusões de mensagem pendentes (acima disso são descartadas)
+LIMPEZA_CONCORRENCIA = int(os.getenv("LIMPEZA_CONCORRENCIA", "4"))  # deleteMessage simultâneos quando não há exclusão em lote
+LIMPEZA_ATRASO_SECONDS = float(os.getenv("LIMPEZA_ATRASO_SECONDS", "1"))  # Espera antes de apagar: a resposta sai primeiro e o lote cresce
+HTTP_CONEXOES_POR_HOST = int(os.getenv("HTTP_CONEXOES_POR_HOST", "10"))  # Conexões simultâneas por API externa
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30"))  # Tempo que uma conexão ociosa fica aberta para reuso
+HTTP_DNS_CACHE_SECONDS = int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))  # Cache de DNS das APIs externas
+CRYPTOPAY_TIMEOUT_SECONDS = float(os.getenv("CRYPTOPAY_TIMEOUT_SECONDS", "15"))  # Timeout total das chamadas ao CryptoPay
+FIVESIM_TIMEOUT_SECONDS = float(os.getenv("FIVESIM_TIMEOUT_SECONDS", "15"))  # Timeout total das chamadas à 5sim
+COINGECKO_TIMEOUT_SECONDS = float(os.getenv("COINGECKO_TIMEOUT_SECONDS", "10"))  # Timeout total das chamadas ao CoinGecko
+CIRCUITO_JANELA = int(os.getenv("CIRCUITO_JANELA", "20"))  # Últimas chamadas usadas na taxa de falha de cada API
+CIRCUITO_MINIMO = int(os.getenv("CIRCUITO_MINIMO", "5"))  # Chamadas na janela antes de o circuito poder abrir
+CIRCUITO_TAXA_FALHA = float(os.getenv("CIRCUITO_TAXA_FALHA", "0.5"))  # Fração de falhas que abre o circuito
+CIRCUITO_ABERTO_SECONDS = float(os.getenv("CIRCUITO_ABERTO_SECONDS", "30"))  # Tempo falhando rápido antes de testar a API de novo
+CIRCUITO_SONDAS = int(os.getenv("CIRCUITO_SONDAS", "1"))  # Chamadas de teste simultâneas com o circuito meio aberto
+CANCELAMENTO_TENTATIVAS = int(os.getenv("CANCELAMENTO_TENTATIVAS", "6"))  # Novas tentativas de cancelar uma ativação na 5sim antes de avisar o admin
+COTACAO_INTERVALO_SECONDS = float(os.getenv("COTACAO_INTERVALO_SECONDS", "60"))  # Atualização das cotações em background
+COTACAO_IDADE_MAXIMA_SECONDS = float(os.getenv("COTACAO_IDADE_MAXIMA_SECONDS", "900"))  # Cotação mais velha que isso não é usada
+
 # URLs das APIs
 CRYPTOPAY_API_BASE = "https://pay.crypt.bot/api"
 FIVESIM_API_BASE = "https://5sim.net/v1"
@@ -295,18 +494,977 @@ MENSAGENS_SUCESSO = [
     "🌟 PERFEITO! Transação realizada com sucesso!"
 ]
 
-class DatabaseManager:
-    def __init__(self, db_path="premium_bot.db"):
+# Saldo atual = saldo consolidado em usuarios + movimentos ainda não consolidados
+# (os posteriores a ledger_estado.ultimo_movimento_id). Usado como subconsulta.
+_SALDO_ATUAL = """
+    SELECT u.user_id,
+           u.saldo + COALESCE(SUM(m.delta_saldo), 0) AS saldo,
+           u.saldo_bonus + COALESCE(SUM(m.delta_bonus), 0) AS saldo_bonus,
+           u.total_depositado + COALESCE(SUM(m.delta_depositado), 0) AS total_depositado
+    FROM usuarios u
+    LEFT JOIN movimentos m
+           ON m.user_id = u.user_id
+          AND m.id > (SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1)
+    WHERE u.user_id = :user_id
+    GROUP BY u.user_id
+"""
+
+# Movimentos ainda não consolidados de um usuário (u) numa coluna do livro; para
+# mostrar o saldo atual em listagens sem agrupar a consulta inteira
+_CAUDA_USUARIO = """(
+               SELECT COALESCE(SUM(m.{coluna}), 0)
+               FROM movimentos m
+               WHERE m.user_id = u.user_id
+                 AND m.id > (SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1))"""
+
+# Consultas SQL nomeadas usadas pelo DatabaseManager. Manter todas aqui permite
+# verificar o plano de execução de cada uma (DatabaseManager.check_query_plans).
+SQL = {
+    # Usuários
+    "get_user": "SELECT * FROM usuarios WHERE user_id = ?",
+    "create_user": """
+        INSERT OR IGNORE INTO usuarios (user_id, username, first_name, indicador_id, saldo, saldo_bonus)
+        VALUES (?, ?, ?, ?, 0.0, 0.0)
+    """,
+    "get_indicador": "SELECT indicador_id FROM usuarios WHERE user_id = ?",
+    # Códigos de indicação (índice UNIQUE de codigo_indicacao)
+    "get_user_by_referral_code": "SELECT user_id FROM usuarios WHERE codigo_indicacao = ?",
+    "get_referral_code": "SELECT codigo_indicacao FROM usuarios WHERE user_id = ?",
+    # Rede de indicações (agregados mantidos por trigger)
+    "get_resumo_indicacoes": """
+        SELECT diretas, indiretas, depositantes, volume_rede
+        FROM indicacoes_resumo WHERE user_id = ?
+    """,
+    "ranking_indicadores": """
+        SELECT r.user_id, u.first_name, r.diretas, r.indiretas, r.depositantes, r.volume_rede
+        FROM indicacoes_resumo r
+        JOIN usuarios u ON u.user_id = r.user_id
+        WHERE r.diretas > 0
+        ORDER BY r.volume_rede DESC
+        LIMIT ?
+    """,
+    "set_referral_code": "UPDATE usuarios SET codigo_indicacao = ? WHERE user_id = ? AND codigo_indicacao IS NULL",
+    # Tudo que as telas mostram sobre o usuário numa única ida ao banco
+    "get_user_snapshot": f"""
+        SELECT u.user_id, u.username, u.first_name, s.saldo, s.saldo_bonus, u.numeros_gratis,
+               u.indicador_id, u.codigo_indicacao, u.data_registro, s.total_depositado,
+               u.indicacoes_validas, u.total_starts,
+               COALESCE(c.total_compras, 0) + COALESCE(r.total_compras, 0),
+               COALESCE(c.total_gasto, 0) + COALESCE(r.total_gasto, 0),
+               COALESCE(c.total_economizado, 0) + COALESCE(r.total_economizado, 0)
+        FROM usuarios u
+        JOIN ({_SALDO_ATUAL}) s ON s.user_id = u.user_id
+        LEFT JOIN resumo_compras r ON r.user_id = u.user_id
+        LEFT JOIN (
+            SELECT user_id,
+                   COUNT(*) AS total_compras,
+                   SUM(preco) AS total_gasto,
+                   SUM(desconto_aplicado) AS total_economizado
+            FROM numeros_sms
+            WHERE user_id = :user_id
+            GROUP BY user_id
+        ) c ON c.user_id = u.user_id
+        WHERE u.user_id = :user_id
+    """,
+    "get_all_user_ids": "SELECT user_id FROM usuarios",
+    "count_users": "SELECT total_usuarios FROM estatisticas WHERE id = 1",
+    "update_user_starts": "UPDATE usuarios SET total_starts = total_starts + ? WHERE user_id = ?",
+
+    # Saldos: só INSERT no livro de movimentos; usuarios.saldo/saldo_bonus/total_depositado
+    # guardam o valor consolidado até ledger_estado.ultimo_movimento_id
+    "registrar_movimento": """
+        INSERT INTO movimentos (user_id, tipo, delta_saldo, delta_bonus, delta_depositado, referencia)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """,
+    "get_saldo_atual": _SALDO_ATUAL,
+    # Débito atômico: consome primeiro o bônus e depois o saldo base, só se houver saldo total
+    "deduzir_saldo": f"""
+        INSERT INTO movimentos (user_id, tipo, delta_saldo, delta_bonus, referencia)
+        SELECT user_id, 'compra',
+               -MAX(:valor - MAX(saldo_bonus, 0), 0),
+               -MIN(MAX(saldo_bonus, 0), :valor),
+               :referencia
+        FROM ({_SALDO_ATUAL})
+        WHERE saldo + saldo_bonus >= :valor
+    """,
+    "get_movimentos": """
+        SELECT tipo, delta_saldo, delta_bonus, referencia, criado_em
+        FROM movimentos
+        WHERE user_id = ?
+        ORDER BY id DESC
+        LIMIT ?
+    """,
+    "get_ledger_estado": "SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1",
+    "get_ultimo_movimento": "SELECT MAX(id) FROM movimentos",
+    # Consolida os movimentos do intervalo (de, ate] no saldo de cada usuário
+    "compactar_movimentos": """
+        UPDATE usuarios
+        SET saldo = saldo + t.delta_saldo,
+            saldo_bonus = saldo_bonus + t.delta_bonus,
+            total_depositado = total_depositado + t.delta_depositado
+        FROM (
+            SELECT user_id,
+                   SUM(delta_saldo) AS delta_saldo,
+                   SUM(delta_bonus) AS delta_bonus,
+                   SUM(delta_depositado) AS delta_depositado
+            FROM movimentos
+            WHERE id > ? AND id <= ?
+            GROUP BY user_id
+        ) AS t
+        WHERE usuarios.user_id = t.user_id
+    """,
+    "atualizar_ledger_estado": """
+        UPDATE ledger_estado SET ultimo_movimento_id = ?, compactado_em = CURRENT_TIMESTAMP WHERE id = 1
+    """,
+    # Auditoria: usuários cujo saldo consolidado difere da soma do livro até o mesmo ponto
+    "reconciliar_saldos": """
+        SELECT u.user_id,
+               u.saldo, COALESCE(m.saldo, 0),
+               u.saldo_bonus, COALESCE(m.saldo_bonus, 0),
+               u.total_depositado, COALESCE(m.total_depositado, 0)
+        FROM usuarios u
+        LEFT JOIN (
+            SELECT user_id,
+                   SUM(delta_saldo) AS saldo,
+                   SUM(delta_bonus) AS saldo_bonus,
+                   SUM(delta_depositado) AS total_depositado
+            FROM movimentos
+            WHERE id <= (SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1)
+            GROUP BY user_id
+        ) m ON m.user_id = u.user_id
+        WHERE ABS(u.saldo - COALESCE(m.saldo, 0)) > 0.001
+           OR ABS(u.saldo_bonus - COALESCE(m.saldo_bonus, 0)) > 0.001
+           OR ABS(u.total_depositado - COALESCE(m.total_depositado, 0)) > 0.001
+    """,
+    "add_numeros_gratis": "UPDATE usuarios SET numeros_gratis = numeros_gratis + ? WHERE user_id = ?",
+    "add_indicacao_valida": "UPDATE usuarios SET indicacoes_validas = indicacoes_validas + 1 WHERE user_id = ?",
+
+    # Números SMS
+    "registrar_numero": """
+        INSERT INTO numeros_sms (user_id, servico, pais, numero, preco, desconto_aplicado, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+
+    # Transações
+    "criar_transacao_pendente": """
+        INSERT INTO transacoes (user_id, tipo, valor, moeda, status, invoice_id, valor_crypto)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+    "get_transacao_pendente": """
+        SELECT user_id, valor, moeda, valor_crypto FROM transacoes 
+        WHERE invoice_id = ? AND status = 'pendente'
+    """,
+    "marcar_valor_incorreto": """
+        UPDATE transacoes 
+        SET status = 'valor_incorreto', 
+            observacoes = ? 
+        WHERE invoice_id = ? AND status = 'pendente'
+    """,
+    "confirmar_transacao": """
+        UPDATE transacoes 
+        SET status = 'confirmado', 
+            data_confirmacao = ?,
+            valor_crypto_pago = ?,
+            moeda_paga = ?
+        WHERE invoice_id = ? AND status = 'pendente'
+    """,
+
+    # Painel administrativo
+    # Contadores materializados (mantidos pelos triggers da migração 4)
+    "get_estatisticas": """
+        SELECT total_usuarios, total_starts, total_vendas, total_faturamento, total_numeros
+        FROM estatisticas WHERE id = 1
+    """,
+    "get_estatisticas_dia": """
+        SELECT novos_usuarios, vendas, faturamento, numeros
+        FROM estatisticas_diarias WHERE dia = DATE('now')
+    """,
+    "count_pendentes": """
+        SELECT COUNT(*) FROM transacoes 
+        WHERE status = 'pendente'
+    """,
+    "ultimos_confirmados": """
+        SELECT u.first_name, t.valor, t.data_transacao 
+        FROM transacoes t 
+        JOIN usuarios u ON t.user_id = u.user_id 
+        WHERE t.status = 'confirmado'
+        ORDER BY t.data_transacao DESC 
+        LIMIT 5
+    """,
+    # Arquivamento: linhas finalizadas mais antigas que a retenção vão para *_arquivo.
+    # Não há trigger de DELETE nessas tabelas, então os contadores materializados
+    # não mudam; os totais por usuário de numeros_sms passam para resumo_compras.
+    "selecionar_transacoes_arquivar": """
+        SELECT id FROM transacoes
+        WHERE status IN ('confirmado', 'valor_incorreto') AND data_transacao < datetime('now', ?)
+        LIMIT ?
+    """,
+    "arquivar_transacoes": """
+        INSERT OR IGNORE INTO transacoes_arquivo
+            (id, user_id, tipo, valor, moeda, status, invoice_id, data_transacao,
+             data_confirmacao, valor_crypto_pago, moeda_paga, observacoes, valor_crypto)
+        SELECT id, user_id, tipo, valor, moeda, status, invoice_id, data_transacao,
+               data_confirmacao, valor_crypto_pago, moeda_paga, observacoes, valor_crypto
+        FROM transacoes
+        WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    "remover_transacoes_arquivadas": "DELETE FROM transacoes WHERE id IN (SELECT value FROM json_each(?))",
+    # Ativação que passou do prazo sem SMS está encerrada na 5sim
+    "expirar_numeros": """
+        UPDATE numeros_sms SET status = 'expirado'
+        WHERE status = 'aguardando_sms' AND data_compra < datetime('now', ?)
+    """,
+    "selecionar_numeros_arquivar": """
+        SELECT id FROM numeros_sms
+        WHERE status <> 'aguardando_sms' AND data_compra < datetime('now', ?)
+        LIMIT ?
+    """,
+    "resumir_numeros_arquivados": """
+        INSERT INTO resumo_compras (user_id, total_compras, total_gasto, total_economizado)
+        SELECT user_id, COUNT(*), COALESCE(SUM(preco), 0), COALESCE(SUM(desconto_aplicado), 0)
+        FROM numeros_sms
+        WHERE id IN (SELECT value FROM json_each(?))
+        GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE
+        SET total_compras = total_compras + excluded.total_compras,
+            total_gasto = total_gasto + excluded.total_gasto,
+            total_economizado = total_economizado + excluded.total_economizado
+    """,
+    "arquivar_numeros": """
+        INSERT OR IGNORE INTO numeros_sms_arquivo
+            (id, user_id, servico, pais, numero, codigo_recebido, preco, desconto_aplicado, status, data_compra)
+        SELECT id, user_id, servico, pais, numero, codigo_recebido, preco, desconto_aplicado, status, data_compra
+        FROM numeros_sms
+        WHERE id IN (SELECT value FROM json_each(?))
+    """,
+    "remover_numeros_arquivados": "DELETE FROM numeros_sms WHERE id IN (SELECT value FROM json_each(?))",
+
+    # Listas paginadas por chave (keyset): a página 1000 custa o mesmo que a 1
+    "listar_pagamentos": """
+        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao, t.invoice_id, t.id
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = ?
+        ORDER BY t.data_transacao DESC, t.id DESC
+        LIMIT ?
+    """,
+    "listar_pagamentos_seguintes": """
+        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao, t.invoice_id, t.id
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = ? AND (t.data_transacao, t.id) < (?, ?)
+        ORDER BY t.data_transacao DESC, t.id DESC
+        LIMIT ?
+    """,
+    "listar_pagamentos_anteriores": """
+        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao, t.invoice_id, t.id
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = ? AND (t.data_transacao, t.id) > (?, ?)
+        ORDER BY t.data_transacao ASC, t.id ASC
+        LIMIT ?
+    """,
+    # Ordena pelo saldo consolidado (atualizado a cada compactação do livro), que é
+    # também o cursor; as duas últimas colunas trazem o saldo atual só das linhas da página
+    "listar_usuarios": f"""
+        SELECT u.user_id, u.first_name, u.saldo, u.total_depositado,
+               u.saldo + {_CAUDA_USUARIO.format(coluna="delta_saldo")},
+               u.total_depositado + {_CAUDA_USUARIO.format(coluna="delta_depositado")}
+        FROM usuarios u
+        ORDER BY u.saldo DESC, u.user_id DESC
+        LIMIT ?
+    """,
+    "listar_usuarios_seguintes": f"""
+        SELECT u.user_id, u.first_name, u.saldo, u.total_depositado,
+               u.saldo + {_CAUDA_USUARIO.format(coluna="delta_saldo")},
+               u.total_depositado + {_CAUDA_USUARIO.format(coluna="delta_depositado")}
+        FROM usuarios u
+        WHERE (u.saldo, u.user_id) < (?, ?)
+        ORDER BY u.saldo DESC, u.user_id DESC
+        LIMIT ?
+    """,
+    "listar_usuarios_anteriores": f"""
+        SELECT u.user_id, u.first_name, u.saldo, u.total_depositado,
+               u.saldo + {_CAUDA_USUARIO.format(coluna="delta_saldo")},
+               u.total_depositado + {_CAUDA_USUARIO.format(coluna="delta_depositado")}
+        FROM usuarios u
+        WHERE (u.saldo, u.user_id) > (?, ?)
+        ORDER BY u.saldo ASC, u.user_id ASC
+        LIMIT ?
+    """,
+}
+
+# Palavras que podem aparecer depois do nome da tabela e não são aliases
+SQL_KEYWORDS = {"WHERE", "JOIN", "ON", "ORDER", "GROUP", "LIMIT", "SET", "LEFT", "INNER", "AS", "USING"}
+
+def _migrar_colunas_legadas(conn):
+    """Adiciona colunas criadas depois do lançamento em bancos antigos que ainda não as têm"""
+    colunas = {
+        "usuarios": [
+            ("total_starts", "INTEGER DEFAULT 0"),
+            ("saldo_bonus", "REAL DEFAULT 0.0"),
+        ],
+        "transacoes": [
+            ("data_confirmacao", "TIMESTAMP"),
+            ("valor_crypto_pago", "REAL"),
+            ("moeda_paga", "TEXT"),
+            ("observacoes", "TEXT"),
+        ],
+    }
+    for tabela, novas in colunas.items():
+        existentes = {row[1] for row in conn.execute(f"PRAGMA table_info({tabela})")}
+        for coluna, tipo in novas:
+            if coluna not in existentes:
+                conn.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}")
+
+def _preencher_estatisticas(conn):
+    """Calcula os contadores materializados a partir das tabelas existentes"""
+    conn.execute("""
+        INSERT OR REPLACE INTO estatisticas (id, total_usuarios, total_starts, total_vendas, total_faturamento, total_numeros)
+        SELECT 1,
+               (SELECT COUNT(*) FROM usuarios),
+               (SELECT COALESCE(SUM(total_starts), 0) FROM usuarios),
+               (SELECT COUNT(*) FROM transacoes WHERE status = 'confirmado'),
+               (SELECT COALESCE(SUM(valor), 0) FROM transacoes WHERE status = 'confirmado'),
+               (SELECT COUNT(*) FROM numeros_sms)
+    """)
+    conn.execute("DELETE FROM estatisticas_diarias")
+    buckets = defaultdict(lambda: [0, 0, 0.0, 0])
+    for dia, novos in conn.execute(
+        "SELECT DATE(data_registro), COUNT(*) FROM usuarios WHERE data_registro IS NOT NULL GROUP BY 1"
+    ):
+        buckets[dia][0] = novos
+    for dia, vendas, faturamento in conn.execute("""
+        SELECT DATE(data_transacao), COUNT(*), COALESCE(SUM(valor), 0) FROM transacoes
+        WHERE status = 'confirmado' AND data_transacao IS NOT NULL GROUP BY 1
+    """):
+        buckets[dia][1:3] = [vendas, faturamento]
+    for dia, numeros in conn.execute(
+        "SELECT DATE(data_compra), COUNT(*) FROM numeros_sms WHERE data_compra IS NOT NULL GROUP BY 1"
+    ):
+        buckets[dia][3] = numeros
+    conn.executemany(
+        "INSERT INTO estatisticas_diarias (dia, novos_usuarios, vendas, faturamento, numeros) VALUES (?, ?, ?, ?, ?)",
+        [(dia, *valores) for dia, valores in buckets.items()]
+    )
+
+# Arquivo onde os códigos de indicação ficavam antes da coluna usuarios.codigo_indicacao
+REFERRAL_CODES_JSON = "referral_codes.json"
+
+def _ler_codigos_json():
+    """Pares (user_id, código) do referral_codes.json antigo, se o arquivo existir"""
+    try:
+        with open(REFERRAL_CODES_JSON, 'r') as f:
+            return [(int(user_id), code) for user_id, code in json.load(f).items()]
+    except FileNotFoundError:
+        return []
+
+def _importar_codigos_json(conn):
+    """Importação única do referral_codes.json para usuarios.codigo_indicacao"""
+    importados = ignorados = 0
+    for user_id, code in _ler_codigos_json():
+        try:
+            cursor = conn.execute(
+                "UPDATE usuarios SET codigo_indicacao = ? WHERE user_id = ? AND codigo_indicacao IS NULL",
+                (code, user_id)
+            )
+        except sqlite3.IntegrityError:
+            cursor = None
+        if cursor is not None and cursor.rowcount:
+            importados += 1
+        else:
+            ignorados += 1
+    if importados or ignorados:
+        logger.info(f"🔗 Códigos de indicação importados do JSON: {importados} (ignorados: {ignorados})")
+
+def _preencher_indicacoes(conn):
+    """Monta a árvore de indicações e os agregados por indicador a partir dos dados existentes"""
+    # Profundidade limitada para não entrar em loop se houver ciclo em indicador_id
+    conn.execute("""
+        INSERT OR IGNORE INTO indicacoes_arvore (ancestral_id, descendente_id, profundidade)
+        WITH RECURSIVE arvore (ancestral_id, descendente_id, profundidade) AS (
+            SELECT indicador_id, user_id, 1 FROM usuarios
+            WHERE indicador_id IS NOT NULL AND indicador_id != user_id
+            UNION
+            SELECT a.ancestral_id, u.user_id, a.profundidade + 1
+            FROM arvore a
+            JOIN usuarios u ON u.indicador_id = a.descendente_id
+            WHERE a.profundidade < 100 AND u.user_id != a.ancestral_id
+        )
+        SELECT ancestral_id, descendente_id, MIN(profundidade) FROM arvore GROUP BY ancestral_id, descendente_id
+    """)
+    conn.execute("""
+        INSERT INTO indicacoes_resumo (user_id, volume_proprio)
+        SELECT user_id, SUM(delta_depositado) FROM movimentos
+        WHERE delta_depositado > 0
+        GROUP BY user_id
+    """)
+    conn.execute("""
+        INSERT INTO indicacoes_resumo (user_id, diretas, indiretas, depositantes, volume_rede)
+        SELECT a.ancestral_id,
+               SUM(a.profundidade = 1),
+               SUM(a.profundidade > 1),
+               SUM(COALESCE(r.volume_proprio, 0) > 0),
+               SUM(COALESCE(r.volume_proprio, 0))
+        FROM indicacoes_arvore a
+        LEFT JOIN indicacoes_resumo r ON r.user_id = a.descendente_id
+        WHERE true
+        GROUP BY a.ancestral_id
+        ON CONFLICT(user_id) DO UPDATE
+        SET diretas = excluded.diretas,
+            indiretas = excluded.indiretas,
+            depositantes = excluded.depositantes,
+            volume_rede = excluded.volume_rede
+    """)
+
+# Migrações do schema: (versão, descrição, passos). Cada passo é um comando SQL
+# ou uma função que recebe a conexão. Migrações já publicadas não devem ser
+# alteradas; mudanças novas entram como uma nova versão no fim da lista.
+MIGRATIONS = [
+    (1, "Tabelas iniciais", [
+        """
+        CREATE TABLE IF NOT EXISTS usuarios (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            saldo REAL DEFAULT 0.0,
+            saldo_bonus REAL DEFAULT 0.0,
+            numeros_gratis INTEGER DEFAULT 0,
+            indicador_id INTEGER,
+            codigo_indicacao TEXT UNIQUE,
+            data_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total_depositado REAL DEFAULT 0.0,
+            indicacoes_validas INTEGER DEFAULT 0,
+            ultimo_bonus TIMESTAMP,
+            vip_status INTEGER DEFAULT 0,
+            total_starts INTEGER DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transacoes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            tipo TEXT,
+            valor REAL,
+            moeda TEXT,
+            status TEXT,
+            invoice_id TEXT,
+            data_transacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            data_confirmacao TIMESTAMP,
+            valor_crypto_pago REAL,
+            moeda_paga TEXT,
+            observacoes TEXT,
+            FOREIGN KEY (user_id) REFERENCES usuarios (user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS numeros_sms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            servico TEXT,
+            pais TEXT,
+            numero TEXT,
+            codigo_recebido TEXT,
+            preco REAL,
+            desconto_aplicado REAL,
+            status TEXT,
+            data_compra TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES usuarios (user_id)
+        )
+        """,
+    ]),
+    (2, "Colunas adicionadas após o lançamento (bancos antigos)", [
+        _migrar_colunas_legadas,
+    ]),
+    (3, "Índices secundários das consultas do bot", [
+        # Webhook: transação por invoice_id + status
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_invoice ON transacoes (invoice_id, status)",
+        # Listas e contagens por status ordenadas por data (valor incluído para SUM sem acessar a tabela)
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_status_data ON transacoes (status, data_transacao, valor)",
+        # get_user_stats: agregação por usuário coberta pelo índice
+        "CREATE INDEX IF NOT EXISTS idx_numeros_sms_user ON numeros_sms (user_id, preco, desconto_aplicado)",
+        # Novos usuários do dia (intervalo em data_registro)
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_data_registro ON usuarios (data_registro)",
+        # Top usuários por saldo
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_saldo ON usuarios (saldo)",
+    ]),
+    (4, "Contadores globais e diários materializados por triggers", [
+        """
+        CREATE TABLE IF NOT EXISTS estatisticas (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_usuarios INTEGER NOT NULL DEFAULT 0,
+            total_starts INTEGER NOT NULL DEFAULT 0,
+            total_vendas INTEGER NOT NULL DEFAULT 0,
+            total_faturamento REAL NOT NULL DEFAULT 0,
+            total_numeros INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS estatisticas_diarias (
+            dia TEXT PRIMARY KEY,
+            novos_usuarios INTEGER NOT NULL DEFAULT 0,
+            vendas INTEGER NOT NULL DEFAULT 0,
+            faturamento REAL NOT NULL DEFAULT 0,
+            numeros INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        _preencher_estatisticas,
+        # Novo usuário (INSERT OR IGNORE só dispara quando insere de fato)
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_usuario_novo AFTER INSERT ON usuarios
+        BEGIN
+            UPDATE estatisticas
+            SET total_usuarios = total_usuarios + 1,
+                total_starts = total_starts + COALESCE(NEW.total_starts, 0)
+            WHERE id = 1;
+            INSERT INTO estatisticas_diarias (dia, novos_usuarios)
+            VALUES (DATE(COALESCE(NEW.data_registro, 'now')), 1)
+            ON CONFLICT(dia) DO UPDATE SET novos_usuarios = novos_usuarios + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_usuario_removido AFTER DELETE ON usuarios
+        BEGIN
+            UPDATE estatisticas
+            SET total_usuarios = total_usuarios - 1,
+                total_starts = total_starts - COALESCE(OLD.total_starts, 0)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_starts AFTER UPDATE OF total_starts ON usuarios
+        WHEN NEW.total_starts IS NOT OLD.total_starts
+        BEGIN
+            UPDATE estatisticas
+            SET total_starts = total_starts + COALESCE(NEW.total_starts, 0) - COALESCE(OLD.total_starts, 0)
+            WHERE id = 1;
+        END
+        """,
+        # Vendas = transações confirmadas, no dia em que a transação foi criada
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_venda_nova AFTER INSERT ON transacoes
+        WHEN NEW.status = 'confirmado'
+        BEGIN
+            UPDATE estatisticas
+            SET total_vendas = total_vendas + 1,
+                total_faturamento = total_faturamento + COALESCE(NEW.valor, 0)
+            WHERE id = 1;
+            INSERT INTO estatisticas_diarias (dia, vendas, faturamento)
+            VALUES (DATE(COALESCE(NEW.data_transacao, 'now')), 1, COALESCE(NEW.valor, 0))
+            ON CONFLICT(dia) DO UPDATE SET vendas = vendas + 1, faturamento = faturamento + excluded.faturamento;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_venda_confirmada AFTER UPDATE OF status ON transacoes
+        WHEN NEW.status = 'confirmado' AND OLD.status IS NOT 'confirmado'
+        BEGIN
+            UPDATE estatisticas
+            SET total_vendas = total_vendas + 1,
+                total_faturamento = total_faturamento + COALESCE(NEW.valor, 0)
+            WHERE id = 1;
+            INSERT INTO estatisticas_diarias (dia, vendas, faturamento)
+            VALUES (DATE(COALESCE(NEW.data_transacao, 'now')), 1, COALESCE(NEW.valor, 0))
+            ON CONFLICT(dia) DO UPDATE SET vendas = vendas + 1, faturamento = faturamento + excluded.faturamento;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_venda_desfeita AFTER UPDATE OF status ON transacoes
+        WHEN OLD.status = 'confirmado' AND NEW.status IS NOT 'confirmado'
+        BEGIN
+            UPDATE estatisticas
+            SET total_vendas = total_vendas - 1,
+                total_faturamento = total_faturamento - COALESCE(OLD.valor, 0)
+            WHERE id = 1;
+            UPDATE estatisticas_diarias
+            SET vendas = vendas - 1, faturamento = faturamento - COALESCE(OLD.valor, 0)
+            WHERE dia = DATE(COALESCE(OLD.data_transacao, 'now'));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_numero_vendido AFTER INSERT ON numeros_sms
+        BEGIN
+            UPDATE estatisticas SET total_numeros = total_numeros + 1 WHERE id = 1;
+            INSERT INTO estatisticas_diarias (dia, numeros)
+            VALUES (DATE(COALESCE(NEW.data_compra, 'now')), 1)
+            ON CONFLICT(dia) DO UPDATE SET numeros = numeros + 1;
+        END
+        """,
+    ]),
+    (5, "Livro de movimentos de saldo (append-only) com saldo consolidado", [
+        """
+        CREATE TABLE IF NOT EXISTS movimentos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,
+            delta_saldo REAL NOT NULL DEFAULT 0,
+            delta_bonus REAL NOT NULL DEFAULT 0,
+            delta_depositado REAL NOT NULL DEFAULT 0,
+            referencia TEXT,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES usuarios (user_id)
+        )
+        """,
+        # Soma da cauda por usuário e extrato cobertos pelo índice
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimentos_user
+        ON movimentos (user_id, id, delta_saldo, delta_bonus, delta_depositado)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ledger_estado (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            ultimo_movimento_id INTEGER NOT NULL,
+            compactado_em TIMESTAMP
+        )
+        """,
+        "UPDATE usuarios SET saldo = COALESCE(saldo, 0), saldo_bonus = COALESCE(saldo_bonus, 0), "
+        "total_depositado = COALESCE(total_depositado, 0)",
+        # Saldos existentes entram no livro como abertura, já consolidados
+        """
+        INSERT INTO movimentos (user_id, tipo, delta_saldo, delta_bonus, delta_depositado)
+        SELECT user_id, 'abertura', saldo, saldo_bonus, total_depositado
+        FROM usuarios
+        WHERE saldo != 0 OR saldo_bonus != 0 OR total_depositado != 0
+        """,
+        """
+        INSERT OR REPLACE INTO ledger_estado (id, ultimo_movimento_id, compactado_em)
+        SELECT 1, COALESCE(MAX(id), 0), CURRENT_TIMESTAMP FROM movimentos
+        """,
+    ]),
+    (6, "Índices de cobertura para as listas paginadas do admin", [
+        # Chave (status, data_transacao, id) mais as colunas exibidas; substitui idx_transacoes_status_data
+        """
+        CREATE INDEX IF NOT EXISTS idx_transacoes_status_pagina
+        ON transacoes (status, data_transacao, id, user_id, valor, moeda, invoice_id)
+        """,
+        "DROP INDEX IF EXISTS idx_transacoes_status_data",
+        # Chave (saldo, user_id) mais as colunas exibidas; substitui idx_usuarios_saldo
+        """
+        CREATE INDEX IF NOT EXISTS idx_usuarios_saldo_pagina
+        ON usuarios (saldo, user_id, first_name, total_depositado)
+        """,
+        "DROP INDEX IF EXISTS idx_usuarios_saldo",
+    ]),
+    (7, "Arquivo frio de transações e números antigos", [
+        """
+        CREATE TABLE IF NOT EXISTS transacoes_arquivo (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            tipo TEXT,
+            valor REAL,
+            moeda TEXT,
+            status TEXT,
+            invoice_id TEXT,
+            data_transacao TIMESTAMP,
+            data_confirmacao TIMESTAMP,
+            valor_crypto_pago REAL,
+            moeda_paga TEXT,
+            observacoes TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS numeros_sms_arquivo (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            servico TEXT,
+            pais TEXT,
+            numero TEXT,
+            codigo_recebido TEXT,
+            preco REAL,
+            desconto_aplicado REAL,
+            status TEXT,
+            data_compra TIMESTAMP
+        )
+        """,
+        # Totais por usuário das compras já arquivadas (somados ao agregado de numeros_sms)
+        """
+        CREATE TABLE IF NOT EXISTS resumo_compras (
+            user_id INTEGER PRIMARY KEY,
+            total_compras INTEGER NOT NULL DEFAULT 0,
+            total_gasto REAL NOT NULL DEFAULT 0,
+            total_economizado REAL NOT NULL DEFAULT 0
+        )
+        """,
+        # Seleção das compras antigas para o arquivamento
+        "CREATE INDEX IF NOT EXISTS idx_numeros_sms_data ON numeros_sms (data_compra)",
+    ]),
+    (8, "Códigos de indicação do referral_codes.json em usuarios.codigo_indicacao", [
+        _importar_codigos_json,
+    ]),
+    (9, "Árvore de indicações (closure table) e agregados por indicador", [
+        # Um registro por par (ancestral, descendente); profundidade 1 = indicação direta
+        """
+        CREATE TABLE IF NOT EXISTS indicacoes_arvore (
+            ancestral_id INTEGER NOT NULL,
+            descendente_id INTEGER NOT NULL,
+            profundidade INTEGER NOT NULL,
+            PRIMARY KEY (ancestral_id, descendente_id)
+        )
+        """,
+        # Ancestrais de um usuário (novo cadastro e depósitos sobem a árvore por aqui)
+        """
+        CREATE INDEX IF NOT EXISTS idx_indicacoes_arvore_descendente
+        ON indicacoes_arvore (descendente_id, ancestral_id, profundidade)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS indicacoes_resumo (
+            user_id INTEGER PRIMARY KEY,
+            diretas INTEGER NOT NULL DEFAULT 0,
+            indiretas INTEGER NOT NULL DEFAULT 0,
+            depositantes INTEGER NOT NULL DEFAULT 0,
+            volume_rede REAL NOT NULL DEFAULT 0,
+            volume_proprio REAL NOT NULL DEFAULT 0
+        )
+        """,
+        # Ranking de indicadores pelo volume depositado pela rede
+        "CREATE INDEX IF NOT EXISTS idx_indicacoes_resumo_volume ON indicacoes_resumo (volume_rede, user_id)",
+        _preencher_indicacoes,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_indicacoes_usuario_novo AFTER INSERT ON usuarios
+        WHEN NEW.indicador_id IS NOT NULL AND NEW.indicador_id != NEW.user_id
+        BEGIN
+            INSERT OR IGNORE INTO indicacoes_arvore (ancestral_id, descendente_id, profundidade)
+            SELECT NEW.indicador_id, NEW.user_id, 1
+            UNION ALL
+            SELECT ancestral_id, NEW.user_id, profundidade + 1
+            FROM indicacoes_arvore WHERE descendente_id = NEW.indicador_id;
+
+            INSERT INTO indicacoes_resumo (user_id, diretas) VALUES (NEW.indicador_id, 1)
+            ON CONFLICT(user_id) DO UPDATE SET diretas = diretas + 1;
+
+            INSERT INTO indicacoes_resumo (user_id, indiretas)
+            SELECT ancestral_id, 1 FROM indicacoes_arvore
+            WHERE descendente_id = NEW.user_id AND profundidade > 1
+            ON CONFLICT(user_id) DO UPDATE SET indiretas = indiretas + 1;
+        END
+        """,
+        # Todo depósito (fatura, manual ou crédito admin) entra no livro com delta_depositado > 0
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_indicacoes_deposito AFTER INSERT ON movimentos
+        WHEN NEW.delta_depositado > 0
+        BEGIN
+            INSERT INTO indicacoes_resumo (user_id, depositantes, volume_rede)
+            SELECT ancestral_id,
+                   COALESCE((SELECT volume_proprio FROM indicacoes_resumo WHERE user_id = NEW.user_id), 0) = 0,
+                   NEW.delta_depositado
+            FROM indicacoes_arvore WHERE descendente_id = NEW.user_id
+            ON CONFLICT(user_id) DO UPDATE
+            SET depositantes = depositantes + excluded.depositantes,
+                volume_rede = volume_rede + excluded.volume_rede;
+
+            INSERT INTO indicacoes_resumo (user_id, volume_proprio) VALUES (NEW.user_id, NEW.delta_depositado)
+            ON CONFLICT(user_id) DO UPDATE SET volume_proprio = volume_proprio + excluded.volume_proprio;
+        END
+        """,
+    ]),
+    (10, "Valor em cripto cobrado na fatura (validação do webhook)", [
+        "ALTER TABLE transacoes ADD COLUMN valor_crypto REAL",
+        "ALTER TABLE transacoes_arquivo ADD COLUMN valor_crypto REAL",
+    ]),
+]
+
+# Tabelas que crescem sem limite: um SCAN nelas é tratado como regressão
+TABELAS_GRANDES = {
+    "usuarios", "transacoes", "numeros_sms", "movimentos", "transacoes_arquivo", "numeros_sms_arquivo",
+    "indicacoes_arvore", "indicacoes_resumo",
+}
+
+# Consultas que percorrem a tabela inteira por natureza (agregados globais e broadcast)
+SCANS_PERMITIDOS = {
+    "get_all_user_ids",
+    "reconciliar_saldos",
+}
+
+class DatabaseMetrics:
+    """Métricas por consulta nomeada (chave do dicionário SQL/PG_SQL).
+
+    Para cada consulta: chamadas, latência (p50/p95/p99 sobre as últimas
+    `amostras` execuções), linhas devolvidas/afetadas e erros (quantos deles
+    foram `database is locked`). Também soma o tempo esperando `DatabaseManager._lock`
+    e uma conexão livre no pool. Thread-safe: é alimentado pelas threads do banco.
+    """
+
+    def __init__(self, amostras=DB_METRICS_AMOSTRAS, lenta_ms=DB_SLOW_QUERY_MS):
+        self.amostras = amostras
+        self.lenta_ms = lenta_ms
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.consultas = defaultdict(lambda: {
+                "calls": 0, "rows": 0, "errors": 0, "locked": 0,
+                "total": 0.0, "max": 0.0, "latencias": deque(maxlen=self.amostras),
+            })
+            self.esperas = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0})
+            self.desde = datetime.now().isoformat()
+
+    def registrar(self, nome, segundos, linhas=0):
+        with self._lock:
+            stats = self.consultas[nome]
+            stats["calls"] += 1
+            stats["rows"] += linhas
+            stats["total"] += segundos
+            stats["max"] = max(stats["max"], segundos)
+            stats["latencias"].append(segundos)
+        if segundos * 1000 > self.lenta_ms:
+            logger.warning(f"🐢 Consulta lenta {nome}: {segundos * 1000:.0f}ms ({linhas} linhas)")
+
+    def registrar_linhas(self, nome, linhas):
+        with self._lock:
+            self.consultas[nome]["rows"] += linhas
+
+    def registrar_erro(self, nome, locked=False):
+        with self._lock:
+            self.consultas[nome]["errors"] += 1
+            if locked:
+                self.consultas[nome]["locked"] += 1
+
+    def registrar_espera(self, nome, segundos):
+        with self._lock:
+            stats = self.esperas[nome]
+            stats["count"] += 1
+            stats["total"] += segundos
+            stats["max"] = max(stats["max"], segundos)
+
+    @staticmethod
+    def _percentil(ordenadas, p):
+        if not ordenadas:
+            return 0.0
+        return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * p))]
+
+    def resumo(self, top=None):
+        """Consultas ordenadas pelo tempo total, com latências em ms"""
+        with self._lock:
+            itens = [(nome, dict(stats), sorted(stats["latencias"])) for nome, stats in self.consultas.items()]
+            esperas = {nome: dict(stats) for nome, stats in self.esperas.items()}
+        consultas = []
+        for nome, stats, ordenadas in sorted(itens, key=lambda item: item[1]["total"], reverse=True)[:top]:
+            consultas.append({
+                "nome": nome,
+                "calls": stats["calls"],
+                "rows": stats["rows"],
+                "errors": stats["errors"],
+                "locked": stats["locked"],
+                "total_ms": stats["total"] * 1000,
+                "p50_ms": self._percentil(ordenadas, 0.50) * 1000,
+                "p95_ms": self._percentil(ordenadas, 0.95) * 1000,
+                "p99_ms": self._percentil(ordenadas, 0.99) * 1000,
+                "max_ms": stats["max"] * 1000,
+            })
+        esperas = {
+            nome: {"count": stats["count"], "total_ms": stats["total"] * 1000, "max_ms": stats["max"] * 1000}
+            for nome, stats in esperas.items()
+        }
+        return {"desde": self.desde, "consultas": consultas, "esperas": esperas}
+
+db_metrics = DatabaseMetrics()
+
+# Texto SQL -> nome da consulta, preenchido na primeira execução
+_NOMES_CONSULTAS = {}
+
+def nome_da_consulta(sql):
+    """Nome da consulta em SQL/PG_SQL; comandos avulsos viram `sql:<duas primeiras palavras>`"""
+    if not _NOMES_CONSULTAS:
+        _NOMES_CONSULTAS.update({consulta: nome for nome, consulta in SQL.items()})
+        _NOMES_CONSULTAS.update({consulta: nome for nome, consulta in PG_SQL.items()})
+    nome = _NOMES_CONSULTAS.get(sql)
+    if nome is None:
+        nome = "sql:" + " ".join(re.findall(r"\w+", sql)[:2]).upper()
+    return nome
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor que mede cada execução e conta as linhas lidas.
+
+    A latência cobre o execute (preparo + primeiro passo, que nas consultas
+    com agregação/ORDER BY já é todo o trabalho); linhas lidas depois pelo
+    fetch são somadas à mesma consulta. Não há retentativa: o busy_timeout
+    da conexão já esperou pelo lock, e um `database is locked` que chega aqui
+    só é contado e repassado.
+    """
+
+    nome = None
+
+    def _executar(self, metodo, sql, params):
+        self.nome = nome_da_consulta(sql)
+        inicio = time.perf_counter()
+        try:
+            metodo(sql, params)
+        except sqlite3.OperationalError as e:
+            db_metrics.registrar_erro(self.nome, locked="locked" in str(e))
+            raise
+        except Exception:
+            db_metrics.registrar_erro(self.nome)
+            raise
+        linhas = self.rowcount if self.description is None and self.rowcount > 0 else 0
+        db_metrics.registrar(self.nome, time.perf_counter() - inicio, linhas)
+        return self
+
+    def execute(self, sql, params=()):
+        return self._executar(super().execute, sql, params)
+
+    def executemany(self, sql, params):
+        return self._executar(super().executemany, sql, list(params))
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self.nome:
+            db_metrics.registrar_linhas(self.nome, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self.nome:
+            db_metrics.registrar_linhas(self.nome, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self.nome:
+            db_metrics.registrar_linhas(self.nome, len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        if self.nome:
+            db_metrics.registrar_linhas(self.nome, 1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Conexão cujos atalhos execute/executemany usam o InstrumentedCursor"""
+
+    def execute(self, sql, params=()):
+        return self.cursor(InstrumentedCursor).execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor(InstrumentedCursor).executemany(sql, params)
+
+class SQLiteConnectionPool:
+    """Pool de conexões SQLite de longa duração.
+
+    As conexões são abertas sob demanda até `size`, recebem os PRAGMAs uma única
+    vez e são reutilizadas em ordem LIFO para manter o cache de páginas aquecido.
+    Conexões ociosas há mais de `healthcheck_interval` segundos são validadas
+    antes de voltar ao uso e substituídas se estiverem quebradas.
+    """
+
+    def __init__(self, db_path, size=DB_POOL_SIZE, timeout=30.0,
+                 healthcheck_interval=DB_POOL_HEALTHCHECK_SECONDS):
         self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = queue.LifoQueue()
+        self._created = 0
         self._lock = threading.Lock()
-        self.init_database()
+        self._closed = False
 
-    def get_connection(self):
-        """Obtém conexão com configurações otimizadas para alta concorrência"""
+    def _connect(self):
+        """Abre uma nova conexão com configurações otimizadas para alta concorrência"""
         conn = sqlite3.connect(
             self.db_path,
-            timeout=30.0,  # Timeout de 30 segundos
-            check_same_thread=False
+            timeout=self.timeout,
+            check_same_thread=False,
+            factory=InstrumentedConnection
         )
         # Otimizações para performance
         conn.execute("PRAGMA journal_mode=WAL")  # Write-Ahead Logging
@@ -315,281 +1473,2099 @@ class DatabaseManager:
         conn.execute("PRAGMA temp_store=MEMORY")  # Store temporário na memória
         return conn
 
-    def init_database(self):
-        """Inicializa o banco de dados com as tabelas necessárias"""
-        with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-
-        # Tabela de usuários
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                saldo REAL DEFAULT 0.0,
-                saldo_bonus REAL DEFAULT 0.0,
-                numeros_gratis INTEGER DEFAULT 0,
-                indicador_id INTEGER,
-                codigo_indicacao TEXT UNIQUE,
-                data_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_depositado REAL DEFAULT 0.0,
-                indicacoes_validas INTEGER DEFAULT 0,
-                ultimo_bonus TIMESTAMP,
-                vip_status INTEGER DEFAULT 0,
-                total_starts INTEGER DEFAULT 0
-            )
-        ''')
-
-        # Migração: Adicionar coluna total_starts se não existir
+    def _is_healthy(self, conn):
+        """Verifica se a conexão ainda responde"""
         try:
-            cursor.execute('ALTER TABLE usuarios ADD COLUMN total_starts INTEGER DEFAULT 0')
-        except sqlite3.OperationalError:
-            # Coluna já existe, ignorar erro
-            pass
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
 
-        # Migração: Adicionar coluna saldo_bonus se não existir
+    def _discard(self, conn):
+        """Fecha uma conexão e libera sua vaga no pool"""
         try:
-            cursor.execute('ALTER TABLE usuarios ADD COLUMN saldo_bonus REAL DEFAULT 0.0')
-        except sqlite3.OperationalError:
-            # Coluna já existe, ignorar erro
+            conn.close()
+        except sqlite3.Error:
             pass
+        with self._lock:
+            self._created -= 1
 
-        # Tabela de transações
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transacoes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                tipo TEXT,
-                valor REAL,
-                moeda TEXT,
-                status TEXT,
-                invoice_id TEXT,
-                data_transacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                data_confirmacao TIMESTAMP,
-                valor_crypto_pago REAL,
-                moeda_paga TEXT,
-                observacoes TEXT,
-                FOREIGN KEY (user_id) REFERENCES usuarios (user_id)
-            )
-        ''')
-
-        # Migração: Adicionar colunas se não existirem
-        try:
-            cursor.execute('ALTER TABLE transacoes ADD COLUMN data_confirmacao TIMESTAMP')
-        except sqlite3.OperationalError:
-            pass
+    def acquire(self):
+        """Obtém uma conexão do pool, criando uma nova se ainda houver vaga"""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Pool de conexões já foi fechado")
 
         try:
-            cursor.execute('ALTER TABLE transacoes ADD COLUMN valor_crypto_pago REAL')
-        except sqlite3.OperationalError:
-            pass
+            conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                conn, last_used = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise sqlite3.OperationalError(
+                    f"Pool de conexões esgotado ({self.size} conexões em uso)"
+                )
 
-        try:
-            cursor.execute('ALTER TABLE transacoes ADD COLUMN moeda_paga TEXT')
-        except sqlite3.OperationalError:
-            pass
+        # Health check apenas em conexões que ficaram ociosas por muito tempo
+        if time.monotonic() - last_used > self.healthcheck_interval and not self._is_healthy(conn):
+            logger.warning("Conexão SQLite inválida descartada do pool")
+            self._discard(conn)
+            with self._lock:
+                self._created += 1
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return conn
 
+    def release(self, conn):
+        """Devolve a conexão ao pool, desfazendo qualquer transação aberta"""
         try:
-            cursor.execute('ALTER TABLE transacoes ADD COLUMN observacoes TEXT')
-        except sqlite3.OperationalError:
-            pass
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
 
-        # Tabela de números SMS
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS numeros_sms (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                servico TEXT,
-                pais TEXT,
-                numero TEXT,
-                codigo_recebido TEXT,
-                preco REAL,
-                desconto_aplicado REAL,
-                status TEXT,
-                data_compra TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES usuarios (user_id)
-            )
-        ''')
+    def close_all(self):
+        """Fecha todas as conexões ociosas (usado no desligamento)"""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Foto de um usuário: saldos, contadores, indicação e estatísticas de compra"""
+    user_id: int
+    username: str | None
+    first_name: str | None
+    saldo_base: float
+    bonus: float
+    numeros_gratis: int
+    indicador_id: int | None
+    codigo_indicacao: str | None
+    data_registro: str | None
+    total_depositado: float
+    indicacoes_validas: int
+    total_starts: int
+    total_compras: int
+    total_gasto: float
+    total_economizado: float
+
+    @property
+    def saldo_total(self):
+        return self.saldo_base + self.bonus
+
+    @classmethod
+    def from_row(cls, row):
+        (user_id, username, first_name, saldo, saldo_bonus, numeros_gratis, indicador_id,
+         codigo_indicacao, data_registro, total_depositado, indicacoes_validas, total_starts,
+         total_compras, total_gasto, total_economizado) = row
+        return cls(
+            user_id=user_id,
+            username=username,
+            first_name=first_name,
+            saldo_base=saldo or 0.0,
+            bonus=saldo_bonus or 0.0,
+            numeros_gratis=numeros_gratis or 0,
+            indicador_id=indicador_id,
+            codigo_indicacao=codigo_indicacao,
+            data_registro=data_registro,
+            total_depositado=total_depositado or 0.0,
+            indicacoes_validas=indicacoes_validas or 0,
+            total_starts=total_starts or 0,
+            total_compras=total_compras or 0,
+            total_gasto=total_gasto or 0.0,
+            total_economizado=total_economizado or 0.0,
+        )
 
-        conn.commit()
-        conn.close()
+class UserCache:
+    """Cache LRU com TTL para leituras por usuário (UserSnapshot).
+
+    As chaves são `(tipo, user_id)`. Toda escrita que muda dados do usuário
+    chama `invalidate(user_id)` depois do commit. Para evitar que uma leitura
+    iniciada antes da escrita grave o valor antigo de volta, `put` recebe a
+    geração da chave lida em `generation(key)` antes da consulta e é ignorado
+    se aquele usuário foi invalidado no meio do caminho. As gerações são por
+    usuário (as de `max_size` usuários mais recentes); quando uma sai da
+    tabela, `_epoca` avança e descarta os `put` em andamento. `ttl` 0 desliga
+    o cache.
+    """
+
+    TIPOS = ("snapshot",)
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generations = OrderedDict()
+        self._epoca = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
 
-    def get_user(self, user_id):
-        """Busca um usuário no banco"""
+    def generation(self, key):
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM usuarios WHERE user_id = ?", (user_id,))
-            user = cursor.fetchone()
-            conn.close()
-            return user
+            return self._epoca, self._generations.get(key[1], 0)
 
-    def create_user(self, user_id, username, first_name, indicador_id=None):
-        """Cria um novo usuário com bônus de boas-vindas"""
+    def get(self, key):
+        """Retorna `(True, valor)` se a chave está no cache e não expirou, senão `(False, None)`"""
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR IGNORE INTO usuarios (user_id, username, first_name, indicador_id, saldo, saldo_bonus)
-                VALUES (?, ?, ?, ?, 0.0, 0.5)
-            ''', (user_id, username, first_name, indicador_id))
-            conn.commit()
-            conn.close()
-
-    def update_saldo(self, user_id, valor):
-        """Atualiza o saldo base do usuário (APENAS para depósitos)"""
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return True, value
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return False, None
+
+    def put(self, key, value, generation):
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE usuarios SET saldo = saldo + ? WHERE user_id = ?
-            ''', (valor, user_id))
-            conn.commit()
-            conn.close()
-
-    def update_saldo_bonus(self, user_id, valor_bonus):
-        """Atualiza o saldo de bônus do usuário"""
+            if self.ttl <= 0 or generation != (self._epoca, self._generations.get(key[1], 0)):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, *user_ids):
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE usuarios SET saldo_bonus = saldo_bonus + ? WHERE user_id = ?
-            ''', (valor_bonus, user_id))
-            conn.commit()
-            conn.close()
+            for user_id in user_ids:
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+                self._generations.move_to_end(user_id)
+                for tipo in self.TIPOS:
+                    self._entries.pop((tipo, user_id), None)
+            while len(self._generations) > self.max_size:
+                self._generations.popitem(last=False)
+                self._epoca += 1
+            self.stats["invalidations"] += 1
+
+    def metrics(self):
+        """Métricas para /status"""
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            "size": len(self._entries),
+            "hit_rate": round(self.stats["hits"] / total, 3) if total else 0.0,
+            **self.stats,
+        }
 
-    def processar_deposito(self, user_id, valor_depositado, bonus):
-        """Processa um depósito separando saldo base e bônus"""
-        with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            # Atualizar saldo base com valor depositado
-            cursor.execute('UPDATE usuarios SET saldo = saldo + ? WHERE user_id = ?', (valor_depositado, user_id))
-            # Atualizar bônus separadamente
-            cursor.execute('UPDATE usuarios SET saldo_bonus = saldo_bonus + ? WHERE user_id = ?', (bonus, user_id))
-            # Atualizar total depositado
-            cursor.execute('UPDATE usuarios SET total_depositado = total_depositado + ? WHERE user_id = ?', (valor_depositado, user_id))
-            conn.commit()
-            conn.close()
+class DatabaseManager:
+    def __init__(self, db_path="premium_bot.db", pool_size=DB_POOL_SIZE):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.pool = SQLiteConnectionPool(db_path, size=pool_size)
+        self.cache = UserCache()
+        self._backup_lock = threading.Lock()
+        self.migrate()
+
+    @contextmanager
+    def connection(self):
+        """Empresta uma conexão do pool; faz commit ao sair ou rollback em caso de erro"""
+        inicio = time.perf_counter()
+        conn = self.pool.acquire()
+        db_metrics.registrar_espera("pool", time.perf_counter() - inicio)
+        try:
+            yield conn
+            if conn.in_transaction:
+                inicio = time.perf_counter()
+                conn.commit()
+                db_metrics.registrar("sql:COMMIT", time.perf_counter() - inicio)
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.release(conn)
 
-    def deduzir_saldo(self, user_id, valor):
-        """Deduz saldo do usuário, usando primeiro o bônus e depois o saldo base"""
+    @contextmanager
+    def _travar(self, nome):
+        """Pega `_lock` registrando quanto tempo `nome` esperou por ele"""
+        inicio = time.perf_counter()
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-
-            # Obter saldo atual
-            cursor.execute('SELECT saldo, saldo_bonus FROM usuarios WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            if not result:
-                conn.close()
-                return False
-
-            saldo_base, saldo_bonus = result
-            saldo_base = saldo_base or 0.0
-            saldo_bonus = saldo_bonus or 0.0
+            db_metrics.registrar_espera(f"_lock:{nome}", time.perf_counter() - inicio)
+            yield
+
+    def migrate(self):
+        """Aplica as migrações pendentes de MIGRATIONS numa única transação.
+
+        A versão atual fica na tabela schema_version; se o schema já estiver
+        em dia, custa apenas uma leitura. Retorna a versão final do schema.
+        """
+        ultima = MIGRATIONS[-1][0]
+        with self.connection() as conn:
+            existe = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+            ).fetchone()
+            if existe:
+                atual = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+                if atual >= ultima:
+                    return atual
+
+            # BEGIN IMMEDIATE garante que só um processo migra por vez
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    descricao TEXT,
+                    aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            atual = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+
+            for version, descricao, passos in MIGRATIONS:
+                if version <= atual:
+                    continue
+                for passo in passos:
+                    if callable(passo):
+                        passo(conn)
+                    else:
+                        conn.execute(passo)
+                conn.execute(
+                    "INSERT INTO schema_version (version, descricao) VALUES (?, ?)",
+                    (version, descricao)
+                )
+                logger.info(f"🗄️ Migração {version} aplicada: {descricao}")
+                atual = version
+
+            return atual
+
+    def _cached(self, key, load):
+        """Leitura via cache: devolve o valor em memória ou executa `load()` e guarda o resultado"""
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        generation = self.cache.generation(key)
+        value = load()
+        self.cache.put(key, value, generation)
+        return value
+
+    def _load_snapshot(self, user_id):
+        with self.connection() as conn:
+            row = conn.execute(SQL["get_user_snapshot"], {"user_id": user_id}).fetchone()
+        return UserSnapshot.from_row(row) if row else None
+
+    def get_user_snapshot(self, user_id):
+        """UserSnapshot do usuário (do cache ou numa única consulta), ou None se ele não existe"""
+        return self._cached(("snapshot", user_id), lambda: self._load_snapshot(user_id))
 
-            # Verificar se há saldo suficiente
-            saldo_total = saldo_base + saldo_bonus
-            if saldo_total < valor:
-                conn.close()
-                return False
+    def get_user(self, user_id):
+        """Busca a linha completa de um usuário no banco"""
+        with self.connection() as conn:
+            return conn.execute(SQL["get_user"], (user_id,)).fetchone()
+
+    def get_user_by_referral_code(self, code):
+        """user_id dono do código de indicação (busca pelo índice UNIQUE), ou None"""
+        with self.connection() as conn:
+            row = conn.execute(SQL["get_user_by_referral_code"], (code,)).fetchone()
+        return row[0] if row else None
+
+    def get_resumo_indicacoes(self, user_id):
+        """(diretas, indiretas, depositantes, volume_rede) da rede de indicações do usuário"""
+        with self.connection() as conn:
+            return conn.execute(SQL["get_resumo_indicacoes"], (user_id,)).fetchone() or (0, 0, 0, 0.0)
+
+    def get_ranking_indicadores(self, limit=10):
+        """Indicadores com maior volume depositado pela rede (diretas + indiretas)"""
+        with self.connection() as conn:
+            return conn.execute(SQL["ranking_indicadores"], (limit,)).fetchall()
+
+    def get_or_create_referral_code(self, user_id):
+        """Código de indicação do usuário, gerando um novo na primeira vez.
+
+        O UPDATE só grava se o usuário ainda não tem código, então dois
+        pedidos simultâneos acabam com o mesmo código; colisão com o código de
+        outro usuário esbarra no UNIQUE e um novo é sorteado.
+        """
+        with self.connection() as conn:
+            while True:
+                row = conn.execute(SQL["get_referral_code"], (user_id,)).fetchone()
+                if row is None or row[0]:
+                    return row[0] if row else None
+                try:
+                    conn.execute(SQL["set_referral_code"], (generate_referral_code(), user_id))
+                except sqlite3.IntegrityError:
+                    continue
+                conn.commit()
+                self.cache.invalidate(user_id)
 
-            # Deduzir primeiro do bônus
-            if saldo_bonus >= valor:
-                # Todo valor é deduzido do bônus
-                cursor.execute('UPDATE usuarios SET saldo_bonus = saldo_bonus - ? WHERE user_id = ?', (valor, user_id))
-            else:
-                # Deduzir todo o bônus e o restante do saldo base
-                valor_restante = valor - saldo_bonus
-                cursor.execute('UPDATE usuarios SET saldo_bonus = 0 WHERE user_id = ?', (user_id,))
-                cursor.execute('UPDATE usuarios SET saldo = saldo - ? WHERE user_id = ?', (valor_restante, user_id))
+    def create_user(self, user_id, username, first_name, indicador_id=None):
+        """Cria um novo usuário com bônus de boas-vindas"""
+        with self.connection() as conn:
+            cursor = conn.execute(SQL["create_user"], (user_id, username, first_name, indicador_id))
+            if cursor.rowcount:
+                conn.execute(SQL["registrar_movimento"], (user_id, "boas_vindas", 0.0, 0.5, 0.0, None))
+        self.cache.invalidate(user_id)
+
+    def _registrar_movimento(self, user_id, tipo, delta_saldo=0.0, delta_bonus=0.0, delta_depositado=0.0, referencia=None):
+        with self.connection() as conn:
+            conn.execute(SQL["registrar_movimento"], (user_id, tipo, delta_saldo, delta_bonus, delta_depositado, referencia))
+        self.cache.invalidate(user_id)
+
+    def update_saldo(self, user_id, valor, tipo="ajuste"):
+        """Lança um crédito (ou débito, se negativo) no saldo base do usuário"""
+        self._registrar_movimento(user_id, tipo, delta_saldo=valor)
+
+    def update_saldo_bonus(self, user_id, valor_bonus, tipo="bonus_admin"):
+        """Lança um crédito no saldo de bônus do usuário"""
+        self._registrar_movimento(user_id, tipo, delta_bonus=valor_bonus)
+
+    def processar_deposito(self, user_id, valor_depositado, bonus, numeros_gratis=0, tipo="deposito", referencia=None):
+        """Processa um depósito separando saldo base e bônus"""
+        with self.connection() as conn:
+            conn.execute(
+                SQL["registrar_movimento"],
+                (user_id, tipo, valor_depositado, bonus, valor_depositado, referencia)
+            )
+            if numeros_gratis:
+                conn.execute(SQL["add_numeros_gratis"], (numeros_gratis, user_id))
+        self.cache.invalidate(user_id)
+
+    def deduzir_saldo(self, user_id, valor, referencia=None):
+        """Deduz saldo do usuário, usando primeiro o bônus e depois o saldo base.
+
+        Verificação e lançamento do débito acontecem num único INSERT ... SELECT
+        condicional, então compras concorrentes nunca deixam o saldo negativo.
+        Retorna a tupla (saldo, saldo_bonus) após o débito ou None se o saldo
+        for insuficiente.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute(
+                SQL["deduzir_saldo"],
+                {"user_id": user_id, "valor": valor, "referencia": referencia}
+            )
+            if not cursor.rowcount:
+                return None
+            _, saldo, saldo_bonus, _ = conn.execute(SQL["get_saldo_atual"], {"user_id": user_id}).fetchone()
+        self.cache.invalidate(user_id)
+        return saldo, saldo_bonus
+
+    def get_movimentos(self, user_id, limit=10):
+        """Extrato: últimos movimentos de saldo do usuário (mais recentes primeiro)"""
+        with self.connection() as conn:
+            return conn.execute(SQL["get_movimentos"], (user_id, limit)).fetchall()
+
+    def compactar_saldos(self):
+        """Consolida em usuarios os movimentos lançados desde a última compactação.
+
+        Roda numa transação IMMEDIATE: a leitura do ponto de corte e a
+        atualização dos saldos consolidados acontecem sob o mesmo lock de
+        escrita. Retorna a quantidade de movimentos consolidados.
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            de = conn.execute(SQL["get_ledger_estado"]).fetchone()[0]
+            ate = conn.execute(SQL["get_ultimo_movimento"]).fetchone()[0] or 0
+            if ate <= de:
+                return 0
+            conn.execute(SQL["compactar_movimentos"], (de, ate))
+            conn.execute(SQL["atualizar_ledger_estado"], (ate,))
+        return ate - de
+
+    def reconciliar_saldos(self):
+        """Lista usuários cujo saldo consolidado não bate com a soma do livro de movimentos"""
+        with self.connection() as conn:
+            return conn.execute(SQL["reconciliar_saldos"]).fetchall()
+
+    def backup(self, diretorio=BACKUP_DIR, paginas=BACKUP_PAGINAS, pausa=BACKUP_PAUSA_SECONDS, manter=BACKUP_MANTER):
+        """Snapshot online do banco com a API de backup do SQLite.
+
+        Copia `paginas` páginas por passo com uma pausa entre eles. A origem
+        fica numa transação de leitura durante toda a cópia: no modo WAL isso
+        fixa um snapshot consistente sem bloquear quem escreve (e evita que o
+        backup recomece a cada commit). O arquivo só entra na rotação depois
+        de passar no PRAGMA integrity_check; ficam os `manter` mais recentes.
+        """
+        if not self._backup_lock.acquire(blocking=False):
+            raise RuntimeError("Já existe um backup em andamento")
+        try:
+            os.makedirs(diretorio, exist_ok=True)
+            inicio = time.monotonic()
+            caminho = os.path.join(diretorio, datetime.now().strftime("premium_bot-%Y%m%d-%H%M%S.db"))
+            parcial = caminho + ".parcial"
+            passos = 0
+
+            def progresso(status, restantes, total):
+                nonlocal passos
+                passos += 1
+                time.sleep(pausa)
+
+            origem = sqlite3.connect(self.db_path, timeout=30.0)
+            destino = sqlite3.connect(parcial)
+            try:
+                origem.execute("BEGIN")
+                origem.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                origem.backup(destino, pages=paginas, progress=progresso)
+                origem.rollback()
+                # O snapshot vira um arquivo único, sem -wal
+                destino.execute("PRAGMA journal_mode=DELETE")
+                integridade = destino.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                destino.close()
+                origem.close()
+
+            if integridade != "ok":
+                os.remove(parcial)
+                raise RuntimeError(f"Backup falhou no integrity_check: {integridade}")
+            os.replace(parcial, caminho)
+
+            snapshots = sorted(
+                nome for nome in os.listdir(diretorio)
+                if nome.startswith("premium_bot-") and nome.endswith(".db")
+            )
+            for antigo in snapshots[:-manter] if manter > 0 else []:
+                os.remove(os.path.join(diretorio, antigo))
 
-            conn.commit()
-            conn.close()
-            return True
+            return {
+                "arquivo": caminho,
+                "bytes": os.path.getsize(caminho),
+                "segundos": time.monotonic() - inicio,
+                "passos": passos,
+                "mantidos": min(len(snapshots), manter),
+            }
+        finally:
+            self._backup_lock.release()
+
+    def _arquivar_em_lotes(self, selecionar, passos, idade, lote):
+        """Move lotes de até `lote` linhas, cada um na sua transação IMMEDIATE, até acabar"""
+        total = 0
+        while True:
+            with self.connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                ids = [row[0] for row in conn.execute(SQL[selecionar], (idade, lote))]
+                if ids:
+                    lista = json.dumps(ids)
+                    for passo in passos:
+                        conn.execute(SQL[passo], (lista,))
+            total += len(ids)
+            if len(ids) < lote:
+                return total
+
+    def arquivar_antigos(self, retencao_dias=ARQUIVO_RETENCAO_DIAS, lote=ARQUIVO_LOTE):
+        """Move transações e números finalizados mais antigos que `retencao_dias` para o arquivo.
+
+        Pagamentos pendentes e números aguardando SMS nunca são arquivados; antes
+        disso, números aguardando há mais de NUMERO_EXPIRACAO_MINUTOS viram "expirado". Estatísticas globais/diárias
+        não mudam e os totais de compras por usuário continuam no snapshot via
+        resumo_compras. Retorna (transações, números) arquivados.
+        """
+        idade = f"-{int(retencao_dias)} days"
+        transacoes = self._arquivar_em_lotes(
+            "selecionar_transacoes_arquivar", ("arquivar_transacoes", "remover_transacoes_arquivadas"), idade, lote
+        )
+        with self.connection() as conn:
+            conn.execute(SQL["expirar_numeros"], (f"-{NUMERO_EXPIRACAO_MINUTOS} minutes",))
+        numeros = self._arquivar_em_lotes(
+            "selecionar_numeros_arquivar",
+            ("resumir_numeros_arquivados", "arquivar_numeros", "remover_numeros_arquivados"),
+            idade, lote
+        )
+        return transacoes, numeros
 
     def get_saldo(self, user_id):
         """Obtém o saldo total do usuário (base + bônus)"""
-        with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT saldo, saldo_bonus FROM usuarios WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                saldo_base, saldo_bonus = result
-                return (saldo_base or 0.0) + (saldo_bonus or 0.0)
-            return 0.0
+        user = self.get_user_snapshot(user_id)
+        return user.saldo_total if user else 0.0
 
     def get_numeros_gratis(self, user_id):
         """Obtém a quantidade de números grátis do usuário"""
-        with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT numeros_gratis FROM usuarios WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            return result[0] if result else 0
+        user = self.get_user_snapshot(user_id)
+        return user.numeros_gratis if user else 0
 
     def get_user_details(self, user_id):
         """Obtém detalhes completos do usuário incluindo saldo base e bônus separados"""
-        with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT saldo, saldo_bonus, numeros_gratis, total_depositado 
-                FROM usuarios WHERE user_id = ?
-            """, (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            if result:
-                saldo_base, saldo_bonus, numeros_gratis, total_depositado = result
-
-                # Garantir que valores não sejam None
-                saldo_base = saldo_base or 0.0
-                saldo_bonus = saldo_bonus or 0.0
-                numeros_gratis = numeros_gratis or 0
-                total_depositado = total_depositado or 0.0
-
-                # Saldo total = saldo base + bônus
-                saldo_total = saldo_base + saldo_bonus
-
-                return {
-                    'saldo_base': saldo_base,
-                    'bonus': saldo_bonus,
-                    'saldo_total': saldo_total,
-                    'numeros_gratis': numeros_gratis,
-                    'total_depositado': total_depositado
-                }
+        user = self.get_user_snapshot(user_id)
+        if user:
             return {
-                'saldo_base': 0,
-                'bonus': 0,
-                'saldo_total': 0,
-                'numeros_gratis': 0,
-                'total_depositado': 0
+                'saldo_base': user.saldo_base,
+                'bonus': user.bonus,
+                'saldo_total': user.saldo_total,
+                'numeros_gratis': user.numeros_gratis,
+                'total_depositado': user.total_depositado
             }
+        return {
+            'saldo_base': 0,
+            'bonus': 0,
+            'saldo_total': 0,
+            'numeros_gratis': 0,
+            'total_depositado': 0
+        }
 
     def get_user_stats(self, user_id):
-        """Obtém estatísticas do usuário"""
+        """Obtém estatísticas do usuário: (total_compras, total_gasto, total_economizado)"""
+        user = self.get_user_snapshot(user_id)
+        if user:
+            return user.total_compras, user.total_gasto, user.total_economizado
+        return 0, 0.0, 0.0
+
+    def update_user_starts(self, user_id, quantidade=1):
+        """Atualiza contador de starts do usuário"""
+        with self._travar("update_user_starts"), self.connection() as conn:
+            conn.execute(SQL["update_user_starts"], (quantidade, user_id))
+
+    def update_user_starts_lote(self, incrementos):
+        """Aplica vários incrementos de starts [(user_id, quantidade), ...] numa única transação"""
+        with self._travar("update_user_starts_lote"), self.connection() as conn:
+            conn.executemany(SQL["update_user_starts"], [(qtd, uid) for uid, qtd in incrementos])
+
+    def add_numeros_gratis(self, user_id, quantidade):
+        """Adiciona números grátis ao usuário"""
+        with self._travar("add_numeros_gratis"), self.connection() as conn:
+            conn.execute(SQL["add_numeros_gratis"], (quantidade, user_id))
+        self.cache.invalidate(user_id)
+
+    def _recompensar_indicacao(self, conn, user_id, indicador_id):
+        """Dá 2 números grátis ao indicado e ao indicador e conta a indicação como válida"""
+        conn.execute(SQL["add_numeros_gratis"], (2, user_id))
+        # Dar números grátis para o indicador
+        conn.execute(SQL["add_numeros_gratis"], (2, indicador_id))
+        # Atualizar contador de indicações válidas
+        conn.execute(SQL["add_indicacao_valida"], (indicador_id,))
+
+    def recompensar_indicacao(self, user_id, indicador_id):
+        """Aplica a recompensa de indicação (depósito de R$ 20+ do indicado)"""
+        with self._travar("recompensar_indicacao"), self.connection() as conn:
+            self._recompensar_indicacao(conn, user_id, indicador_id)
+        self.cache.invalidate(user_id, indicador_id)
+
+    def get_all_user_ids(self):
+        """Lista o ID de todos os usuários (broadcast)"""
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute(SQL["get_all_user_ids"])]
+
+    def count_users(self):
+        """Conta o total de usuários cadastrados"""
+        with self.connection() as conn:
+            return conn.execute(SQL["count_users"]).fetchone()[0]
+
+    def registrar_numero(self, user_id, servico, pais, numero, preco, desconto_aplicado=0, status="aguardando_sms"):
+        """Registra um número SMS comprado"""
+        with self._travar("registrar_numero"), self.connection() as conn:
+            conn.execute(SQL["registrar_numero"], (user_id, servico, pais, numero, preco, desconto_aplicado, status))
+        self.cache.invalidate(user_id)
+
+    def criar_transacao_pendente(self, user_id, valor, moeda, invoice_id, valor_crypto=None):
+        """Registra um depósito pendente aguardando o pagamento da fatura"""
+        with self._travar("criar_transacao_pendente"), self.connection() as conn:
+            conn.execute(
+                SQL["criar_transacao_pendente"], (user_id, 'deposito', valor, moeda, 'pendente', invoice_id, valor_crypto)
+            )
+
+    def get_transacao_pendente(self, invoice_id):
+        """Busca (user_id, valor, moeda) da transação pendente de uma fatura"""
+        with self.connection() as conn:
+            return conn.execute(SQL["get_transacao_pendente"], (invoice_id,)).fetchone()
+
+    def marcar_valor_incorreto(self, invoice_id, observacoes):
+        """Marca a transação de uma fatura como paga com valor incorreto"""
+        with self._travar("marcar_valor_incorreto"), self.connection() as conn:
+            conn.execute(SQL["marcar_valor_incorreto"], (observacoes, invoice_id))
+
+    def confirmar_deposito_fatura(self, invoice_id, user_id, valor, bonus, numeros_gratis, valor_crypto_pago, moeda_paga):
+        """Confirma o depósito de uma fatura numa única transação.
+
+        Credita saldo, bônus e números grátis, aplica a recompensa de indicação
+        (R$ 20+) e marca a transação como confirmada. Retorna
+        `(processado, indicador_id)`; `processado` é False se a fatura já não
+        estava mais pendente (webhook repetido).
+        """
+        processado, indicador_id = self._confirmar_deposito_fatura(
+            invoice_id, user_id, valor, bonus, numeros_gratis, valor_crypto_pago, moeda_paga
+        )
+        if processado:
+            self.cache.invalidate(user_id, indicador_id)
+        return processado, indicador_id
+
+    def _confirmar_deposito_fatura(self, invoice_id, user_id, valor, bonus, numeros_gratis, valor_crypto_pago, moeda_paga):
+        with self._travar("_confirmar_deposito_fatura"), self.connection() as conn:
+            # Marcar transação como confirmada (apenas se ainda pendente)
+            cursor = conn.execute(
+                SQL["confirmar_transacao"],
+                (datetime.now().isoformat(), valor_crypto_pago, moeda_paga, invoice_id)
+            )
+            if cursor.rowcount == 0:
+                return False, None
+
+            conn.execute(SQL["registrar_movimento"], (user_id, "deposito", valor, bonus, valor, invoice_id))
+            if numeros_gratis:
+                conn.execute(SQL["add_numeros_gratis"], (numeros_gratis, user_id))
+
+            # Verificar se é elegível para recompensa de indicação (R$ 20+)
+            indicador_id = None
+            if valor >= 20.0:
+                indicador_result = conn.execute(SQL["get_indicador"], (user_id,)).fetchone()
+                if indicador_result and indicador_result[0]:
+                    indicador_id = indicador_result[0]
+                    self._recompensar_indicacao(conn, user_id, indicador_id)
+
+            return True, indicador_id
+
+    def get_admin_stats(self):
+        """Estatísticas gerais para o painel administrativo (contadores materializados, O(1))"""
+        with self.connection() as conn:
+            total_usuarios, total_starts, total_vendas, total_faturamento, total_numeros = \
+                conn.execute(SQL["get_estatisticas"]).fetchone()
+            hoje = conn.execute(SQL["get_estatisticas_dia"]).fetchone() or (0, 0, 0.0, 0)
+
+        return {
+            'total_usuarios': total_usuarios,
+            'total_starts': total_starts,
+            'total_vendas': total_vendas,
+            'total_faturamento': total_faturamento,
+            'total_numeros': total_numeros,
+            # Estatísticas do dia
+            'novos_hoje': hoje[0],
+            'vendas_hoje': hoje[1]
+        }
+
+    def get_payments_overview(self):
+        """Quantidade de pagamentos pendentes e os 5 últimos confirmados"""
+        with self.connection() as conn:
+            pendentes = conn.execute(SQL["count_pendentes"]).fetchone()[0]
+            ultimos = conn.execute(SQL["ultimos_confirmados"]).fetchall()
+        return pendentes, ultimos
+
+    def _pagina(self, consulta, filtros, limit, cursor, anteriores):
+        """Busca uma página por chave (keyset) a partir de `cursor`.
+
+        Sem cursor devolve a primeira página; com cursor devolve as linhas logo
+        depois dele (ou logo antes, com `anteriores`). Retorna (linhas, mais):
+        as linhas sempre na ordem de exibição e se existem mais linhas na
+        direção pedida.
+        """
+        if cursor is None:
+            nome, params = consulta, (*filtros, limit + 1)
+        else:
+            nome = f"{consulta}_{'anteriores' if anteriores else 'seguintes'}"
+            params = (*filtros, *cursor, limit + 1)
+        with self.connection() as conn:
+            linhas = conn.execute(SQL[nome], params).fetchall()
+        mais = len(linhas) > limit
+        linhas = linhas[:limit]
+        if anteriores:
+            linhas.reverse()
+        return linhas, mais
+
+    def get_pending_payments(self, limit=10, cursor=None, anteriores=False):
+        """Página de pagamentos pendentes, mais recentes primeiro; cursor = (data_transacao, id)"""
+        return self._pagina("listar_pagamentos", ("pendente",), limit, cursor, anteriores)
+
+    def get_confirmed_payments(self, limit=15, cursor=None, anteriores=False):
+        """Página de pagamentos confirmados, mais recentes primeiro; cursor = (data_transacao, id)"""
+        return self._pagina("listar_pagamentos", ("confirmado",), limit, cursor, anteriores)
+
+    def get_top_users(self, limit=10, cursor=None, anteriores=False):
+        """Página de usuários por saldo consolidado, maior primeiro; cursor = (saldo, user_id).
+
+        Cada linha traz (user_id, first_name, saldo, total_depositado, saldo_atual,
+        total_depositado_atual): os dois últimos incluem os movimentos ainda não compactados.
+        """
+        return self._pagina("listar_usuarios", (), limit, cursor, anteriores)
+
+    def check_query_plans(self):
+        """Roda EXPLAIN QUERY PLAN em todas as consultas de SQL e aponta SCANs.
+
+        Retorna uma lista de `(nome, detalhe)` para cada consulta que percorre
+        uma tabela de TABELAS_GRANDES sem usar índice (exceto SCANS_PERMITIDOS).
+        """
+        problemas = []
+        with self.connection() as conn:
+            for nome, consulta in SQL.items():
+                if nome in SCANS_PERMITIDOS:
+                    continue
+
+                # Mapear aliases (FROM transacoes t) para o nome real da tabela
+                aliases = {}
+                for tabela, alias in re.findall(r'\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(\w+))?', consulta, re.IGNORECASE):
+                    aliases[tabela] = tabela
+                    if alias and alias.upper() not in SQL_KEYWORDS:
+                        aliases[alias] = tabela
+
+                nomeados = re.findall(r':(\w+)', consulta)
+                params = dict.fromkeys(nomeados) if nomeados else [None] * consulta.count("?")
+                plano = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + consulta, params)]
+                # Percorrer um índice já na ordem do ORDER BY com LIMIT lê só as primeiras linhas;
+                # se o SQLite ainda precisa ordenar (TEMP B-TREE), o índice não está servindo o ORDER BY
+                scan_ordenado = (
+                    re.search(r'\bORDER BY\b[^()]*\bLIMIT\b', consulta, re.IGNORECASE | re.DOTALL)
+                    and not any("TEMP B-TREE FOR ORDER BY" in detalhe for detalhe in plano)
+                )
+                for detalhe in plano:
+                    match = re.match(r'SCAN (?:TABLE )?(\w+)(?: AS \w+)?( USING (?:COVERING )?INDEX \w+)?$', detalhe)
+                    if not match or aliases.get(match.group(1), match.group(1)) not in TABELAS_GRANDES:
+                        continue
+                    if match.group(2) and scan_ordenado:
+                        continue
+                    problemas.append((nome, detalhe))
+        return problemas
+
+class DatabaseBusyError(Exception):
+    """Fila do executor de banco de dados está cheia"""
+
+class Storage(ABC):
+    """Interface de armazenamento usada pelos handlers (`await async_db.<método>(...)`).
+
+    Implementações: AsyncDatabase (SQLite local via DatabaseManager) e
+    PostgresStorage (asyncpg, vários processos/hosts). Toda consulta que o bot
+    faz passa por um destes métodos; os handlers nunca falam SQL diretamente.
+    Todos são abstratos: um backend sem algum deles não pode ser instanciado.
+    Além dos métodos, todo backend expõe `cache` (UserCache) para o /status.
+    """
+
+    @abstractmethod
+    async def open(self):
+        """Prepara conexões e aplica migrações pendentes"""
+
+    @abstractmethod
+    async def close(self):
+        """Libera conexões e threads"""
+
+    @abstractmethod
+    async def get_user(self, user_id): ...
+    @abstractmethod
+    async def get_user_snapshot(self, user_id): ...
+    @abstractmethod
+    async def create_user(self, user_id, username, first_name, indicador_id=None): ...
+    @abstractmethod
+    async def get_user_by_referral_code(self, code): ...
+    @abstractmethod
+    async def get_or_create_referral_code(self, user_id): ...
+    @abstractmethod
+    async def get_resumo_indicacoes(self, user_id): ...
+    @abstractmethod
+    async def get_ranking_indicadores(self, limit=10): ...
+    @abstractmethod
+    async def update_saldo(self, user_id, valor, tipo="ajuste"): ...
+    @abstractmethod
+    async def update_saldo_bonus(self, user_id, valor_bonus, tipo="bonus_admin"): ...
+    @abstractmethod
+    async def processar_deposito(self, user_id, valor_depositado, bonus, numeros_gratis=0, tipo="deposito", referencia=None): ...
+    @abstractmethod
+    async def deduzir_saldo(self, user_id, valor, referencia=None): ...
+    @abstractmethod
+    async def get_saldo(self, user_id): ...
+    @abstractmethod
+    async def get_numeros_gratis(self, user_id): ...
+    @abstractmethod
+    async def get_user_details(self, user_id): ...
+    @abstractmethod
+    async def get_user_stats(self, user_id): ...
+    @abstractmethod
+    async def update_user_starts(self, user_id, quantidade=1): ...
+    @abstractmethod
+    async def update_user_starts_lote(self, incrementos): ...
+    @abstractmethod
+    async def add_numeros_gratis(self, user_id, quantidade): ...
+    @abstractmethod
+    async def recompensar_indicacao(self, user_id, indicador_id): ...
+    @abstractmethod
+    async def get_all_user_ids(self): ...
+    @abstractmethod
+    async def count_users(self): ...
+    @abstractmethod
+    async def registrar_numero(self, user_id, servico, pais, numero, preco, desconto_aplicado=0, status="aguardando_sms"): ...
+    @abstractmethod
+    async def criar_transacao_pendente(self, user_id, valor, moeda, invoice_id, valor_crypto=None): ...
+    @abstractmethod
+    async def get_transacao_pendente(self, invoice_id): ...
+    @abstractmethod
+    async def marcar_valor_incorreto(self, invoice_id, observacoes): ...
+    @abstractmethod
+    async def confirmar_deposito_fatura(self, invoice_id, user_id, valor, bonus, numeros_gratis, valor_crypto_pago, moeda_paga): ...
+    @abstractmethod
+    async def get_admin_stats(self): ...
+    @abstractmethod
+    async def get_payments_overview(self): ...
+    @abstractmethod
+    async def get_pending_payments(self, limit=10, cursor=None, anteriores=False): ...
+    @abstractmethod
+    async def get_confirmed_payments(self, limit=15, cursor=None, anteriores=False): ...
+    @abstractmethod
+    async def get_top_users(self, limit=10, cursor=None, anteriores=False): ...
+    @abstractmethod
+    async def get_movimentos(self, user_id, limit=10): ...
+    @abstractmethod
+    async def compactar_saldos(self): ...
+    @abstractmethod
+    async def reconciliar_saldos(self): ...
+    @abstractmethod
+    async def arquivar_antigos(self, retencao_dias=ARQUIVO_RETENCAO_DIAS, lote=ARQUIVO_LOTE): ...
+    @abstractmethod
+    async def backup(self): ...
+    @abstractmethod
+    async def check_query_plans(self): ...
+
+class AsyncDatabase(Storage):
+    """Fachada assíncrona do DatabaseManager.
+
+    Cada chamada roda em threads dedicadas ao SQLite, então o event loop nunca
+    bloqueia esperando lock, disco ou o `timeout` de 30s. A fila é limitada a
+    `max_queue` chamadas em andamento (acima disso levanta DatabaseBusyError)
+    e o tempo que cada chamada esperou por uma thread livre é registrado por
+    método. Uso: `await async_db.get_saldo(user_id)`.
+    """
+
+    def __init__(self, manager, workers=DB_EXECUTOR_WORKERS, max_queue=DB_MAX_QUEUE,
+                 slow_queue_seconds=DB_QUEUE_WARN_SECONDS):
+        self.manager = manager
+        self.max_queue = max_queue
+        self.slow_queue_seconds = slow_queue_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+        self._pending = 0
+        self.queue_stats = defaultdict(lambda: {"calls": 0, "queued_total": 0.0, "queued_max": 0.0})
+        self.rejected = 0
+
+    @property
+    def pending(self):
+        """Chamadas aguardando ou executando no executor"""
+        return self._pending
+
+    async def run(self, func, *args, **kwargs):
+        """Executa `func(*args, **kwargs)` numa thread do banco e devolve o resultado"""
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise DatabaseBusyError(f"Fila do banco cheia ({self._pending} chamadas pendentes)")
+
+        enqueued_at = time.monotonic()
+
+        def call():
+            queued = time.monotonic() - enqueued_at
+            return queued, func(*args, **kwargs)
+
+        self._pending += 1
+        try:
+            queued, result = await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            self._pending -= 1
+
+        name = getattr(func, "__name__", repr(func))
+        stats = self.queue_stats[name]
+        stats["calls"] += 1
+        stats["queued_total"] += queued
+        stats["queued_max"] = max(stats["queued_max"], queued)
+        if queued > self.slow_queue_seconds:
+            logger.warning(f"Chamada ao banco {name} ficou {queued * 1000:.0f}ms na fila ({self._pending} pendentes)")
+        return result
+
+    @property
+    def cache(self):
+        return self.manager.cache
+
+    async def open(self):
+        """O DatabaseManager já aplica as migrações no construtor"""
+
+    async def backup(self, **kwargs):
+        """Backup numa thread própria: a cópia longa não ocupa as threads do executor do banco"""
+        return await asyncio.to_thread(self.manager.backup, **kwargs)
+
+    async def close(self):
+        """Aguarda as chamadas em andamento, encerra as threads e fecha o pool"""
+        self._executor.shutdown(wait=True)
+        self.manager.pool.close_all()
+
+def _delegar_ao_manager(nome):
+    async def metodo(self, *args, **kwargs):
+        return await self.run(getattr(self.manager, nome), *args, **kwargs)
+
+    metodo.__name__ = nome
+    return metodo
+
+# Os métodos de Storage no AsyncDatabase executam o método homônimo do DatabaseManager no executor
+for _nome in sorted(Storage.__abstractmethods__ - set(vars(AsyncDatabase))):
+    if not callable(getattr(DatabaseManager, _nome, None)):
+        raise TypeError(f"DatabaseManager não implementa {_nome} da interface Storage")
+    setattr(AsyncDatabase, _nome, _delegar_ao_manager(_nome))
+update_abstractmethods(AsyncDatabase)
+
+class CounterBuffer:
+    """Buffer write-behind para contadores quentes (ex.: total_starts).
+
+    Incrementos ficam em memória agrupados por chave e são gravados de uma vez
+    por `flush_func([(chave, quantidade), ...])` a cada `flush_interval`
+    segundos ou assim que `max_entries` chaves estiverem pendentes. Se a
+    gravação falhar o lote volta para o buffer e é tentado no próximo ciclo.
+    """
+
+    def __init__(self, flush_func, flush_interval=STARTS_FLUSH_SECONDS, max_entries=STARTS_FLUSH_MAX):
+        self.flush_func = flush_func
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._wake = None
+        self.stats = {
+            "increments": 0,
+            "flushes": 0,
+            "flushed_keys": 0,
+            "errors": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "last_flush_at": None,
+        }
+
+    @property
+    def backlog(self):
+        """Chaves com incrementos ainda não gravados"""
+        return len(self._pending)
+
+    def add(self, key, quantidade=1):
+        """Registra um incremento; não toca no banco"""
         with self._lock:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_compras,
-                    SUM(preco) as total_gasto,
-                    SUM(desconto_aplicado) as total_economizado
-                FROM numeros_sms 
-                WHERE user_id = ?
-            ''', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            return result if result else (0, 0.0, 0.0)
+            self._pending[key] += quantidade
+            tamanho = len(self._pending)
+        self.stats["increments"] += quantidade
+        if tamanho >= self.max_entries and self._wake is not None:
+            self._wake.set()
+
+    async def flush(self):
+        """Grava os incrementos pendentes pelo backend de armazenamento"""
+        with self._lock:
+            lote, self._pending = self._pending, defaultdict(int)
+        if not lote:
+            return 0
 
-# Instância do gerenciador de banco de dados
-db = DatabaseManager()
+        inicio = time.monotonic()
+        try:
+            await self.flush_func(list(lote.items()))
+        except Exception:
+            with self._lock:
+                for key, quantidade in lote.items():
+                    self._pending[key] += quantidade
+            self.stats["errors"] += 1
+            raise
+
+        duracao_ms = (time.monotonic() - inicio) * 1000
+        self.stats["flushes"] += 1
+        self.stats["flushed_keys"] += len(lote)
+        self.stats["last_flush_ms"] = duracao_ms
+        self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], duracao_ms)
+        self.stats["last_flush_at"] = datetime.now().isoformat()
+        return len(lote)
+
+    async def run(self):
+        """Loop em background: grava no intervalo ou quando o buffer enche"""
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Erro ao gravar contadores ({self.backlog} pendentes): {e}")
+
+    def metrics(self):
+        """Métricas para /status"""
+        return {"backlog": self.backlog, **self.stats}
+
+async def _pg_importar_codigos_json(conn):
+    """Importação única do referral_codes.json (banco PostgreSQL criado do zero)"""
+    for user_id, code in _ler_codigos_json():
+        await conn.execute(
+            """
+            UPDATE usuarios SET codigo_indicacao = $1
+            WHERE user_id = $2 AND codigo_indicacao IS NULL
+              AND NOT EXISTS (SELECT 1 FROM usuarios WHERE codigo_indicacao = $1)
+            """,
+            code, user_id
+        )
+
+# Schema do backend PostgreSQL, equivalente ao schema SQLite após a migração 5.
+# Os contadores de estatisticas são mantidos pelos métodos de escrita do
+# PostgresStorage (não há triggers) e datas são devolvidas como texto para os
+# handlers tratarem os dois backends da mesma forma.
+PG_MIGRATIONS = [
+    (1, "Schema inicial (equivalente à versão 5 do SQLite)", [
+        """
+        CREATE TABLE IF NOT EXISTS usuarios (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            saldo DOUBLE PRECISION NOT NULL DEFAULT 0,
+            saldo_bonus DOUBLE PRECISION NOT NULL DEFAULT 0,
+            numeros_gratis INTEGER NOT NULL DEFAULT 0,
+            indicador_id BIGINT,
+            codigo_indicacao TEXT UNIQUE,
+            data_registro TIMESTAMP(0) DEFAULT (NOW() AT TIME ZONE 'utc'),
+            total_depositado DOUBLE PRECISION NOT NULL DEFAULT 0,
+            indicacoes_validas INTEGER NOT NULL DEFAULT 0,
+            ultimo_bonus TIMESTAMP(0),
+            vip_status INTEGER DEFAULT 0,
+            total_starts INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transacoes (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT,
+            tipo TEXT,
+            valor DOUBLE PRECISION,
+            moeda TEXT,
+            status TEXT,
+            invoice_id TEXT,
+            data_transacao TIMESTAMP(0) DEFAULT (NOW() AT TIME ZONE 'utc'),
+            data_confirmacao TIMESTAMP(0),
+            valor_crypto_pago DOUBLE PRECISION,
+            moeda_paga TEXT,
+            observacoes TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS numeros_sms (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT,
+            servico TEXT,
+            pais TEXT,
+            numero TEXT,
+            codigo_recebido TEXT,
+            preco DOUBLE PRECISION,
+            desconto_aplicado DOUBLE PRECISION,
+            status TEXT,
+            data_compra TIMESTAMP(0) DEFAULT (NOW() AT TIME ZONE 'utc')
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS movimentos (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            tipo TEXT NOT NULL,
+            delta_saldo DOUBLE PRECISION NOT NULL DEFAULT 0,
+            delta_bonus DOUBLE PRECISION NOT NULL DEFAULT 0,
+            delta_depositado DOUBLE PRECISION NOT NULL DEFAULT 0,
+            referencia TEXT,
+            criado_em TIMESTAMP(0) DEFAULT (NOW() AT TIME ZONE 'utc')
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ledger_estado (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            ultimo_movimento_id BIGINT NOT NULL,
+            compactado_em TIMESTAMP(0)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS estatisticas (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_usuarios BIGINT NOT NULL DEFAULT 0,
+            total_starts BIGINT NOT NULL DEFAULT 0,
+            total_vendas BIGINT NOT NULL DEFAULT 0,
+            total_faturamento DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_numeros BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS estatisticas_diarias (
+            dia DATE PRIMARY KEY,
+            novos_usuarios INTEGER NOT NULL DEFAULT 0,
+            vendas INTEGER NOT NULL DEFAULT 0,
+            faturamento DOUBLE PRECISION NOT NULL DEFAULT 0,
+            numeros INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT INTO ledger_estado (id, ultimo_movimento_id) VALUES (1, 0) ON CONFLICT DO NOTHING",
+        "INSERT INTO estatisticas (id) VALUES (1) ON CONFLICT DO NOTHING",
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_invoice ON transacoes (invoice_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_transacoes_status_data ON transacoes (status, data_transacao, valor)",
+        "CREATE INDEX IF NOT EXISTS idx_numeros_sms_user ON numeros_sms (user_id, preco, desconto_aplicado)",
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_data_registro ON usuarios (data_registro)",
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_saldo ON usuarios (saldo)",
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimentos_user
+        ON movimentos (user_id, id) INCLUDE (delta_saldo, delta_bonus, delta_depositado)
+        """,
+    ]),
+    (2, "Índices de cobertura para as listas paginadas do admin (versão 6 do SQLite)", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_transacoes_status_pagina
+        ON transacoes (status, data_transacao, id) INCLUDE (user_id, valor, moeda, invoice_id)
+        """,
+        "DROP INDEX IF EXISTS idx_transacoes_status_data",
+        """
+        CREATE INDEX IF NOT EXISTS idx_usuarios_saldo_pagina
+        ON usuarios (saldo, user_id) INCLUDE (first_name, total_depositado)
+        """,
+        "DROP INDEX IF EXISTS idx_usuarios_saldo",
+    ]),
+    (3, "Arquivo frio de transações e números antigos (versão 7 do SQLite)", [
+        """
+        CREATE TABLE IF NOT EXISTS transacoes_arquivo (
+            id BIGINT PRIMARY KEY,
+            user_id BIGINT,
+            tipo TEXT,
+            valor DOUBLE PRECISION,
+            moeda TEXT,
+            status TEXT,
+            invoice_id TEXT,
+            data_transacao TIMESTAMP(0),
+            data_confirmacao TIMESTAMP(0),
+            valor_crypto_pago DOUBLE PRECISION,
+            moeda_paga TEXT,
+            observacoes TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS numeros_sms_arquivo (
+            id BIGINT PRIMARY KEY,
+            user_id BIGINT,
+            servico TEXT,
+            pais TEXT,
+            numero TEXT,
+            codigo_recebido TEXT,
+            preco DOUBLE PRECISION,
+            desconto_aplicado DOUBLE PRECISION,
+            status TEXT,
+            data_compra TIMESTAMP(0)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resumo_compras (
+            user_id BIGINT PRIMARY KEY,
+            total_compras BIGINT NOT NULL DEFAULT 0,
+            total_gasto DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_economizado DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_numeros_sms_data ON numeros_sms (data_compra)",
+    ]),
+    (4, "Códigos de indicação do referral_codes.json (versão 8 do SQLite)", [
+        _pg_importar_codigos_json,
+    ]),
+    (5, "Árvore de indicações e agregados por indicador (versão 9 do SQLite)", [
+        """
+        CREATE TABLE IF NOT EXISTS indicacoes_arvore (
+            ancestral_id BIGINT NOT NULL,
+            descendente_id BIGINT NOT NULL,
+            profundidade INTEGER NOT NULL,
+            PRIMARY KEY (ancestral_id, descendente_id)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_indicacoes_arvore_descendente
+        ON indicacoes_arvore (descendente_id, ancestral_id) INCLUDE (profundidade)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS indicacoes_resumo (
+            user_id BIGINT PRIMARY KEY,
+            diretas INTEGER NOT NULL DEFAULT 0,
+            indiretas INTEGER NOT NULL DEFAULT 0,
+            depositantes INTEGER NOT NULL DEFAULT 0,
+            volume_rede DOUBLE PRECISION NOT NULL DEFAULT 0,
+            volume_proprio DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_indicacoes_resumo_volume ON indicacoes_resumo (volume_rede, user_id)",
+        """
+        INSERT INTO indicacoes_arvore (ancestral_id, descendente_id, profundidade)
+        WITH RECURSIVE arvore (ancestral_id, descendente_id, profundidade) AS (
+            SELECT indicador_id, user_id, 1 FROM usuarios
+            WHERE indicador_id IS NOT NULL AND indicador_id <> user_id
+            UNION
+            SELECT a.ancestral_id, u.user_id, a.profundidade + 1
+            FROM arvore a
+            JOIN usuarios u ON u.indicador_id = a.descendente_id
+            WHERE a.profundidade < 100 AND u.user_id <> a.ancestral_id
+        )
+        SELECT ancestral_id, descendente_id, MIN(profundidade) FROM arvore GROUP BY ancestral_id, descendente_id
+        ON CONFLICT DO NOTHING
+        """,
+        """
+        INSERT INTO indicacoes_resumo (user_id, volume_proprio)
+        SELECT user_id, SUM(delta_depositado) FROM movimentos
+        WHERE delta_depositado > 0
+        GROUP BY user_id
+        """,
+        """
+        INSERT INTO indicacoes_resumo (user_id, diretas, indiretas, depositantes, volume_rede)
+        SELECT a.ancestral_id,
+               COUNT(*) FILTER (WHERE a.profundidade = 1),
+               COUNT(*) FILTER (WHERE a.profundidade > 1),
+               COUNT(*) FILTER (WHERE r.volume_proprio > 0),
+               COALESCE(SUM(r.volume_proprio), 0)
+        FROM indicacoes_arvore a
+        LEFT JOIN indicacoes_resumo r ON r.user_id = a.descendente_id
+        GROUP BY a.ancestral_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET diretas = EXCLUDED.diretas,
+            indiretas = EXCLUDED.indiretas,
+            depositantes = EXCLUDED.depositantes,
+            volume_rede = EXCLUDED.volume_rede
+        """,
+    ]),
+    (6, "Valor em cripto cobrado na fatura (versão 10 do SQLite)", [
+        "ALTER TABLE transacoes ADD COLUMN IF NOT EXISTS valor_crypto DOUBLE PRECISION",
+        "ALTER TABLE transacoes_arquivo ADD COLUMN IF NOT EXISTS valor_crypto DOUBLE PRECISION",
+    ]),
+]
+
+# Saldo atual no PostgreSQL: consolidado + cauda do livro (mesma regra de _SALDO_ATUAL)
+_PG_CAUDA_MOVIMENTOS = """
+    SELECT SUM(delta_saldo) AS delta_saldo,
+           SUM(delta_bonus) AS delta_bonus,
+           SUM(delta_depositado) AS delta_depositado
+    FROM movimentos
+    WHERE user_id = u.user_id
+      AND id > (SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1)
+"""
+
+# Mesmas consultas de SQL no dialeto do PostgreSQL ($n em vez de ?)
+PG_SQL = {
+    # Usuários
+    "get_user": "SELECT * FROM usuarios WHERE user_id = $1",
+    "create_user": """
+        INSERT INTO usuarios (user_id, username, first_name, indicador_id)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING data_registro::date
+    """,
+    "get_indicador": "SELECT indicador_id FROM usuarios WHERE user_id = $1",
+    "get_user_by_referral_code": "SELECT user_id FROM usuarios WHERE codigo_indicacao = $1",
+    "get_referral_code": "SELECT codigo_indicacao FROM usuarios WHERE user_id = $1",
+    "set_referral_code": "UPDATE usuarios SET codigo_indicacao = $1 WHERE user_id = $2 AND codigo_indicacao IS NULL",
+    "existe_usuario": "SELECT 1 FROM usuarios WHERE user_id = $1",
+
+    # Rede de indicações. Sem triggers aqui: create_user e os depósitos atualizam a árvore/agregados
+    # travando só a cadeia afetada ($1 e seus ancestrais), sempre em ordem de id para
+    # que cadeias com ancestrais em comum não se travem em ordens diferentes
+    "travar_indicacoes": """
+        SELECT pg_advisory_xact_lock(id) FROM (
+            SELECT $1::bigint AS id
+            UNION
+            SELECT ancestral_id FROM indicacoes_arvore WHERE descendente_id = $1
+            ORDER BY id
+        ) AS cadeia
+    """,
+    "registrar_na_arvore": """
+        INSERT INTO indicacoes_arvore (ancestral_id, descendente_id, profundidade)
+        SELECT $2::bigint, $1::bigint, 1
+        UNION ALL
+        SELECT ancestral_id, $1, profundidade + 1 FROM indicacoes_arvore WHERE descendente_id = $2
+        ON CONFLICT DO NOTHING
+    """,
+    "contar_indicacao_direta": """
+        INSERT INTO indicacoes_resumo (user_id, diretas) VALUES ($1, 1)
+        ON CONFLICT (user_id) DO UPDATE SET diretas = indicacoes_resumo.diretas + 1
+    """,
+    "contar_indicacoes_indiretas": """
+        INSERT INTO indicacoes_resumo (user_id, indiretas)
+        SELECT ancestral_id, 1 FROM indicacoes_arvore WHERE descendente_id = $1 AND profundidade > 1
+        ON CONFLICT (user_id) DO UPDATE SET indiretas = indicacoes_resumo.indiretas + 1
+    """,
+    # Devolve o volume próprio de antes do depósito (0 = primeiro depósito)
+    "contar_deposito_proprio": """
+        INSERT INTO indicacoes_resumo (user_id, volume_proprio) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET volume_proprio = indicacoes_resumo.volume_proprio + EXCLUDED.volume_proprio
+        RETURNING volume_proprio - $2
+    """,
+    "contar_deposito_rede": """
+        INSERT INTO indicacoes_resumo (user_id, depositantes, volume_rede)
+        SELECT ancestral_id, $2, $3 FROM indicacoes_arvore WHERE descendente_id = $1
+        ON CONFLICT (user_id) DO UPDATE
+        SET depositantes = indicacoes_resumo.depositantes + EXCLUDED.depositantes,
+            volume_rede = indicacoes_resumo.volume_rede + EXCLUDED.volume_rede
+    """,
+    "get_resumo_indicacoes": """
+        SELECT diretas, indiretas, depositantes, volume_rede
+        FROM indicacoes_resumo WHERE user_id = $1
+    """,
+    "ranking_indicadores": """
+        SELECT r.user_id, u.first_name, r.diretas, r.indiretas, r.depositantes, r.volume_rede
+        FROM indicacoes_resumo r
+        JOIN usuarios u ON u.user_id = r.user_id
+        WHERE r.diretas > 0
+        ORDER BY r.volume_rede DESC
+        LIMIT $1
+    """,
+    "get_user_snapshot": f"""
+        SELECT u.user_id, u.username, u.first_name,
+               u.saldo + COALESCE(t.delta_saldo, 0),
+               u.saldo_bonus + COALESCE(t.delta_bonus, 0),
+               u.numeros_gratis, u.indicador_id, u.codigo_indicacao, u.data_registro::text,
+               u.total_depositado + COALESCE(t.delta_depositado, 0),
+               u.indicacoes_validas, u.total_starts,
+               c.total_compras + COALESCE(r.total_compras, 0),
+               COALESCE(c.total_gasto, 0) + COALESCE(r.total_gasto, 0),
+               COALESCE(c.total_economizado, 0) + COALESCE(r.total_economizado, 0)
+        FROM usuarios u
+        LEFT JOIN resumo_compras r ON r.user_id = u.user_id
+        LEFT JOIN LATERAL ({_PG_CAUDA_MOVIMENTOS}) t ON true
+        LEFT JOIN LATERAL (
+            SELECT COUNT(*) AS total_compras,
+                   SUM(preco) AS total_gasto,
+                   SUM(desconto_aplicado) AS total_economizado
+            FROM numeros_sms
+            WHERE user_id = u.user_id
+        ) c ON true
+        WHERE u.user_id = $1
+    """,
+    "get_all_user_ids": "SELECT user_id FROM usuarios",
+    "count_users": "SELECT total_usuarios FROM estatisticas WHERE id = 1",
+    "update_user_starts_lote": """
+        UPDATE usuarios u
+        SET total_starts = u.total_starts + v.quantidade
+        FROM unnest($1::bigint[], $2::int[]) AS v(user_id, quantidade)
+        WHERE u.user_id = v.user_id
+        RETURNING v.quantidade
+    """,
+
+    # Saldos (livro de movimentos)
+    "travar_ledger": "SELECT 1 FROM ledger_estado WHERE id = 1 FOR SHARE",
+    "travar_usuario": "SELECT 1 FROM usuarios WHERE user_id = $1 FOR UPDATE",
+    "registrar_movimento": """
+        INSERT INTO movimentos (user_id, tipo, delta_saldo, delta_bonus, delta_depositado, referencia)
+        VALUES ($1, $2, $3, $4, $5, $6)
+    """,
+    "get_saldo_atual": f"""
+        SELECT u.saldo + COALESCE(t.delta_saldo, 0), u.saldo_bonus + COALESCE(t.delta_bonus, 0)
+        FROM usuarios u
+        LEFT JOIN LATERAL ({_PG_CAUDA_MOVIMENTOS}) t ON true
+        WHERE u.user_id = $1
+    """,
+    "get_movimentos": """
+        SELECT tipo, delta_saldo, delta_bonus, referencia, criado_em::text
+        FROM movimentos
+        WHERE user_id = $1
+        ORDER BY id DESC
+        LIMIT $2
+    """,
+    "get_ledger_estado": "SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1 FOR UPDATE",
+    "get_ultimo_movimento": "SELECT MAX(id) FROM movimentos",
+    "compactar_movimentos": """
+        UPDATE usuarios u
+        SET saldo = u.saldo + t.delta_saldo,
+            saldo_bonus = u.saldo_bonus + t.delta_bonus,
+            total_depositado = u.total_depositado + t.delta_depositado
+        FROM (
+            SELECT user_id,
+                   SUM(delta_saldo) AS delta_saldo,
+                   SUM(delta_bonus) AS delta_bonus,
+                   SUM(delta_depositado) AS delta_depositado
+            FROM movimentos
+            WHERE id > $1 AND id <= $2
+            GROUP BY user_id
+        ) AS t
+        WHERE u.user_id = t.user_id
+    """,
+    "atualizar_ledger_estado": """
+        UPDATE ledger_estado SET ultimo_movimento_id = $1, compactado_em = NOW() AT TIME ZONE 'utc' WHERE id = 1
+    """,
+    "reconciliar_saldos": """
+        SELECT u.user_id,
+               u.saldo, COALESCE(m.saldo, 0),
+               u.saldo_bonus, COALESCE(m.saldo_bonus, 0),
+               u.total_depositado, COALESCE(m.total_depositado, 0)
+        FROM usuarios u
+        LEFT JOIN (
+            SELECT user_id,
+                   SUM(delta_saldo) AS saldo,
+                   SUM(delta_bonus) AS saldo_bonus,
+                   SUM(delta_depositado) AS total_depositado
+            FROM movimentos
+            WHERE id <= (SELECT ultimo_movimento_id FROM ledger_estado WHERE id = 1)
+            GROUP BY user_id
+        ) m ON m.user_id = u.user_id
+        WHERE ABS(u.saldo - COALESCE(m.saldo, 0)) > 0.001
+           OR ABS(u.saldo_bonus - COALESCE(m.saldo_bonus, 0)) > 0.001
+           OR ABS(u.total_depositado - COALESCE(m.total_depositado, 0)) > 0.001
+    """,
+    "add_numeros_gratis": "UPDATE usuarios SET numeros_gratis = numeros_gratis + $1 WHERE user_id = $2",
+    "add_indicacao_valida": "UPDATE usuarios SET indicacoes_validas = indicacoes_validas + 1 WHERE user_id = $1",
+
+    # Números SMS
+    "registrar_numero": """
+        INSERT INTO numeros_sms (user_id, servico, pais, numero, preco, desconto_aplicado, status)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+        RETURNING data_compra::date
+    """,
+
+    # Transações
+    "criar_transacao_pendente": """
+        INSERT INTO transacoes (user_id, tipo, valor, moeda, status, invoice_id, valor_crypto)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+    """,
+    "get_transacao_pendente": """
+        SELECT user_id, valor, moeda, valor_crypto FROM transacoes
+        WHERE invoice_id = $1 AND status = 'pendente'
+    """,
+    # Venda já confirmada não volta atrás (os contadores não têm trigger de estorno aqui)
+    "marcar_valor_incorreto": """
+        UPDATE transacoes
+        SET status = 'valor_incorreto',
+            observacoes = $1
+        WHERE invoice_id = $2 AND status = 'pendente'
+    """,
+    "confirmar_transacao": """
+        UPDATE transacoes
+        SET status = 'confirmado',
+            data_confirmacao = $1,
+            valor_crypto_pago = $2,
+            moeda_paga = $3
+        WHERE invoice_id = $4 AND status = 'pendente'
+        RETURNING COALESCE(valor, 0), data_transacao::date
+    """,
+
+    # Contadores materializados
+    "contar_usuario_novo": "UPDATE estatisticas SET total_usuarios = total_usuarios + 1 WHERE id = 1",
+    "contar_starts": "UPDATE estatisticas SET total_starts = total_starts + $1 WHERE id = 1",
+    "contar_venda": """
+        UPDATE estatisticas
+        SET total_vendas = total_vendas + 1, total_faturamento = total_faturamento + $1
+        WHERE id = 1
+    """,
+    "contar_numero": "UPDATE estatisticas SET total_numeros = total_numeros + 1 WHERE id = 1",
+    "contar_dia": """
+        INSERT INTO estatisticas_diarias (dia, novos_usuarios, vendas, faturamento, numeros)
+        VALUES (COALESCE($1, (NOW() AT TIME ZONE 'utc')::date), $2, $3, $4, $5)
+        ON CONFLICT (dia) DO UPDATE
+        SET novos_usuarios = estatisticas_diarias.novos_usuarios + EXCLUDED.novos_usuarios,
+            vendas = estatisticas_diarias.vendas + EXCLUDED.vendas,
+            faturamento = estatisticas_diarias.faturamento + EXCLUDED.faturamento,
+            numeros = estatisticas_diarias.numeros + EXCLUDED.numeros
+    """,
+
+    # Painel administrativo
+    "get_estatisticas": """
+        SELECT total_usuarios, total_starts, total_vendas, total_faturamento, total_numeros
+        FROM estatisticas WHERE id = 1
+    """,
+    "get_estatisticas_dia": """
+        SELECT novos_usuarios, vendas, faturamento, numeros
+        FROM estatisticas_diarias WHERE dia = (NOW() AT TIME ZONE 'utc')::date
+    """,
+    "count_pendentes": "SELECT COUNT(*) FROM transacoes WHERE status = 'pendente'",
+    "ultimos_confirmados": """
+        SELECT u.first_name, t.valor, t.data_transacao::text
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = 'confirmado'
+        ORDER BY t.data_transacao DESC
+        LIMIT 5
+    """,
+    # Arquivamento em um único comando por lote (DELETE ... RETURNING alimenta o arquivo)
+    "arquivar_transacoes": """
+        WITH movidas AS (
+            DELETE FROM transacoes
+            WHERE id IN (
+                SELECT id FROM transacoes
+                WHERE status IN ('confirmado', 'valor_incorreto')
+                  AND data_transacao < (NOW() AT TIME ZONE 'utc') - make_interval(days => $1)
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, tipo, valor, moeda, status, invoice_id, data_transacao,
+                      data_confirmacao, valor_crypto_pago, moeda_paga, observacoes, valor_crypto
+        ), arquivadas AS (
+            INSERT INTO transacoes_arquivo
+                (id, user_id, tipo, valor, moeda, status, invoice_id, data_transacao,
+                 data_confirmacao, valor_crypto_pago, moeda_paga, observacoes, valor_crypto)
+            SELECT * FROM movidas
+            ON CONFLICT (id) DO NOTHING
+        )
+        SELECT COUNT(*) FROM movidas
+    """,
+    "expirar_numeros": """
+        UPDATE numeros_sms SET status = 'expirado'
+        WHERE status = 'aguardando_sms' AND data_compra < (NOW() AT TIME ZONE 'utc') - make_interval(mins => $1)
+    """,
+    "arquivar_numeros": """
+        WITH movidos AS (
+            DELETE FROM numeros_sms
+            WHERE id IN (
+                SELECT id FROM numeros_sms
+                WHERE status <> 'aguardando_sms'
+                  AND data_compra < (NOW() AT TIME ZONE 'utc') - make_interval(days => $1)
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, servico, pais, numero, codigo_recebido, preco, desconto_aplicado, status, data_compra
+        ), arquivados AS (
+            INSERT INTO numeros_sms_arquivo
+                (id, user_id, servico, pais, numero, codigo_recebido, preco, desconto_aplicado, status, data_compra)
+            SELECT * FROM movidos
+            ON CONFLICT (id) DO NOTHING
+        ), resumidos AS (
+            INSERT INTO resumo_compras (user_id, total_compras, total_gasto, total_economizado)
+            SELECT user_id, COUNT(*), COALESCE(SUM(preco), 0), COALESCE(SUM(desconto_aplicado), 0)
+            FROM movidos
+            GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET total_compras = resumo_compras.total_compras + EXCLUDED.total_compras,
+                total_gasto = resumo_compras.total_gasto + EXCLUDED.total_gasto,
+                total_economizado = resumo_compras.total_economizado + EXCLUDED.total_economizado
+        )
+        SELECT COUNT(*) FROM movidos
+    """,
+
+    # Listas paginadas por chave (keyset): a página 1000 custa o mesmo que a 1
+    "listar_pagamentos": """
+        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao::text, t.invoice_id, t.id
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = $1
+        ORDER BY t.data_transacao DESC, t.id DESC
+        LIMIT $2
+    """,
+    "listar_pagamentos_seguintes": """
+        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao::text, t.invoice_id, t.id
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = $1 AND (t.data_transacao, t.id) < ($2::timestamp, $3)
+        ORDER BY t.data_transacao DESC, t.id DESC
+        LIMIT $4
+    """,
+    "listar_pagamentos_anteriores": """
+        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao::text, t.invoice_id, t.id
+        FROM transacoes t
+        JOIN usuarios u ON t.user_id = u.user_id
+        WHERE t.status = $1 AND (t.data_transacao, t.id) > ($2::timestamp, $3)
+        ORDER BY t.data_transacao ASC, t.id ASC
+        LIMIT $4
+    """,
+    # Ordena pelo saldo consolidado (atualizado a cada compactação do livro), que é
+    # também o cursor; as duas últimas colunas trazem o saldo atual só das linhas da página
+    "listar_usuarios": f"""
+        SELECT u.user_id, u.first_name, u.saldo, u.total_depositado,
+               u.saldo + COALESCE(t.delta_saldo, 0),
+               u.total_depositado + COALESCE(t.delta_depositado, 0)
+        FROM usuarios u
+        LEFT JOIN LATERAL ({_PG_CAUDA_MOVIMENTOS}) t ON true
+        ORDER BY u.saldo DESC, u.user_id DESC
+        LIMIT $1
+    """,
+    "listar_usuarios_seguintes": f"""
+        SELECT u.user_id, u.first_name, u.saldo, u.total_depositado,
+               u.saldo + COALESCE(t.delta_saldo, 0),
+               u.total_depositado + COALESCE(t.delta_depositado, 0)
+        FROM usuarios u
+        LEFT JOIN LATERAL ({_PG_CAUDA_MOVIMENTOS}) t ON true
+        WHERE (u.saldo, u.user_id) < ($1, $2)
+        ORDER BY u.saldo DESC, u.user_id DESC
+        LIMIT $3
+    """,
+    "listar_usuarios_anteriores": f"""
+        SELECT u.user_id, u.first_name, u.saldo, u.total_depositado,
+               u.saldo + COALESCE(t.delta_saldo, 0),
+               u.total_depositado + COALESCE(t.delta_depositado, 0)
+        FROM usuarios u
+        LEFT JOIN LATERAL ({_PG_CAUDA_MOVIMENTOS}) t ON true
+        WHERE (u.saldo, u.user_id) > ($1, $2)
+        ORDER BY u.saldo ASC, u.user_id ASC
+        LIMIT $3
+    """,
+}
+
+class PostgresStorage(Storage):
+    """Backend PostgreSQL (asyncpg) da interface Storage.
+
+    Permite vários processos/hosts escrevendo ao mesmo tempo. Regras de
+    concorrência: toda transação que lança movimentos pega `FOR SHARE` em
+    ledger_estado antes de qualquer outra trava, e a compactação pega
+    `FOR UPDATE` na mesma linha; assim o ponto de corte nunca passa por cima
+    de um movimento ainda não commitado. Débitos travam a linha do usuário
+    para que a checagem de saldo e o lançamento sejam atômicos.
+    """
+
+    def __init__(self, dsn, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        # Outros processos escrevem no mesmo banco sem invalidar este cache: TTL curto
+        self.cache = UserCache(ttl=PG_USER_CACHE_TTL)
+
+    async def open(self):
+        if asyncpg is None:
+            raise RuntimeError("DATABASE_URL configurada, mas o pacote asyncpg não está instalado")
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(
+                self.dsn, min_size=self.min_size, max_size=self.max_size, init=self._instrumentar
+            )
+            await self.migrate()
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def _instrumentar(self, conn):
+        """Toda conexão nova do pool reporta suas consultas para db_metrics"""
+        conn.add_query_logger(self._registrar_consulta)
+
+    def _registrar_consulta(self, registro):
+        nome = nome_da_consulta(registro.query)
+        if registro.exception is not None:
+            db_metrics.registrar_erro(nome)
+        else:
+            db_metrics.registrar(nome, registro.elapsed)
+
+    async def migrate(self):
+        """Aplica PG_MIGRATIONS pendentes; o advisory lock evita duas instâncias migrando juntas"""
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(584852)")
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    descricao TEXT,
+                    aplicada_em TIMESTAMP(0) DEFAULT (NOW() AT TIME ZONE 'utc')
+                )
+            """)
+            atual = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            for version, descricao, passos in PG_MIGRATIONS:
+                if version <= atual:
+                    continue
+                for passo in passos:
+                    if callable(passo):
+                        await passo(conn)
+                    else:
+                        await conn.execute(passo)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, descricao) VALUES ($1, $2)", version, descricao
+                )
+                logger.info(f"🗄️ Migração PostgreSQL {version} aplicada: {descricao}")
+                atual = version
+            return atual
+
+    async def _cached(self, key, load):
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        generation = self.cache.generation(key)
+        value = await load()
+        self.cache.put(key, value, generation)
+        return value
+
+    async def _load_snapshot(self, user_id):
+        row = await self.pool.fetchrow(PG_SQL["get_user_snapshot"], user_id)
+        return UserSnapshot.from_row(row) if row else None
+
+    async def get_user_snapshot(self, user_id):
+        return await self._cached(("snapshot", user_id), lambda: self._load_snapshot(user_id))
+
+    async def get_user(self, user_id):
+        return await self.pool.fetchrow(PG_SQL["get_user"], user_id)
+
+    async def get_user_by_referral_code(self, code):
+        return await self.pool.fetchval(PG_SQL["get_user_by_referral_code"], code)
+
+    async def get_resumo_indicacoes(self, user_id):
+        return await self.pool.fetchrow(PG_SQL["get_resumo_indicacoes"], user_id) or (0, 0, 0, 0.0)
+
+    async def get_ranking_indicadores(self, limit=10):
+        return await self.pool.fetch(PG_SQL["ranking_indicadores"], limit)
+
+    async def get_or_create_referral_code(self, user_id):
+        while True:
+            code = await self.pool.fetchval(PG_SQL["get_referral_code"], user_id)
+            if code is not None:
+                return code
+            try:
+                status = await self.pool.execute(PG_SQL["set_referral_code"], generate_referral_code(), user_id)
+            except asyncpg.UniqueViolationError:
+                continue
+            if status == "UPDATE 0" and await self.pool.fetchval(PG_SQL["existe_usuario"], user_id) is None:
+                return None
+            self.cache.invalidate(user_id)
+
+    async def create_user(self, user_id, username, first_name, indicador_id=None):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(PG_SQL["travar_ledger"])
+            dia = await conn.fetchval(PG_SQL["create_user"], user_id, username, first_name, indicador_id)
+            if dia is not None:
+                await conn.execute(PG_SQL["registrar_movimento"], user_id, "boas_vindas", 0.0, 0.5, 0.0, None)
+                await conn.execute(PG_SQL["contar_usuario_novo"])
+                await conn.execute(PG_SQL["contar_dia"], dia, 1, 0, 0.0, 0)
+                if indicador_id and indicador_id != user_id:
+                    await conn.execute(PG_SQL["travar_indicacoes"], indicador_id)
+                    await conn.execute(PG_SQL["registrar_na_arvore"], user_id, indicador_id)
+                    await conn.execute(PG_SQL["contar_indicacao_direta"], indicador_id)
+                    await conn.execute(PG_SQL["contar_indicacoes_indiretas"], user_id)
+        self.cache.invalidate(user_id)
+
+    async def _contar_deposito_na_rede(self, conn, user_id, valor):
+        """Soma o depósito ao volume do usuário e de todos os seus ancestrais na árvore"""
+        await conn.execute(PG_SQL["travar_indicacoes"], user_id)
+        anterior = await conn.fetchval(PG_SQL["contar_deposito_proprio"], user_id, valor)
+        await conn.execute(PG_SQL["contar_deposito_rede"], user_id, 1 if anterior <= 0 else 0, valor)
+
+    async def _registrar_movimento(self, user_id, tipo, delta_saldo=0.0, delta_bonus=0.0, delta_depositado=0.0,
+                                   referencia=None, numeros_gratis=0):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(PG_SQL["travar_ledger"])
+            await conn.execute(
+                PG_SQL["registrar_movimento"], user_id, tipo, delta_saldo, delta_bonus, delta_depositado, referencia
+            )
+            if delta_depositado > 0:
+                await self._contar_deposito_na_rede(conn, user_id, delta_depositado)
+            if numeros_gratis:
+                await conn.execute(PG_SQL["add_numeros_gratis"], numeros_gratis, user_id)
+        self.cache.invalidate(user_id)
+
+    async def update_saldo(self, user_id, valor, tipo="ajuste"):
+        await self._registrar_movimento(user_id, tipo, delta_saldo=valor)
+
+    async def update_saldo_bonus(self, user_id, valor_bonus, tipo="bonus_admin"):
+        await self._registrar_movimento(user_id, tipo, delta_bonus=valor_bonus)
+
+    async def processar_deposito(self, user_id, valor_depositado, bonus, numeros_gratis=0, tipo="deposito", referencia=None):
+        await self._registrar_movimento(
+            user_id, tipo, valor_depositado, bonus, valor_depositado, referencia, numeros_gratis
+        )
+
+    async def deduzir_saldo(self, user_id, valor, referencia=None):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(PG_SQL["travar_ledger"])
+            if await conn.fetchval(PG_SQL["travar_usuario"], user_id) is None:
+                return None
+            saldo, saldo_bonus = await conn.fetchrow(PG_SQL["get_saldo_atual"], user_id)
+            if saldo + saldo_bonus < valor:
+                return None
+            do_bonus = min(max(saldo_bonus, 0.0), valor)
+            do_saldo = max(valor - max(saldo_bonus, 0.0), 0.0)
+            await conn.execute(
+                PG_SQL["registrar_movimento"], user_id, "compra", -do_saldo, -do_bonus, 0.0, referencia
+            )
+        self.cache.invalidate(user_id)
+        return saldo - do_saldo, saldo_bonus - do_bonus
+
+    async def get_saldo(self, user_id):
+        user = await self.get_user_snapshot(user_id)
+        return user.saldo_total if user else 0.0
+
+    async def get_numeros_gratis(self, user_id):
+        user = await self.get_user_snapshot(user_id)
+        return user.numeros_gratis if user else 0
+
+    async def get_user_details(self, user_id):
+        user = await self.get_user_snapshot(user_id)
+        if user:
+            return {
+                'saldo_base': user.saldo_base,
+                'bonus': user.bonus,
+                'saldo_total': user.saldo_total,
+                'numeros_gratis': user.numeros_gratis,
+                'total_depositado': user.total_depositado
+            }
+        return {'saldo_base': 0, 'bonus': 0, 'saldo_total': 0, 'numeros_gratis': 0, 'total_depositado': 0}
+
+    async def get_user_stats(self, user_id):
+        user = await self.get_user_snapshot(user_id)
+        if user:
+            return user.total_compras, user.total_gasto, user.total_economizado
+        return 0, 0.0, 0.0
+
+    async def update_user_starts(self, user_id, quantidade=1):
+        await self.update_user_starts_lote([(user_id, quantidade)])
+
+    async def update_user_starts_lote(self, incrementos):
+        user_ids = [uid for uid, _ in incrementos]
+        quantidades = [qtd for _, qtd in incrementos]
+        async with self.pool.acquire() as conn, conn.transaction():
+            aplicados = await conn.fetch(PG_SQL["update_user_starts_lote"], user_ids, quantidades)
+            total = sum(row[0] for row in aplicados)
+            if total:
+                await conn.execute(PG_SQL["contar_starts"], total)
+
+    async def add_numeros_gratis(self, user_id, quantidade):
+        await self.pool.execute(PG_SQL["add_numeros_gratis"], quantidade, user_id)
+        self.cache.invalidate(user_id)
+
+    async def _recompensar_indicacao(self, conn, user_id, indicador_id):
+        await conn.execute(PG_SQL["add_numeros_gratis"], 2, user_id)
+        await conn.execute(PG_SQL["add_numeros_gratis"], 2, indicador_id)
+        await conn.execute(PG_SQL["add_indicacao_valida"], indicador_id)
+
+    async def recompensar_indicacao(self, user_id, indicador_id):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await self._recompensar_indicacao(conn, user_id, indicador_id)
+        self.cache.invalidate(user_id, indicador_id)
+
+    async def get_all_user_ids(self):
+        return [row[0] for row in await self.pool.fetch(PG_SQL["get_all_user_ids"])]
+
+    async def count_users(self):
+        return await self.pool.fetchval(PG_SQL["count_users"])
+
+    async def registrar_numero(self, user_id, servico, pais, numero, preco, desconto_aplicado=0, status="aguardando_sms"):
+        async with self.pool.acquire() as conn, conn.transaction():
+            dia = await conn.fetchval(
+                PG_SQL["registrar_numero"], user_id, servico, pais, numero, preco, desconto_aplicado, status
+            )
+            await conn.execute(PG_SQL["contar_numero"])
+            await conn.execute(PG_SQL["contar_dia"], dia, 0, 0, 0.0, 1)
+        self.cache.invalidate(user_id)
+
+    async def criar_transacao_pendente(self, user_id, valor, moeda, invoice_id, valor_crypto=None):
+        await self.pool.execute(
+            PG_SQL["criar_transacao_pendente"], user_id, 'deposito', valor, moeda, 'pendente', invoice_id, valor_crypto
+        )
+
+    async def get_transacao_pendente(self, invoice_id):
+        return await self.pool.fetchrow(PG_SQL["get_transacao_pendente"], invoice_id)
+
+    async def marcar_valor_incorreto(self, invoice_id, observacoes):
+        await self.pool.execute(PG_SQL["marcar_valor_incorreto"], observacoes, invoice_id)
+
+    async def confirmar_deposito_fatura(self, invoice_id, user_id, valor, bonus, numeros_gratis, valor_crypto_pago, moeda_paga):
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(PG_SQL["travar_ledger"])
+            confirmada = await conn.fetchrow(
+                PG_SQL["confirmar_transacao"], datetime.now(), valor_crypto_pago, moeda_paga, invoice_id
+            )
+            if confirmada is None:
+                return False, None
+            valor_transacao, dia = confirmada
+            await conn.execute(PG_SQL["contar_venda"], valor_transacao)
+            await conn.execute(PG_SQL["contar_dia"], dia, 0, 1, valor_transacao, 0)
+
+            await conn.execute(PG_SQL["registrar_movimento"], user_id, "deposito", valor, bonus, valor, invoice_id)
+            if valor > 0:
+                await self._contar_deposito_na_rede(conn, user_id, valor)
+            if numeros_gratis:
+                await conn.execute(PG_SQL["add_numeros_gratis"], numeros_gratis, user_id)
+
+            # Verificar se é elegível para recompensa de indicação (R$ 20+)
+            indicador_id = None
+            if valor >= 20.0:
+                indicador_id = await conn.fetchval(PG_SQL["get_indicador"], user_id)
+                if indicador_id:
+                    await self._recompensar_indicacao(conn, user_id, indicador_id)
+        self.cache.invalidate(user_id, indicador_id)
+        return True, indicador_id
+
+    async def get_admin_stats(self):
+        async with self.pool.acquire() as conn:
+            total_usuarios, total_starts, total_vendas, total_faturamento, total_numeros = \
+                await conn.fetchrow(PG_SQL["get_estatisticas"])
+            hoje = await conn.fetchrow(PG_SQL["get_estatisticas_dia"]) or (0, 0, 0.0, 0)
+        return {
+            'total_usuarios': total_usuarios,
+            'total_starts': total_starts,
+            'total_vendas': total_vendas,
+            'total_faturamento': total_faturamento,
+            'total_numeros': total_numeros,
+            'novos_hoje': hoje[0],
+            'vendas_hoje': hoje[1]
+        }
+
+    async def get_payments_overview(self):
+        async with self.pool.acquire() as conn:
+            pendentes = await conn.fetchval(PG_SQL["count_pendentes"])
+            ultimos = await conn.fetch(PG_SQL["ultimos_confirmados"])
+        return pendentes, ultimos
+
+    async def _pagina(self, consulta, filtros, limit, cursor, anteriores):
+        if cursor is None:
+            nome, params = consulta, (*filtros, limit + 1)
+        else:
+            nome = f"{consulta}_{'anteriores' if anteriores else 'seguintes'}"
+            params = (*filtros, *cursor, limit + 1)
+        linhas = await self.pool.fetch(PG_SQL[nome], *params)
+        mais = len(linhas) > limit
+        linhas = linhas[:limit]
+        if anteriores:
+            linhas.reverse()
+        return linhas, mais
+
+    async def get_pending_payments(self, limit=10, cursor=None, anteriores=False):
+        if cursor is not None:
+            cursor = (datetime.fromisoformat(cursor[0]), cursor[1])
+        return await self._pagina("listar_pagamentos", ("pendente",), limit, cursor, anteriores)
+
+    async def get_confirmed_payments(self, limit=15, cursor=None, anteriores=False):
+        if cursor is not None:
+            cursor = (datetime.fromisoformat(cursor[0]), cursor[1])
+        return await self._pagina("listar_pagamentos", ("confirmado",), limit, cursor, anteriores)
+
+    async def get_top_users(self, limit=10, cursor=None, anteriores=False):
+        return await self._pagina("listar_usuarios", (), limit, cursor, anteriores)
+
+    async def get_movimentos(self, user_id, limit=10):
+        return await self.pool.fetch(PG_SQL["get_movimentos"], user_id, limit)
+
+    async def compactar_saldos(self):
+        async with self.pool.acquire() as conn, conn.transaction():
+            # FOR UPDATE espera os lançamentos em andamento (FOR SHARE) terminarem
+            de = await conn.fetchval(PG_SQL["get_ledger_estado"])
+            ate = await conn.fetchval(PG_SQL["get_ultimo_movimento"]) or 0
+            if ate <= de:
+                return 0
+            await conn.execute(PG_SQL["compactar_movimentos"], de, ate)
+            await conn.execute(PG_SQL["atualizar_ledger_estado"], ate)
+        return ate - de
+
+    async def reconciliar_saldos(self):
+        return await self.pool.fetch(PG_SQL["reconciliar_saldos"])
+
+    async def arquivar_antigos(self, retencao_dias=ARQUIVO_RETENCAO_DIAS, lote=ARQUIVO_LOTE):
+        await self.pool.execute(PG_SQL["expirar_numeros"], NUMERO_EXPIRACAO_MINUTOS)
+        movidos = []
+        for consulta in ("arquivar_transacoes", "arquivar_numeros"):
+            total = 0
+            while True:
+                quantidade = await self.pool.fetchval(PG_SQL[consulta], int(retencao_dias), lote)
+                total += quantidade
+                if quantidade < lote:
+                    break
+            movidos.append(total)
+        return tuple(movidos)
+
+    async def check_query_plans(self):
+        """Roda EXPLAIN (FORMAT JSON) em todas as consultas de PG_SQL e aponta Seq Scans.
+
+        Com `enable_seqscan = off` o planejador só escolhe Seq Scan quando não há
+        índice utilizável, então o resultado não depende do tamanho atual das
+        tabelas. O plano é o genérico (parâmetros nulos). Retorna `(nome, detalhe)`
+        para cada Seq Scan em TABELAS_GRANDES (exceto SCANS_PERMITIDOS).
+        """
+        problemas = []
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("SET LOCAL enable_seqscan = off; SET LOCAL plan_cache_mode = force_generic_plan")
+            for nome, consulta in PG_SQL.items():
+                if nome in SCANS_PERMITIDOS:
+                    continue
+                parametros = max(map(int, re.findall(r"\$(\d+)", consulta)), default=0)
+                argumentos = f"({', '.join(['NULL'] * parametros)})" if parametros else ""
+                async with conn.transaction():
+                    await conn.execute(f"PREPARE verificar_plano AS {consulta}")
+                    plano = json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) EXECUTE verificar_plano{argumentos}"))
+                    await conn.execute("DEALLOCATE verificar_plano")
+                pendentes = [plano[0]["Plan"]]
+                while pendentes:
+                    no = pendentes.pop()
+                    pendentes.extend(no.get("Plans", []))
+                    if no["Node Type"] == "Seq Scan" and no.get("Relation Name") in TABELAS_GRANDES:
+                        problemas.append((nome, f"Seq Scan on {no['Relation Name']}"))
+        return problemas
+
+    async def backup(self, **kwargs):
+        raise RuntimeError("Backup online disponível só no SQLite; no PostgreSQL use pg_dump ou o backup do provedor")
+
+# Tabelas copiadas por `python main.py --migrar-postgres`, na ordem de cópia
+TABELAS_MIGRACAO = {
+    "usuarios": ["user_id", "username", "first_name", "saldo", "saldo_bonus", "numeros_gratis", "indicador_id",
+                 "codigo_indicacao", "data_registro", "total_depositado", "indicacoes_validas", "ultimo_bonus",
+                 "vip_status", "total_starts"],
+    "transacoes": ["id", "user_id", "tipo", "valor", "moeda", "status", "invoice_id", "data_transacao",
+                   "data_confirmacao", "valor_crypto_pago", "moeda_paga", "observacoes", "valor_crypto"],
+    "numeros_sms": ["id", "user_id", "servico", "pais", "numero", "codigo_recebido", "preco",
+                    "desconto_aplicado", "status", "data_compra"],
+    "movimentos": ["id", "user_id", "tipo", "delta_saldo", "delta_bonus", "delta_depositado", "referencia",
+                   "criado_em"],
+    "estatisticas_diarias": ["dia", "novos_usuarios", "vendas", "faturamento", "numeros"],
+    "transacoes_arquivo": ["id", "user_id", "tipo", "valor", "moeda", "status", "invoice_id", "data_transacao",
+                           "data_confirmacao", "valor_crypto_pago", "moeda_paga", "observacoes", "valor_crypto"],
+    "numeros_sms_arquivo": ["id", "user_id", "servico", "pais", "numero", "codigo_recebido", "preco",
+                            "desconto_aplicado", "status", "data_compra"],
+    "resumo_compras": ["user_id", "total_compras", "total_gasto", "total_economizado"],
+    "indicacoes_arvore": ["ancestral_id", "descendente_id", "profundidade"],
+    "indicacoes_resumo": ["user_id", "diretas", "indiretas", "depositantes", "volume_rede", "volume_proprio"],
+}
+COLUNAS_DATA_HORA = {"data_registro", "ultimo_bonus", "data_transacao", "data_confirmacao", "data_compra", "criado_em"}
+MIGRACAO_LOTE = 5000
+
+def _converter_para_postgres(coluna, valor):
+    """SQLite guarda datas como texto; o PostgreSQL espera datetime/date"""
+    if valor is None or not isinstance(valor, str):
+        return valor
+    if coluna in COLUNAS_DATA_HORA:
+        return datetime.fromisoformat(valor).replace(tzinfo=None)
+    if coluna == "dia":
+        return datetime.fromisoformat(valor).date()
+    return valor
+
+async def migrar_para_postgres(sqlite_path="premium_bot.db"):
+    """Copia o banco SQLite local para o PostgreSQL de DATABASE_URL (destino precisa estar vazio)"""
+    if not DATABASE_URL:
+        print("❌ Configure DATABASE_URL com o PostgreSQL de destino")
+        return 1
+
+    origem = DatabaseManager(sqlite_path)
+    origem.compactar_saldos()
+    destino = PostgresStorage(DATABASE_URL)
+    await destino.open()
+    try:
+        async with destino.pool.acquire() as conn, conn.transaction():
+            if await conn.fetchval("SELECT COUNT(*) FROM usuarios"):
+                print("❌ O PostgreSQL de destino já tem usuários; migração cancelada")
+                return 1
+
+            await conn.execute("DELETE FROM estatisticas_diarias")
+            for tabela, colunas in TABELAS_MIGRACAO.items():
+                copiadas = 0
+                with origem.connection() as src:
+                    cursor = src.execute(f"SELECT {', '.join(colunas)} FROM {tabela}")
+                    while lote := cursor.fetchmany(MIGRACAO_LOTE):
+                        registros = [
+                            tuple(_converter_para_postgres(col, val) for col, val in zip(colunas, row))
+                            for row in lote
+                        ]
+                        await conn.copy_records_to_table(tabela, records=registros, columns=colunas)
+                        copiadas += len(registros)
+                    # Continua a sequência do AUTOINCREMENT (ids arquivados não podem ser reutilizados)
+                    sequencia = src.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (tabela,)).fetchone()
+                if sequencia:
+                    await conn.execute(
+                        "SELECT setval(pg_get_serial_sequence($1, 'id'), $2 + 1, false)", tabela, sequencia[0]
+                    )
+                print(f"✅ {tabela}: {copiadas} linhas")
+
+            with origem.connection() as src:
+                estatisticas = src.execute(SQL["get_estatisticas"]).fetchone()
+                ultimo_movimento = src.execute(SQL["get_ledger_estado"]).fetchone()[0]
+            await conn.execute(
+                """
+                UPDATE estatisticas
+                SET total_usuarios = $1, total_starts = $2, total_vendas = $3, total_faturamento = $4, total_numeros = $5
+                WHERE id = 1
+                """,
+                *estatisticas
+            )
+            await conn.execute(PG_SQL["atualizar_ledger_estado"], ultimo_movimento)
+    finally:
+        await destino.close()
+        origem.pool.close_all()
+
+    print("✅ Migração para PostgreSQL concluída")
+    return 0
+
+def criar_storage():
+    """Escolhe o backend: PostgreSQL quando DATABASE_URL está configurada, senão SQLite local.
+
+    Devolve (DatabaseManager ou None, Storage). O DatabaseManager só existe no
+    modo SQLite e é usado pelas ferramentas de linha de comando.
+    """
+    if DATABASE_URL:
+        return None, PostgresStorage(DATABASE_URL)
+    manager = DatabaseManager()
+    return manager, AsyncDatabase(manager)
+
+# Backend de armazenamento: criado por main() (ou pelo modo de linha de comando), nunca no import
+db = None
+async_db = None
+starts_buffer = CounterBuffer(lambda lote: async_db.update_user_starts_lote(lote))
 
 # Funções auxiliares
 def generate_referral_code():
@@ -598,45 +3574,6 @@ def generate_referral_code():
     numbers = string.digits
     return ''.join(random.choice(letters + numbers) for _ in range(8))
 
-def load_referral_codes():
-    """Carrega códigos de indicação do arquivo JSON"""
-    try:
-        with open('referral_codes.json', 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-def save_referral_codes(codes_data):
-    """Salva códigos de indicação no arquivo JSON"""
-    with open('referral_codes.json', 'w') as f:
-        json.dump(codes_data, f, indent=2)
-
-def get_or_create_referral_code_json(user_id):
-    """Obtém ou cria código de indicação para usuário usando JSON"""
-    codes_data = load_referral_codes()
-    user_id_str = str(user_id)
-
-    # Verificar se usuário já tem código
-    if user_id_str in codes_data:
-        return codes_data[user_id_str]
-
-    # Gerar novo código único
-    while True:
-        code = generate_referral_code()
-        # Verificar se código já existe
-        if code not in codes_data.values():
-            codes_data[user_id_str] = code
-            save_referral_codes(codes_data)
-            return code
-
-def get_user_by_referral_code_json(code):
-    """Busca usuário pelo código de indicação usando JSON"""
-    codes_data = load_referral_codes()
-    for user_id, user_code in codes_data.items():
-        if user_code == code:
-            return int(user_id)
-    return None
-
 def calcular_bonus(valor):
     """Função centralizada para calcular bônus baseado no valor depositado"""
     if valor >= 200:
@@ -652,17 +3589,6 @@ def is_admin(user_id):
     """Verifica se o usuário é admin"""
     return user_id == ADMIN_ID
 
-def update_user_starts(user_id):
-    """Atualiza contador de starts do usuário"""
-    with db._lock:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE usuarios SET total_starts = total_starts + 1 WHERE user_id = ?
-        ''', (user_id,))
-        conn.commit()
-        conn.close()
-
 def get_min_price_for_service():
     """Obtém o preço mínimo entre todos os serviços e países"""
     min_price = float('inf')
@@ -686,6 +3612,268 @@ def get_crypto_name(crypto_code):
             return moeda["name"]
     return crypto_code
 
+class UpstreamUnavailableError(Exception):
+    """Circuito da API externa aberto: a chamada falha na hora, sem ir à rede"""
+
+class CircuitBreaker:
+    """Circuit breaker por taxa de falha nas últimas `janela` chamadas.
+
+    Fechado: tudo passa; com pelo menos `minimo` resultados na janela e
+    fração de falhas >= `taxa_falha`, abre. Aberto: recusa tudo por
+    `aberto_por` segundos. Meio aberto: deixa passar até `sondas` chamadas
+    de teste; um sucesso fecha o circuito (janela zerada), uma falha reabre.
+    """
+
+    def __init__(self, nome, janela=CIRCUITO_JANELA, minimo=CIRCUITO_MINIMO, taxa_falha=CIRCUITO_TAXA_FALHA,
+                 aberto_por=CIRCUITO_ABERTO_SECONDS, sondas=CIRCUITO_SONDAS, relogio=time.monotonic):
+        self.nome = nome
+        self.minimo = minimo
+        self.taxa_falha = taxa_falha
+        self.aberto_por = aberto_por
+        self.sondas = sondas
+        self.relogio = relogio
+        self.estado = "fechado"
+        self._resultados = deque(maxlen=janela)
+        self._aberto_ate = 0.0
+        self._sondas_ativas = 0
+        self.stats = {"aberturas": 0, "rejeitadas": 0}
+
+    def permitir(self):
+        """True se a chamada pode ir à rede (o resultado deve voltar em `registrar`)"""
+        if self.estado == "aberto":
+            if self.relogio() < self._aberto_ate:
+                self.stats["rejeitadas"] += 1
+                return False
+            self.estado = "meio_aberto"
+            self._sondas_ativas = 0
+        if self.estado == "meio_aberto":
+            if self._sondas_ativas >= self.sondas:
+                self.stats["rejeitadas"] += 1
+                return False
+            self._sondas_ativas += 1
+        return True
+
+    def registrar(self, sucesso):
+        if self.estado == "meio_aberto":
+            self._sondas_ativas = max(0, self._sondas_ativas - 1)
+            if sucesso:
+                self.estado = "fechado"
+                self._resultados.clear()
+                logger.info(f"🟢 Circuito {self.nome} fechado: API respondendo de novo")
+            else:
+                self._abrir()
+            return
+        if self.estado == "aberto":
+            # Chamada que começou antes de o circuito abrir
+            return
+        self._resultados.append(sucesso)
+        falhas = self._resultados.count(False)
+        if len(self._resultados) >= self.minimo and falhas / len(self._resultados) >= self.taxa_falha:
+            self._abrir()
+
+    def _abrir(self):
+        self.estado = "aberto"
+        self._aberto_ate = self.relogio() + self.aberto_por
+        self.stats["aberturas"] += 1
+        logger.warning(f"🔴 Circuito {self.nome} aberto por {self.aberto_por:.0f}s")
+
+    def metrics(self):
+        """Métricas para /status"""
+        return {
+            "estado": self.estado,
+            "falhas_janela": self._resultados.count(False),
+            "chamadas_janela": len(self._resultados),
+            **self.stats,
+        }
+
+class HttpUpstream:
+    """Sessão aiohttp de longa duração para uma API externa.
+
+    Uma sessão por upstream, aberta em `open()` no início do bot (ou na
+    primeira chamada) e fechada em `close()` no desligamento, com keep-alive,
+    cache de DNS e limite de conexões por host. `request()` mede a latência
+    de cada chamada, passa pelo CircuitBreaker da API (erro de rede, timeout,
+    429 e 5xx contam como falha) e um TraceConfig conta conexões novas x
+    reutilizadas.
+    """
+
+    def __init__(self, nome, timeout, conexoes_por_host=HTTP_CONEXOES_POR_HOST):
+        self.nome = nome
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 5))
+        self.conexoes_por_host = conexoes_por_host
+        self.session = None
+        self.circuito = CircuitBreaker(nome)
+        self.latencias = deque(maxlen=DB_METRICS_AMOSTRAS)
+        self.stats = {"requests": 0, "errors": 0, "http_5xx": 0, "conexoes_novas": 0, "conexoes_reusadas": 0, "max_ms": 0.0}
+
+    async def open(self):
+        if self.session is not None and not self.session.closed:
+            return self.session
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._conexao_nova)
+        trace.on_connection_reuseconn.append(self._conexao_reusada)
+        connector = aiohttp.TCPConnector(
+            limit=self.conexoes_por_host * 2,
+            limit_per_host=self.conexoes_por_host,
+            ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trace_configs=[trace])
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _conexao_nova(self, session, contexto, params):
+        self.stats["conexoes_novas"] += 1
+
+    async def _conexao_reusada(self, session, contexto, params):
+        self.stats["conexoes_reusadas"] += 1
+
+    @asynccontextmanager
+    async def request(self, metodo, url, **kwargs):
+        """`async with upstream.request("GET", url) as response:` pela sessão compartilhada.
+
+        Levanta UpstreamUnavailableError sem tocar na rede se o circuito estiver aberto.
+        """
+        if not self.circuito.permitir():
+            raise UpstreamUnavailableError(self.nome)
+        inicio = time.perf_counter()
+        falhou = True
+        try:
+            # Dentro do try: se abrir a sessão falhar, o finally ainda libera a sondagem do meio-aberto
+            session = await self.open()
+            async with session.request(metodo, url, **kwargs) as response:
+                if response.status >= 500:
+                    self.stats["http_5xx"] += 1
+                yield response
+                falhou = response.status >= 500 or response.status == 429
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.circuito.registrar(not falhou)
+            segundos = time.perf_counter() - inicio
+            self.stats["requests"] += 1
+            self.stats["max_ms"] = max(self.stats["max_ms"], segundos * 1000)
+            self.latencias.append(segundos)
+
+    def metrics(self):
+        """Métricas para /status"""
+        ordenadas = sorted(self.latencias)
+        conexoes = self.stats["conexoes_novas"] + self.stats["conexoes_reusadas"]
+        return {
+            **self.stats,
+            "circuito": self.circuito.metrics(),
+            "reuso": round(self.stats["conexoes_reusadas"] / conexoes, 3) if conexoes else 0.0,
+            "p50_ms": DatabaseMetrics._percentil(ordenadas, 0.50) * 1000,
+            "p95_ms": DatabaseMetrics._percentil(ordenadas, 0.95) * 1000,
+        }
+
+cryptopay_http = HttpUpstream("cryptopay", CRYPTOPAY_TIMEOUT_SECONDS)
+fivesim_http = HttpUpstream("5sim", FIVESIM_TIMEOUT_SECONDS)
+coingecko_http = HttpUpstream("coingecko", COINGECKO_TIMEOUT_SECONDS, conexoes_por_host=4)
+UPSTREAMS = (cryptopay_http, fivesim_http, coingecko_http)
+
+class CryptoRateOracle:
+    """Cotações BRL de todas as moedas do MOEDAS_CRYPTO, atualizadas em lote.
+
+    Uma única chamada `simple/price` do CoinGecko com todos os ids traz as
+    cotações; `run()` repete isso a cada `intervalo` segundos em background.
+    `cotacao()` responde na hora com a última cotação conhecida: se ela passou
+    do intervalo, dispara uma atualização sem esperar (stale-while-revalidate);
+    só espera a rede quando não há cotação ou ela passou de `idade_maxima`.
+    Atualizações simultâneas são agrupadas em uma única tarefa.
+    """
+
+    REVALIDAR_APOS_FALHA = 5
+
+    def __init__(self, intervalo=COTACAO_INTERVALO_SECONDS, idade_maxima=COTACAO_IDADE_MAXIMA_SECONDS):
+        self.intervalo = intervalo
+        self.idade_maxima = idade_maxima
+        self.ids = {moeda["code"]: COINGECKO_IDS[moeda["code"]] for moeda in MOEDAS_CRYPTO if moeda["code"] in COINGECKO_IDS}
+        self._cotacoes = {}
+        self._tarefa = None
+        self._ultima_falha = float("-inf")
+        self.stats = {"frescas": 0, "antigas": 0, "esperas": 0, "atualizacoes": 0, "falhas": 0}
+
+    async def cotacao(self, codigo):
+        """Preço em BRL de `codigo`, ou None se não houver cotação dentro da idade máxima"""
+        registro = self._cotacoes.get(codigo)
+        idade = time.time() - registro[1] if registro else None
+        if idade is not None and idade < self.intervalo:
+            self.stats["frescas"] += 1
+            return registro[0]
+        if idade is not None and idade <= self.idade_maxima:
+            self.stats["antigas"] += 1
+            # Com o CoinGecko fora, não tenta de novo a cada leitura
+            if time.monotonic() - self._ultima_falha >= self.REVALIDAR_APOS_FALHA:
+                self._disparar()
+            return registro[0]
+
+        self.stats["esperas"] += 1
+        await self.atualizar()
+        registro = self._cotacoes.get(codigo)
+        if registro and time.time() - registro[1] <= self.idade_maxima:
+            return registro[0]
+        return None
+
+    async def atualizar(self):
+        """Atualiza todas as cotações (ou espera a atualização que já está em andamento)"""
+        await asyncio.shield(self._disparar())
+
+    def _disparar(self):
+        if self._tarefa is None or self._tarefa.done():
+            self._tarefa = asyncio.create_task(self._buscar())
+            # Falha de uma atualização disparada em background já foi logada em _buscar
+            self._tarefa.add_done_callback(lambda tarefa: tarefa.cancelled() or tarefa.exception())
+        return self._tarefa
+
+    async def _buscar(self):
+        url = f"https://api.coingecko.com/api/v3/simple/price?ids={','.join(sorted(set(self.ids.values())))}&vs_currencies=brl"
+        try:
+            async with coingecko_http.request("GET", url) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"HTTP {response.status}")
+                data = await response.json()
+        except Exception as e:
+            self.stats["falhas"] += 1
+            self._ultima_falha = time.monotonic()
+            logger.error(f"Erro ao atualizar cotações no CoinGecko: {e}")
+            raise
+
+        agora = time.time()
+        for codigo, cripto_id in self.ids.items():
+            preco = data.get(cripto_id, {}).get("brl")
+            if preco:
+                self._cotacoes[codigo] = (float(preco), agora)
+            else:
+                logger.warning(f"Cotação de {codigo} ({cripto_id}) ausente na resposta do CoinGecko")
+        self.stats["atualizacoes"] += 1
+
+    async def run(self):
+        """Loop em background (task criada em main)"""
+        while True:
+            try:
+                await self.atualizar()
+            except Exception:
+                pass
+            await asyncio.sleep(self.intervalo)
+
+    def metrics(self):
+        """Métricas para /status"""
+        agora = time.time()
+        idades = [agora - atualizado_em for _, atualizado_em in self._cotacoes.values()]
+        return {
+            "moedas": len(self._cotacoes),
+            "idade_max_s": round(max(idades), 1) if idades else None,
+            **self.stats,
+        }
+
+crypto_oracle = CryptoRateOracle()
+
 class CryptoPayManager:
     def __init__(self):
         self.api_token = CRYPTOPAY_API_TOKEN
@@ -696,95 +3884,26 @@ class CryptoPayManager:
         }
 
     async def get_crypto_price_async(self, valor_brl, cripto):
-        """Converte valor em BRL para criptomoeda usando CoinGecko com cache e requests assíncronos"""
+        """Converte valor em BRL para criptomoeda pela cotação do crypto_oracle"""
         try:
-            # Verificar cache primeiro
-            cache_key = f"{cripto.upper()}_{int(time.time() // CACHE_EXPIRY_SECONDS)}"
-            if cache_key in crypto_price_cache:
-                cotacao = crypto_price_cache[cache_key]
-                return round(valor_brl / cotacao, 8)
-
             # Verificar se a moeda é suportada
             moedas_suportadas = [m["code"] for m in MOEDAS_CRYPTO]
             if cripto.upper() not in moedas_suportadas:
                 logger.error(f"Moeda {cripto} não suportada pelo CryptoPay")
                 return None
 
-            cripto_id = COINGECKO_IDS.get(cripto.upper())
-            if not cripto_id:
+            if cripto.upper() not in crypto_oracle.ids:
                 logger.error(f"ID CoinGecko não encontrado para {cripto}")
                 return None
 
-            url = f"https://api.coingecko.com/api/v3/simple/price?ids={cripto_id}&vs_currencies=brl"
-
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-                async with session.get(url) as response:
-                    if response.status != 200:
-                        logger.error(f"Erro na API CoinGecko: {response.status}")
-                        return None
-
-                    data = await response.json()
-                    if cripto_id not in data:
-                        logger.error(f"Dados não encontrados para {cripto_id}")
-                        return None
-
-                    cotacao = data[cripto_id]["brl"]
-
-                    # Salvar no cache
-                    crypto_price_cache[cache_key] = cotacao
-
-                    # Limpar cache antigo
-                    current_time_slot = int(time.time() // CACHE_EXPIRY_SECONDS)
-                    keys_to_remove = [k for k in crypto_price_cache.keys() 
-                                    if int(k.split('_')[-1]) < current_time_slot - 1]
-                    for key in keys_to_remove:
-                        del crypto_price_cache[key]
-
-                    return round(valor_brl / cotacao, 8)
-        except Exception as e:
-            logger.error(f"Erro ao converter BRL para {cripto}: {e}")
-            return None
-
-    def get_crypto_price(self, valor_brl, cripto):
-        """Versão síncrona para compatibilidade"""
-        try:
-            # Verificar cache primeiro
-            cache_key = f"{cripto.upper()}_{int(time.time() // CACHE_EXPIRY_SECONDS)}"
-            if cache_key in crypto_price_cache:
-                cotacao = crypto_price_cache[cache_key]
-                return round(valor_brl / cotacao, 8)
-
-            # Verificar se a moeda é suportada
-            moedas_suportadas = [m["code"] for m in MOEDAS_CRYPTO]
-            if cripto.upper() not in moedas_suportadas:
-                logger.error(f"Moeda {cripto} não suportada pelo CryptoPay")
-                return None
-
-            cripto_id = COINGECKO_IDS.get(cripto.upper())
-            if not cripto_id:
-                logger.error(f"ID CoinGecko não encontrado para {cripto}")
-                return None
-
-            url = f"https://api.coingecko.com/api/v3/simple/price?ids={cripto_id}&vs_currencies=brl"
-
-            import requests
-            response = requests.get(url, timeout=10)
-
-            if response.status_code != 200:
-                logger.error(f"Erro na API CoinGecko: {response.status_code}")
-                return None
-
-            data = response.json()
-            if cripto_id not in data:
-                logger.error(f"Dados não encontrados para {cripto_id}")
+            cotacao = await crypto_oracle.cotacao(cripto.upper())
+            if not cotacao:
+                logger.error(f"Sem cotação recente para {cripto}")
                 return None
 
-            cotacao = data[cripto_id]["brl"]
-
-            # Salvar no cache
-            crypto_price_cache[cache_key] = cotacao
-
             return round(valor_brl / cotacao, 8)
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Erro ao converter BRL para {cripto}: {e}")
             return None
@@ -804,54 +3923,42 @@ class CryptoPayManager:
                 "expires_in": 3600
             }
 
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15)) as session:
-                async with session.post(
-                    f"{self.api_base}/createInvoice",
-                    json=payload,
-                    headers=self.headers
-                ) as response:
-                    data = await response.json()
-                    if data.get("ok"):
-                        invoice = data["result"]
-                        return invoice, None
-                    else:
-                        return None, data.get("error", "Erro desconhecido")
+            async with cryptopay_http.request(
+                "POST",
+                f"{self.api_base}/createInvoice",
+                json=payload,
+                headers=self.headers
+            ) as response:
+                data = await response.json()
+                if data.get("ok"):
+                    invoice = data["result"]
+                    return invoice, None
+                else:
+                    return None, data.get("error", "Erro desconhecido")
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Erro ao criar fatura: {e}")
             return None, str(e)
 
-    def create_invoice(self, valor_brl, moeda, user_id):
-        """Versão síncrona para compatibilidade"""
+    async def get_invoice_async(self, invoice_id):
+        """Consulta uma fatura pelo id (getInvoices); None se não existir ou a consulta falhar"""
         try:
-            valor_crypto = self.get_crypto_price(valor_brl, moeda)
-            if not valor_crypto:
-                return None, "Erro ao converter moeda"
-
-            payload = {
-                "amount": str(valor_crypto),
-                "asset": moeda,
-                "currency_type": "crypto",
-                "description": f"🔥 OFERTA ESPECIAL - R$ {valor_brl} - Usuário {user_id}",
-                "expires_in": 3600
-            }
-
-            import requests
-            response = requests.post(
-                f"{self.api_base}/createInvoice",
-                json=payload,
-                headers=self.headers,
-                timeout=15
-            )
-
-            data = response.json()
-            if data.get("ok"):
-                invoice = data["result"]
-                return invoice, None
-            else:
-                return None, data.get("error", "Erro desconhecido")
+            async with cryptopay_http.request(
+                "GET",
+                f"{self.api_base}/getInvoices",
+                params={"invoice_ids": str(invoice_id)},
+                headers=self.headers
+            ) as response:
+                data = await response.json()
+                if data.get("ok") and data["result"].get("items"):
+                    return data["result"]["items"][0]
+                return None
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
-            logger.error(f"Erro ao criar fatura: {e}")
-            return None, str(e)
+            logger.error(f"Erro ao consultar fatura {invoice_id}: {e}")
+            return None
 
 # Instância do gerenciador de pagamentos
 crypto_pay = CryptoPayManager()
@@ -868,14 +3975,16 @@ class FiveSimManager:
     async def get_available_countries_async(self, service):
         """Obtém países disponíveis para um serviço com requests assíncronos"""
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-                async with session.get(
-                    f"{self.api_base}/guest/countries",
-                    headers=self.headers
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    return None
+            async with fivesim_http.request(
+                "GET",
+                f"{self.api_base}/guest/countries",
+                headers=self.headers
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                return None
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Erro ao obter países: {e}")
             return None
@@ -883,126 +3992,335 @@ class FiveSimManager:
     async def buy_number_async(self, service, country):
         """Compra um número SMS com requests assíncronos"""
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15)) as session:
-                async with session.get(
-                    f"{self.api_base}/user/buy/activation/{country}/{service}",
-                    headers=self.headers
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    return None
+            async with fivesim_http.request(
+                "GET",
+                f"{self.api_base}/user/buy/activation/{country}/{service}",
+                headers=self.headers
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                return None
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
             logger.error(f"Erro ao comprar número: {e}")
             return None
 
-    def get_available_countries(self, service):
-        """Obtém países disponíveis para um serviço"""
+    async def cancel_order_async(self, order_id):
+        """Cancela uma ativação comprada (reembolso na 5sim)"""
         try:
-            import requests
-            response = requests.get(
-                f"{self.api_base}/guest/countries",
-                headers=self.headers,
-                timeout=10
-            )
-            return response.json() if response.status_code == 200 else None
+            async with fivesim_http.request(
+                "GET",
+                f"{self.api_base}/user/cancel/{order_id}",
+                headers=self.headers
+            ) as response:
+                return response.status == 200
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
-            logger.error(f"Erro ao obter países: {e}")
-            return None
+            logger.error(f"Erro ao cancelar número {order_id}: {e}")
+            return False
 
-    def get_service_price(self, service, country):
-        """Obtém preço do serviço para um país específico"""
-        try:
-            import requests
-            response = requests.get(
-                f"{self.api_base}/guest/prices?country={country}&product={service}",
-                headers=self.headers,
-                timeout=10
-            )
-            data = response.json()
-            if response.status_code == 200 and data:
-                return data.get(country, {}).get(service, {})
-            return None
-        except Exception as e:
-            logger.error(f"Erro ao obter preços: {e}")
-            return None
+# Instância do gerenciador 5sim
+fivesim = FiveSimManager()
 
-    def buy_number(self, service, country):
-        """Compra um número SMS"""
+# Cancelamentos em andamento (referência forte para as tarefas não serem coletadas)
+_cancelamentos_pendentes = set()
+
+def agendar_cancelamento(bot, activation_id, user_id):
+    """Cancela a ativação em background quando a 5sim não aceitou o cancelamento na hora"""
+    tarefa = asyncio.create_task(_cancelar_com_retentativa(bot, activation_id, user_id))
+    _cancelamentos_pendentes.add(tarefa)
+    tarefa.add_done_callback(_cancelamentos_pendentes.discard)
+
+async def _cancelar_com_retentativa(bot, activation_id, user_id):
+    """Repete o cancelamento com espera crescente (a primeira espera cobre o circuito aberto).
+
+    Se nenhuma tentativa der certo o admin é avisado: a ativação foi paga à
+    5sim mas não foi cobrada do usuário.
+    """
+    espera = CIRCUITO_ABERTO_SECONDS
+    for _ in range(CANCELAMENTO_TENTATIVAS):
+        await asyncio.sleep(espera)
+        espera *= 2
         try:
-            import requests
-            response = requests.get(
-                f"{self.api_base}/user/buy/activation/{country}/{service}",
-                headers=self.headers,
-                timeout=15
-            )
-            return response.json() if response.status_code == 200 else None
-        except Exception as e:
-            logger.error(f"Erro ao comprar número: {e}")
-            return None
-
-    def get_sms_code(self, activation_id):
-        """Obtém código SMS recebido"""
+            if await fivesim.cancel_order_async(activation_id):
+                logger.info(f"✅ Ativação {activation_id} cancelada na nova tentativa")
+                return
+        except UpstreamUnavailableError:
+            continue
+
+    logger.error(f"❌ Não foi possível cancelar a ativação {activation_id} do usuário {user_id}")
+    if ADMIN_ID:
         try:
-            import requests
-            response = requests.get(
-                f"{self.api_base}/user/check/{activation_id}",
-                headers=self.headers,
-                timeout=10
+            await bot.send_message(
+                chat_id=ADMIN_ID,
+                text=f"⚠️ CANCELAMENTO PENDENTE NA 5SIM\n\n"
+                     f"👤 Usuário: {user_id}\n"
+                     f"🆔 Ativação: {activation_id}\n\n"
+                     f"O saldo do usuário não foi debitado. Cancele a ativação manualmente."
             )
-            return response.json() if response.status_code == 200 else None
         except Exception as e:
-            logger.error(f"Erro ao verificar SMS: {e}")
-            return None
+            logger.error(f"Erro ao notificar admin: {e}")
+
+class _Sessao:
+    """Entrada do SessionStore: valor e instante (time.time) em que expira"""
+    __slots__ = ("valor", "expira_em")
+
+    def __init__(self, valor, expira_em):
+        self.valor = valor
+        self.expira_em = expira_em
+
+class SessionStore:
+    """Estado de conversa por usuário com TTL deslizante e limite de entradas.
+
+    Cada leitura ou escrita renova o TTL e move a entrada para o fim do
+    OrderedDict, então o início guarda sempre as que expiram primeiro: as
+    vencidas saem a cada escrita e, acima de `max_size`, as menos usadas.
+    A expiração usa o relógio de parede para sobreviver ao snapshot em disco
+    feito no desligamento. Usado só pelo event loop, sem lock.
+    """
+
+    def __init__(self, nome, ttl, max_size=SESSAO_MAX):
+        self.nome = nome
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def get(self, user_id, default=None):
+        entry = self._entries.get(user_id)
+        agora = time.time()
+        if entry is None or entry.expira_em <= agora:
+            if entry is not None:
+                del self._entries[user_id]
+                self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return default
+        entry.expira_em = agora + self.ttl
+        self._entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return entry.valor
+
+    def set(self, user_id, valor):
+        agora = time.time()
+        self._entries[user_id] = _Sessao(valor, agora + self.ttl)
+        self._entries.move_to_end(user_id)
+        self._remover_vencidas(agora)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def pop(self, user_id, default=None):
+        valor = self.get(user_id, default)
+        self._entries.pop(user_id, None)
+        return valor
+
+    def _remover_vencidas(self, agora):
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expira_em > agora:
+                break
+            self._entries.popitem(last=False)
+            self.stats["expired"] += 1
+
+    def snapshot(self):
+        """Entradas ainda válidas como `{user_id: [valor, expira_em]}` (serializável em JSON)"""
+        agora = time.time()
+        return {str(user_id): [entry.valor, entry.expira_em] for user_id, entry in self._entries.items() if entry.expira_em > agora}
+
+    def restaurar(self, dados):
+        """Carrega um `snapshot()`; entradas vencidas enquanto o bot estava parado são descartadas"""
+        agora = time.time()
+        for user_id, (valor, expira_em) in sorted(dados.items(), key=lambda item: item[1][1]):
+            if expira_em > agora:
+                self._entries[int(user_id)] = _Sessao(valor, expira_em)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return len(self._entries)
+
+    def metrics(self):
+        """Métricas para /status (bytes é uma estimativa via sys.getsizeof)"""
+        total = self.stats["hits"] + self.stats["misses"]
+        memoria = sys.getsizeof(self._entries) + sum(
+            sys.getsizeof(entry) + sys.getsizeof(entry.valor) for entry in self._entries.values()
+        )
+        return {
+            "size": len(self._entries),
+            "bytes": memoria,
+            "hit_rate": round(self.stats["hits"] / total, 3) if total else 0.0,
+            **self.stats,
+        }
 
-# Instância do gerenciador 5sim
-fivesim = FiveSimManager()
+# Fluxo em andamento (serviço escolhido / recarga escolhida) por usuário
+temp_data = SessionStore("temp_data", SESSAO_TTL_SECONDS)
+
+# IDs das mensagens enviadas pelo bot por usuário (para apagar depois)
+user_messages = SessionStore("user_messages", MENSAGENS_TTL_SECONDS)
 
-# Dicionário para armazenar dados temporários
-temp_data = {}
+SESSOES = (temp_data, user_messages)
 
-# Dicionário para armazenar IDs das mensagens por usuário
-user_messages = {}
+def salvar_sessoes(caminho=SESSOES_ARQUIVO):
+    """Grava as sessões em disco no desligamento para os fluxos sobreviverem ao deploy"""
+    if not caminho:
+        return
+    temporario = f"{caminho}.tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump({sessao.nome: sessao.snapshot() for sessao in SESSOES}, f)
+    os.replace(temporario, caminho)
+    logger.info(f"💾 Sessões salvas em {caminho}: " + ", ".join(f"{s.nome}={len(s._entries)}" for s in SESSOES))
+
+def carregar_sessoes(caminho=SESSOES_ARQUIVO):
+    """Restaura o snapshot gravado por salvar_sessoes (e apaga o arquivo)"""
+    if not caminho or not os.path.exists(caminho):
+        return
+    try:
+        with open(caminho, encoding="utf-8") as f:
+            dados = json.load(f)
+        for sessao in SESSOES:
+            restauradas = sessao.restaurar(dados.get(sessao.nome, {}))
+            logger.info(f"♻️ {restauradas} sessões restauradas em {sessao.nome}")
+    except Exception as e:
+        logger.error(f"Erro ao restaurar sessões de {caminho}: {e}")
+    finally:
+        os.remove(caminho)
 
 def get_random_urgencia():
     """Retorna uma mensagem de urgência aleatória"""
     return random.choice(MENSAGENS_URGENCIA)
 
-def get_random_exclusividade():
-    """Retorna uma mensagem de exclusividade aleatória"""
-    return random.choice(MENSAGENS_EXCLUSIVIDADE)
+def get_random_exclusividade():
+    """Retorna uma mensagem de exclusividade aleatória"""
+    return random.choice(MENSAGENS_EXCLUSIVIDADE)
+
+def get_random_sucesso():
+    """Retorna uma mensagem de sucesso aleatória"""
+    return random.choice(MENSAGENS_SUCESSO)
+
+class MessageCleaner:
+    """Fila de exclusão de mensagens processada em background.
+
+    Os handlers só enfileiram `(chat_id, message_id, enviada_em)` e respondem
+    na hora. O worker espera `atraso` segundos depois do primeiro item, junta
+    o que chegou e apaga por chat: em lotes de até 100 com deleteMessages
+    quando a versão do python-telegram-bot oferece `Bot.delete_messages`, senão
+    com até `concorrencia` deleteMessage simultâneos. Um flood wait
+    (RetryAfter) pausa todas as chamadas pelo tempo pedido e repete a
+    exclusão. Mensagens com mais de 48h não podem ser apagadas pelo bot e
+    são descartadas sem chamar a API.
+    """
+
+    IDADE_MAXIMA = 48 * 3600 - 300  # Margem para o relógio do Telegram
+    LOTE_MAXIMO = 100
+    TENTATIVAS = 3
+
+    def __init__(self, max_fila=LIMPEZA_FILA_MAX, concorrencia=LIMPEZA_CONCORRENCIA, atraso=LIMPEZA_ATRASO_SECONDS):
+        self.max_fila = max_fila
+        self.concorrencia = concorrencia
+        self.atraso = atraso
+        self._fila = deque()
+        self._acordar = None
+        self._pausa_ate = 0.0
+        self.stats = {"enfileiradas": 0, "apagadas": 0, "expiradas": 0, "descartadas": 0, "falhas": 0, "flood_waits": 0}
+
+    def agendar(self, chat_id, message_id, enviada_em=None):
+        """Enfileira a exclusão; não chama a API"""
+        if len(self._fila) >= self.max_fila:
+            self.stats["descartadas"] += 1
+            return
+        self._fila.append((chat_id, message_id, enviada_em or time.time()))
+        self.stats["enfileiradas"] += 1
+        if self._acordar is not None:
+            self._acordar.set()
+
+    async def run(self, bot):
+        """Loop do worker (task criada em main)"""
+        self._acordar = asyncio.Event()
+        while True:
+            if not self._fila:
+                self._acordar.clear()
+                await self._acordar.wait()
+            await asyncio.sleep(self.atraso)
+
+            limite = time.time() - self.IDADE_MAXIMA
+            por_chat = defaultdict(list)
+            while self._fila:
+                chat_id, message_id, enviada_em = self._fila.popleft()
+                if enviada_em < limite:
+                    self.stats["expiradas"] += 1
+                else:
+                    por_chat[chat_id].append(message_id)
+
+            for chat_id, ids in por_chat.items():
+                try:
+                    await self._apagar_chat(bot, chat_id, ids)
+                except Exception as e:
+                    logger.error(f"Erro na limpeza de mensagens do chat {chat_id}: {e}")
+
+    async def _chamar(self, funcao, **kwargs):
+        """Chama a API respeitando o flood wait corrente; devolve False se a exclusão falhou"""
+        for _ in range(self.TENTATIVAS):
+            espera = self._pausa_ate - time.monotonic()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            try:
+                await funcao(**kwargs)
+                return True
+            except RetryAfter as e:
+                self.stats["flood_waits"] += 1
+                self._pausa_ate = max(self._pausa_ate, time.monotonic() + e.retry_after)
+                logger.warning(f"⏳ Flood wait de {e.retry_after}s na limpeza de mensagens")
+            except TelegramError as e:
+                # Mensagem já apagada pelo usuário, chat bloqueado etc.: não adianta repetir
+                logger.debug(f"Mensagem não apagada ({kwargs}): {e}")
+                return False
+        return False
+
+    async def _apagar_chat(self, bot, chat_id, ids):
+        apagar_lote = getattr(bot, "delete_messages", None)
+        if apagar_lote is not None:
+            for inicio in range(0, len(ids), self.LOTE_MAXIMO):
+                lote = ids[inicio:inicio + self.LOTE_MAXIMO]
+                if await self._chamar(apagar_lote, chat_id=chat_id, message_ids=lote):
+                    self.stats["apagadas"] += len(lote)
+                else:
+                    self.stats["falhas"] += len(lote)
+            return
+
+        semaforo = asyncio.Semaphore(self.concorrencia)
+
+        async def apagar(message_id):
+            async with semaforo:
+                ok = await self._chamar(bot.delete_message, chat_id=chat_id, message_id=message_id)
+            self.stats["apagadas" if ok else "falhas"] += 1
 
-def get_random_sucesso():
-    """Retorna uma mensagem de sucesso aleatória"""
-    return random.choice(MENSAGENS_SUCESSO)
+        await asyncio.gather(*(apagar(message_id) for message_id in ids))
+
+    def metrics(self):
+        """Métricas para /status"""
+        return {"pendentes": len(self._fila), **self.stats}
+
+limpeza_mensagens = MessageCleaner()
 
-async def delete_previous_messages(context, chat_id, user_id, user_message_id=None):
-    """Apaga mensagens anteriores do usuário no chat (bot + usuário)"""
+def delete_previous_messages(context, chat_id, user_id, user_message_id=None):
+    """Agenda a exclusão das mensagens anteriores do usuário no chat (bot + usuário)"""
     # Apagar mensagem do usuário atual se fornecida
     if user_message_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=user_message_id)
-        except Exception as e:
-            logger.error(f"Erro ao apagar mensagem do usuário {user_message_id}: {e}")
+        limpeza_mensagens.agendar(chat_id, user_message_id)
 
-    # Apagar mensagens anteriores do bot
-    if user_id in user_messages:
-        for message_id in user_messages[user_id]:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            except Exception as e:
-                logger.error(f"Erro ao apagar mensagem do bot {message_id}: {e}")
-        # Limpar lista após apagar
-        user_messages[user_id] = []
+    # Apagar mensagens anteriores do bot (e limpar a lista)
+    for item in user_messages.pop(user_id, None) or []:
+        # Snapshots antigos guardavam só o id, sem o horário de envio
+        message_id, enviada_em = item if isinstance(item, list) else (item, None)
+        limpeza_mensagens.agendar(chat_id, message_id, enviada_em)
 
 def store_message_id(user_id, message_id):
-    """Armazena ID da mensagem enviada pelo bot"""
-    if user_id not in user_messages:
-        user_messages[user_id] = []
-    user_messages[user_id].append(message_id)
+    """Armazena ID da mensagem enviada pelo bot (com o horário, para respeitar o limite de 48h)"""
+    ids = user_messages.get(user_id) or []
+    ids.append([message_id, time.time()])
 
     # Manter apenas as últimas 15 mensagens para evitar acúmulo
-    if len(user_messages[user_id]) > 15:
-        user_messages[user_id] = user_messages[user_id][-15:]
+    user_messages.set(user_id, ids[-15:])
 
 def calculate_time_left():
     """Calcula tempo restante da promoção baseado em horário de Brasília"""
@@ -1120,23 +4438,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Apagar mensagens anteriores (bot + usuário)
     if update.message:
-        await delete_previous_messages(context, update.message.chat_id, user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, user.id, update.message.message_id)
 
-    # Atualizar contador de starts
-    update_user_starts(user.id)
+    # Atualizar contador de starts (gravado em lote pelo starts_buffer)
+    starts_buffer.add(user.id)
 
-    # Verificar se é um link de indicação com código
-    indicador_id = None
-    if context.args:
-        referral_code = context.args[0]
-        indicador_id = get_user_by_referral_code_json(referral_code)
-
-    # Verificar se usuário existe
-    user_exists = db.get_user(user.id)
+    # Verificar se usuário existe (a mesma consulta já traz tudo que o menu mostra)
+    snapshot = await async_db.get_user_snapshot(user.id)
+    user_exists = snapshot is not None
 
     # Criar usuário se não existir
     if not user_exists:
-        db.create_user(user.id, user.username, user.first_name, indicador_id)
+        # Link de indicação com código: só vale para usuário novo
+        indicador_id = None
+        if context.args:
+            indicador_id = await async_db.get_user_by_referral_code(context.args[0])
+
+        await async_db.create_user(user.id, user.username, user.first_name, indicador_id)
+        snapshot = await async_db.get_user_snapshot(user.id)
 
         # Se foi indicado, notificar o indicador
         if indicador_id:
@@ -1155,14 +4474,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Obter estatísticas e detalhes do usuário
     stats = get_stats_fake()
-    user_details = db.get_user_details(user.id)
-    user_stats = db.get_user_stats(user.id)
 
     # Extrair informações do usuário
-    saldo_base = user_details['saldo_base']
-    bonus = user_details['bonus']
-    saldo_total = user_details['saldo_total']
-    numeros_gratis = user_details['numeros_gratis']
+    saldo_base = snapshot.saldo_base
+    bonus = snapshot.bonus
+    numeros_gratis = snapshot.numeros_gratis
 
     # Criar mensagem de boas-vindas premium
     exclusividade_msg = get_random_exclusividade()
@@ -1214,7 +4530,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"💰 Seu saldo: R$ {saldo_base:.2f}\n"
             f"🎁 Seu bônus: R$ {bonus:.2f}\n"
             f"📳 Celular grátis: {numeros_gratis}\n"
-            f"📱 Suas compras: {user_stats[0]}\n"
+            f"📱 Suas compras: {snapshot.total_compras}\n"
             f"🔥 Usuários online: {stats['usuarios_online']}\n"
             f"⏰ Promoção VIP: {tempo_restante}\n"
             f"━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -1229,7 +4545,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif update.callback_query:
         await update.callback_query.edit_message_text(welcome_text, reply_markup=reply_markup)
 
-@rate_limit
 async def menu_servicos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Menu de serviços premium"""
     query = update.callback_query
@@ -1242,7 +4557,7 @@ async def menu_servicos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     store_message_id(query.from_user.id, query.message.message_id)
 
     user_id = query.from_user.id
-    saldo = db.get_saldo(user_id)
+    saldo = await async_db.get_saldo(user_id)
 
     # Verificar se tem saldo suficiente
     preco_minimo = get_min_price_for_service()
@@ -1324,7 +4639,7 @@ async def menu_servicos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-async def selecionar_servico(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def selecionar_servico(update: Update, context: ContextTypes.DEFAULT_TYPE, servico):
     """Selecionar país após escolher serviço"""
     query = update.callback_query
     if not query or not query.data or not query.from_user:
@@ -1332,11 +4647,10 @@ async def selecionar_servico(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     await query.answer()
 
-    servico = query.data.split("_")[1]
     user_id = query.from_user.id
 
     # Armazenar serviço selecionado
-    temp_data[user_id] = {"servico": servico}
+    temp_data.set(user_id, {"servico": servico})
 
     # Obter preços do serviço por país
     precos_servico = PRECOS_SERVICOS[servico]
@@ -1372,7 +4686,7 @@ async def selecionar_servico(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=reply_markup
     )
 
-async def selecionar_pais(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def selecionar_pais(update: Update, context: ContextTypes.DEFAULT_TYPE, pais):
     """Processar compra do número após selecionar país"""
     query = update.callback_query
     if not query or not query.data or not query.from_user:
@@ -1380,16 +4694,16 @@ async def selecionar_pais(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await query.answer()
 
-    pais = query.data.split("_")[1]
     user_id = query.from_user.id
 
-    if user_id not in temp_data:
+    sessao = temp_data.get(user_id)
+    if not sessao or pais not in PRECOS_SERVICOS.get(sessao.get("servico"), {}):
         await query.edit_message_text("❌ Erro: Dados não encontrados. Tente novamente.")
         return
 
-    servico = temp_data[user_id]["servico"]
+    servico = sessao["servico"]
     preco = PRECOS_SERVICOS[servico][pais]
-    saldo = db.get_saldo(user_id)
+    saldo = await async_db.get_saldo(user_id)
 
     # Verificar saldo
     if saldo < preco:
@@ -1443,12 +4757,18 @@ async def selecionar_pais(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     service_code = service_codes.get(servico, servico)
 
-    # Tentar comprar número real via 5sim usando método assíncrono
+    # Comprar número real via 5sim (falha na hora se a 5sim estiver instável)
     try:
         numero_data = await fivesim.buy_number_async(service_code, country_code)
-    except Exception as e:
-        logger.error(f"Erro ao usar método assíncrono, tentando síncrono: {e}")
-        numero_data = fivesim.buy_number(service_code, country_code)
+    except UpstreamUnavailableError:
+        await query.edit_message_text(
+            "⚠️ FORNECEDOR DE NÚMEROS INSTÁVEL\n\n"
+            "Nosso parceiro de números não está respondendo agora.\n"
+            "💰 Nenhum valor foi cobrado do seu saldo.\n\n"
+            "🔄 Tente novamente em alguns minutos!",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Voltar", callback_data="menu_servicos")]])
+        )
+        return
 
     numero_disponivel = numero_data is not None
 
@@ -1477,23 +4797,36 @@ async def selecionar_pais(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Processar compra com sucesso
     await asyncio.sleep(1)  # Simular processamento
 
-    db.deduzir_saldo(user_id, preco)
-
     # Usar número real da API
     numero_telefone = numero_data.get("phone", "Número não disponível")
     activation_id = numero_data.get("id", 0)
 
+    # Débito atômico: outra compra simultânea pode ter consumido o saldo desde a checagem
+    if await async_db.deduzir_saldo(user_id, preco, referencia=f"5sim:{activation_id}") is None:
+        logger.warning(f"Saldo insuficiente no débito do usuário {user_id}; cancelando ativação {activation_id}")
+        if activation_id:
+            try:
+                cancelado = await fivesim.cancel_order_async(activation_id)
+            except UpstreamUnavailableError:
+                cancelado = False
+            if not cancelado:
+                agendar_cancelamento(context.bot, activation_id, user_id)
+
+        keyboard = [
+            [InlineKeyboardButton("💎 RECARREGAR VIP", callback_data="menu_recarga")],
+            [InlineKeyboardButton("🔙 Voltar", callback_data="menu_servicos")]
+        ]
+        await query.edit_message_text(
+            f"❌ SALDO INSUFICIENTE!\n\n"
+            f"💰 Seu saldo mudou durante a compra e não cobre R$ {preco:.2f}.\n"
+            f"🔥 Recarregue agora e garanta seu número!",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+
     # Salvar no banco de dados com melhor tratamento de erro
     try:
-        with db._lock:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO numeros_sms (user_id, servico, pais, numero, preco, desconto_aplicado, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, servico, pais, numero_telefone, preco, 0, "aguardando_sms"))
-            conn.commit()
-            conn.close()
+        await async_db.registrar_numero(user_id, servico, pais, numero_telefone, preco, 0, "aguardando_sms")
     except Exception as e:
         logger.error(f"Erro ao salvar número no banco: {e}")
 
@@ -1519,7 +4852,6 @@ async def selecionar_pais(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-@rate_limit
 async def menu_recarga(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Menu de recarga premium"""
     query = update.callback_query
@@ -1588,7 +4920,7 @@ async def menu_recarga(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-async def selecionar_valor_recarga(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def selecionar_valor_recarga(update: Update, context: ContextTypes.DEFAULT_TYPE, valor):
     """Selecionar moeda após escolher valor"""
     query = update.callback_query
     if not query or not query.data or not query.from_user:
@@ -1596,7 +4928,6 @@ async def selecionar_valor_recarga(update: Update, context: ContextTypes.DEFAULT
 
     await query.answer()
 
-    valor = int(query.data.split("_")[1])
     user_id = query.from_user.id
 
     # Calcular bônus fixo
@@ -1617,11 +4948,11 @@ async def selecionar_valor_recarga(update: Update, context: ContextTypes.DEFAULT
     valor_total_pagar = valor
 
     # Armazenar dados
-    temp_data[user_id] = {
+    temp_data.set(user_id, {
         "valor_recarga": valor,
         "bonus": bonus,
         "valor_total_pagar": valor_total_pagar
-    }
+    })
 
     total_receber = valor + bonus
 
@@ -1655,7 +4986,7 @@ async def selecionar_valor_recarga(update: Update, context: ContextTypes.DEFAULT
         reply_markup=reply_markup
     )
 
-async def processar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def processar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE, moeda):
     """Processar pagamento após selecionar moeda"""
     query = update.callback_query
     if not query or not query.data or not query.from_user:
@@ -1663,25 +4994,30 @@ async def processar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await query.answer()
 
-    moeda = query.data.split("_")[1]
     user_id = query.from_user.id
 
-    if user_id not in temp_data:
+    sessao = temp_data.get(user_id)
+    if not sessao or "valor_recarga" not in sessao:
         await query.edit_message_text("❌ Erro: Dados não encontrados. Tente novamente.")
         return
 
-    valor = temp_data[user_id]["valor_recarga"]
-    bonus = temp_data[user_id]["bonus"]
-    valor_total_pagar = temp_data[user_id]["valor_total_pagar"]
+    valor = sessao["valor_recarga"]
+    bonus = sessao["bonus"]
+    valor_total_pagar = sessao["valor_total_pagar"]
 
     await query.edit_message_text("🔄 GERANDO PAGAMENTO VIP...\n\n💎 Preparando sua transação exclusiva...")
 
-    # Criar fatura usando método assíncrono para melhor performance
+    # Criar fatura (falha na hora se CryptoPay ou CoinGecko estiverem instáveis)
     try:
         invoice, erro = await crypto_pay.create_invoice_async(valor_total_pagar, moeda, user_id)
-    except Exception as e:
-        logger.error(f"Erro ao usar método assíncrono, tentando síncrono: {e}")
-        invoice, erro = crypto_pay.create_invoice(valor_total_pagar, moeda, user_id)
+    except UpstreamUnavailableError:
+        await query.edit_message_text(
+            "⚠️ PAGAMENTOS TEMPORARIAMENTE INDISPONÍVEIS\n\n"
+            "O provedor de pagamentos não está respondendo agora.\n\n"
+            "🔄 Tente novamente em alguns minutos!",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Voltar", callback_data="menu_recarga")]])
+        )
+        return
 
     if erro:
         await query.edit_message_text(f"❌ Erro ao gerar pagamento: {erro}")
@@ -1703,24 +5039,14 @@ async def processar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE
     crypto_symbol = get_crypto_symbol(moeda)
     crypto_name = get_crypto_name(moeda)
 
-    # Usar método assíncrono para obter preço se possível
-    try:
-        valor_crypto = await crypto_pay.get_crypto_price_async(valor_total_pagar, moeda)
-    except Exception as e:
-        logger.error(f"Erro ao usar método assíncrono, tentando síncrono: {e}")
-        valor_crypto = crypto_pay.get_crypto_price(valor_total_pagar, moeda)
+    # Valor exato cobrado na fatura
+    valor_crypto = invoice["amount"]
 
     # Salvar transação pendente no banco
     try:
-        with db._lock:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO transacoes (user_id, tipo, valor, moeda, status, invoice_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, 'deposito', valor_total_pagar, moeda, 'pendente', invoice["invoice_id"]))
-            conn.commit()
-            conn.close()
+        await async_db.criar_transacao_pendente(
+            user_id, valor_total_pagar, moeda, invoice["invoice_id"], float(valor_crypto)
+        )
     except Exception as e:
         logger.error(f"Erro ao salvar transação pendente: {e}")
 
@@ -1757,24 +5083,14 @@ async def menu_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     user_id = query.from_user.id
-    user_data = db.get_user(user_id)
+    snapshot = await async_db.get_user_snapshot(user_id)
 
-    if not user_data:
+    if not snapshot:
         await query.edit_message_text("❌ Erro: Usuário não encontrado.")
         return
 
-    # Corrigir índice das indicações - usar indicacoes_validas se existir
-    try:
-        with db._lock:
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT indicacoes_validas FROM usuarios WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            indicacoes = result[0] if result and result[0] else 0
-            conn.close()
-    except Exception as e:
-        logger.error(f"Erro ao buscar indicações: {e}")
-        indicacoes = 0
+    indicacoes = snapshot.indicacoes_validas
+    diretas, indiretas, depositantes, volume_rede = await async_db.get_resumo_indicacoes(user_id)
 
     stats = get_stats_fake()
 
@@ -1789,6 +5105,8 @@ async def menu_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"👑 PROGRAMA VIP DE INDICAÇÕES\n\n"
         f"📊 Suas indicações: {indicacoes}\n"
         f"💰 Ganhos estimados: R$ {indicacoes * 12:.0f}\n"
+        f"🌐 Sua rede: {diretas} diretas + {indiretas} indiretas\n"
+        f"💳 Depositantes na rede: {depositantes} (R$ {volume_rede:.2f})\n"
         f"━━━━━━━━━━━━━━━━━━━━\n\n"
         f"🎁 RECOMPENSAS EXCLUSIVAS:\n"
         f"• A cada pessoa que indicar que depositar R$ 20+ = 2 números GRÁTIS para você\n"
@@ -1799,7 +5117,7 @@ async def menu_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-async def compartilhar_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def compartilhar_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
     """Compartilhar link de indicação premium"""
     query = update.callback_query
     if not query or not query.data or not context.bot.username:
@@ -1807,10 +5125,9 @@ async def compartilhar_indicacao(update: Update, context: ContextTypes.DEFAULT_T
 
     await query.answer()
 
-    user_id = int(query.data.split("_")[1])
 
-    # Gerar código de indicação único usando JSON
-    referral_code = get_or_create_referral_code_json(user_id)
+    # Código de indicação do usuário (usuarios.codigo_indicacao, criado na primeira vez)
+    referral_code = await async_db.get_or_create_referral_code(user_id)
 
     texto_compartilhamento = (
         f"🤖 Olá! Descobri este bot incrível para receber códigos SMS!\n\n"
@@ -1924,57 +5241,156 @@ async def estrategias_indicacao(update: Update, context: ContextTypes.DEFAULT_TY
         reply_markup=reply_markup
     )
 
+class RotaCallback:
+    """Rota registrada no CallbackRouter"""
+    __slots__ = ("nome", "handler", "parse", "admin", "custo")
+
+    def __init__(self, nome, handler, parse, admin, custo):
+        self.nome = nome
+        self.handler = handler
+        self.parse = parse
+        self.admin = admin
+        self.custo = custo
+
+class CallbackRouter:
+    """Despacho de callback_data por tabela.
+
+    Rotas exatas ficam em um dict; rotas terminadas em "_" são prefixos e
+    recebem o restante do callback_data convertido por `parse` (ValueError ou
+    KeyError = payload inválido). Listas paginadas levam o cursor depois de
+    "|" ("admin_users|n|11|12.5|123"), que não faz parte da rota. Para cada
+    rota guarda chamadas, erros, payloads inválidos e um histograma de latência.
+    """
+
+    LIMITES_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.exatas = {}
+        self.prefixos = {}
+        self.reset()
+
+    def reset(self):
+        self.metricas = defaultdict(lambda: {
+            "calls": 0, "errors": 0, "invalid": 0, "total": 0.0, "max": 0.0,
+            "histograma": [0] * (len(self.LIMITES_MS) + 1),
+        })
+        self.desde = datetime.now().isoformat()
+
+    def registrar(self, nome, handler, parse=None, admin=False):
+        rota = RotaCallback(nome, handler, parse, admin, custo_do_callback(nome))
+        (self.prefixos if nome.endswith("_") else self.exatas)[nome] = rota
+
+    def resolver(self, data):
+        """`(rota, payload)` para o callback_data; `(None, None)` se nenhuma rota atende"""
+        chave = data.split("|", 1)[0]
+        rota = self.exatas.get(chave)
+        if rota is not None:
+            return rota, None
+        # Prefixo mais longo primeiro ("copiar_link_" antes de um eventual "copiar_")
+        fim = chave.rfind("_")
+        while fim > 0:
+            rota = self.prefixos.get(chave[:fim + 1])
+            if rota is not None:
+                return rota, chave[fim + 1:]
+            fim = chave.rfind("_", 0, fim)
+        return None, None
+
+    async def despachar(self, update, context):
+        query = update.callback_query
+        rota, payload = self.resolver(query.data)
+        if rota is None:
+            # Log para debugar callbacks não tratados
+            logger.warning(f"Callback não tratado: {query.data}")
+            self.metricas["desconhecido"]["invalid"] += 1
+            await query.answer("❌ Opção não reconhecida!")
+            return
+
+        if not await admitir_callback(query, rota.custo):
+            return
+
+        metricas = self.metricas[rota.nome]
+        if rota.admin and not is_admin(query.from_user.id):
+            await query.answer("❌ Acesso negado!")
+            return
+
+        args = ()
+        if rota.parse is not None:
+            try:
+                args = (rota.parse(payload),)
+            except (ValueError, KeyError):
+                logger.warning(f"Callback com payload inválido: {query.data}")
+                metricas["invalid"] += 1
+                await query.answer("❌ Opção não reconhecida!")
+                return
+
+        inicio = time.perf_counter()
+        try:
+            await rota.handler(update, context, *args)
+        except Exception:
+            metricas["errors"] += 1
+            raise
+        finally:
+            segundos = time.perf_counter() - inicio
+            metricas["calls"] += 1
+            metricas["total"] += segundos
+            metricas["max"] = max(metricas["max"], segundos)
+            metricas["histograma"][bisect.bisect_left(self.LIMITES_MS, segundos * 1000)] += 1
+
+    def resumo(self, top=None):
+        """Rotas ordenadas pelo tempo total, com latências em ms"""
+        rotas = []
+        for nome, stats in sorted(self.metricas.items(), key=lambda item: item[1]["total"], reverse=True)[:top]:
+            rotas.append({
+                "nome": nome,
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "invalid": stats["invalid"],
+                "media_ms": stats["total"] / stats["calls"] * 1000 if stats["calls"] else 0.0,
+                "max_ms": stats["max"] * 1000,
+                "histograma": dict(zip([f"<={limite}ms" for limite in self.LIMITES_MS] + ["+"], stats["histograma"])),
+            })
+        return {"desde": self.desde, "rotas": rotas}
+
+callback_router = CallbackRouter()
+
+def _opcao_de(opcoes):
+    """Parser de payload que só aceita chaves de `opcoes`"""
+    def parse(payload):
+        if payload not in opcoes:
+            raise KeyError(payload)
+        return payload
+    return parse
+
+def _valor_recarga(payload):
+    valor = int(payload)
+    if valor not in VALORES_RECARGA:
+        raise ValueError(payload)
+    return valor
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gerenciador principal de callbacks"""
     query = update.callback_query
-    if not query or not query.data:
+    if not query or not query.data or not query.from_user:
         return
 
-    data = query.data
-
-    if data == "menu_servicos":
-        await menu_servicos(update, context)
-    elif data == "menu_recarga":
-        await menu_recarga(update, context)
-    elif data == "menu_indicacao":
-        await menu_indicacao(update, context)
-    elif data == "estrategias_indicacao":
-        await estrategias_indicacao(update, context)
-    elif data == "menu_ajuda":
-        await menu_ajuda(update, context)
-    elif data == "menu_principal":
-        await start(update, context)
-    elif data.startswith("servico_"):
-        await selecionar_servico(update, context)
-    elif data.startswith("pais_"):
-        await selecionar_pais(update, context)
-    elif data.startswith("recarga_"):
-        await selecionar_valor_recarga(update, context)
-    elif data.startswith("moeda_"):
-        await processar_pagamento(update, context)
-    elif data.startswith("compartilhar_"):
-        await compartilhar_indicacao(update, context)
-    elif data.startswith("copiar_texto_"):
-        await copiar_texto_indicacao(update, context)
-    elif data.startswith("copiar_link_"):
-        await copiar_link_indicacao(update, context)
-    elif data.startswith("admin_"):
-        await handle_admin_callback(update, context)
-    else:
-        # Log para debugar callbacks não tratados
-        logger.warning(f"Callback não tratado: {data}")
-        await query.answer("❌ Opção não reconhecida!")
+    await callback_router.despachar(update, context)
+
+async def notificar_disponivel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botão "avisar quando disponível" da tela de número esgotado"""
+    query = update.callback_query
+    await query.answer(
+        "🔔 Os números são repostos a cada 3 horas. Tente novamente em breve!",
+        show_alert=True
+    )
 
-async def copiar_texto_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def copiar_texto_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
     """Mostra o texto para copiar"""
     query = update.callback_query
     if not query:
         return
 
     await query.answer("Texto pronto para copiar!")
-
-    user_id = int(query.data.split("_")[2])
-    referral_code = get_or_create_referral_code_json(user_id)
+    referral_code = await async_db.get_or_create_referral_code(user_id)
 
     if not context.bot.username:
         return
@@ -2000,16 +5416,14 @@ async def copiar_texto_indicacao(update: Update, context: ContextTypes.DEFAULT_T
         ])
     )
 
-async def copiar_link_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def copiar_link_indicacao(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
     """Mostra apenas o link para copiar"""
     query = update.callback_query
     if not query:
         return
 
     await query.answer("Link pronto para copiar!")
-
-    user_id = int(query.data.split("_")[2])
-    referral_code = get_or_create_referral_code_json(user_id)
+    referral_code = await async_db.get_or_create_referral_code(user_id)
 
     if not context.bot.username:
         return
@@ -2036,7 +5450,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Apagar mensagens anteriores (bot + usuário)
-    await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+    delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
 
     keyboard = [
         [
@@ -2050,7 +5464,8 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [
             InlineKeyboardButton("🔧 CONFIGURAÇÕES", callback_data="admin_config"),
             InlineKeyboardButton("📤 BROADCAST", callback_data="admin_broadcast")
-        ]
+        ],
+        [InlineKeyboardButton("🏆 INDICADORES", callback_data="admin_ranking")]
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2079,7 +5494,7 @@ async def dar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Apagar mensagem do comando
     try:
-        await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
     except Exception as e:
         logger.error(f"Erro ao apagar mensagem: {e}")
 
@@ -2098,9 +5513,6 @@ async def dar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Calcular bônus usando função centralizada
         bonus = calcular_bonus(valor)
 
-        # Processar como depósito completo (saldo + bônus)
-        db.processar_deposito(user_id, valor, bonus)
-
         # Adicionar números grátis baseado no valor
         if valor >= 200:
             numeros_gratis = 20
@@ -2111,13 +5523,8 @@ async def dar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             numeros_gratis = 0
 
-        if numeros_gratis > 0:
-            with db._lock:
-                conn = db.get_connection()
-                cursor = conn.cursor()
-                cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + ? WHERE user_id = ?', (numeros_gratis, user_id))
-                conn.commit()
-                conn.close()
+        # Processar como depósito completo (saldo + bônus + números grátis)
+        await async_db.processar_deposito(user_id, valor, bonus, numeros_gratis, tipo="credito_admin")
 
         try:
             if bonus > 0:
@@ -2167,7 +5574,7 @@ async def dar_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Apagar mensagem do comando
     try:
-        await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
     except Exception as e:
         logger.error(f"Erro ao apagar mensagem: {e}")
 
@@ -2184,7 +5591,7 @@ async def dar_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
         valor_bonus = float(context.args[1])
 
         # Adicionar apenas ao saldo de bônus
-        db.update_saldo_bonus(user_id, valor_bonus)
+        await async_db.update_saldo_bonus(user_id, valor_bonus)
 
         try:
             await context.bot.send_message(
@@ -2220,7 +5627,7 @@ async def dar_numeros(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Apagar mensagem do comando
     try:
-        await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
     except Exception as e:
         logger.error(f"Erro ao apagar mensagem: {e}")
 
@@ -2236,11 +5643,7 @@ async def dar_numeros(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = int(context.args[0])
         quantidade = int(context.args[1])
 
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + ? WHERE user_id = ?', (quantidade, user_id))
-        conn.commit()
-        conn.close()
+        await async_db.add_numeros_gratis(user_id, quantidade)
 
         try:
             await context.bot.send_message(
@@ -2276,7 +5679,7 @@ async def info_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Apagar mensagem do comando
     try:
-        await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
     except Exception as e:
         logger.error(f"Erro ao apagar mensagem: {e}")
 
@@ -2290,57 +5693,33 @@ async def info_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = int(context.args[0])
-        user_data = db.get_user(user_id)
+        user = await async_db.get_user_snapshot(user_id)
 
-        if not user_data:
+        if not user:
             await update.message.reply_text("❌ Usuário não encontrado!")
             return
 
-        saldo = db.get_saldo(user_id)
-        user_stats = db.get_user_stats(user_id)
-
-        # Buscar dados adicionais
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-
-        # Buscar números grátis
-        cursor.execute("SELECT numeros_gratis FROM usuarios WHERE user_id = ?", (user_id,))
-        numeros_gratis = cursor.fetchone()
-        numeros_gratis = numeros_gratis[0] if numeros_gratis else 0
-
-        # Buscar indicações válidas
-        cursor.execute("SELECT indicacoes_validas FROM usuarios WHERE user_id = ?", (user_id,))
-        indicacoes_validas = cursor.fetchone()
-        indicacoes_validas = indicacoes_validas[0] if indicacoes_validas else 0
-
-        # Buscar total depositado
-        cursor.execute("SELECT total_depositado FROM usuarios WHERE user_id = ?", (user_id,))
-        total_depositado = cursor.fetchone()
-        total_depositado = total_depositado[0] if total_depositado else 0
-
-        # Buscar código de indicação
-        cursor.execute("SELECT codigo_indicacao FROM usuarios WHERE user_id = ?", (user_id,))
-        codigo_indicacao = cursor.fetchone()
-        codigo_indicacao = codigo_indicacao[0] if codigo_indicacao else 'Não criado'
-
-        conn.close()
+        extrato = ""
+        for tipo, delta_saldo, delta_bonus, referencia, criado_em in await async_db.get_movimentos(user_id, 5):
+            extrato += f"\n• {criado_em[:16]} {tipo}: R$ {delta_saldo:+.2f} / bônus {delta_bonus:+.2f}"
 
         sent_message = await context.bot.send_message(
             update.message.chat_id,
             f"👤 INFORMAÇÕES DO USUÁRIO\n\n"
-            f"🆔 ID: {user_data[0]}\n"
-            f"👤 Nome: {user_data[2] or 'N/A'}\n"
-            f"📱 Username: @{user_data[1] or 'N/A'}\n"
-            f"💰 Saldo: R$ {saldo:.2f}\n"
-            f"🎁 Números grátis: {numeros_gratis}\n"
-            f"👥 Indicador: {user_data[5] or 'Nenhum'}\n"
-            f"🔗 Código indicação: {codigo_indicacao}\n"
-            f"📅 Registro: {user_data[7][:10] if len(user_data) > 7 else 'N/A'}\n"
-            f"💵 Total depositado: R$ {total_depositado:.2f}\n"
-            f"📊 Indicações válidas: {indicacoes_validas}\n"
-            f"📱 Total compras: {user_stats[0]}\n"
-            f"💸 Total gasto: R$ {user_stats[1]:.2f}\n"
-            f"💎 Total economizado: R$ {user_stats[2]:.2f}"
+            f"🆔 ID: {user.user_id}\n"
+            f"👤 Nome: {user.first_name or 'N/A'}\n"
+            f"📱 Username: @{user.username or 'N/A'}\n"
+            f"💰 Saldo: R$ {user.saldo_total:.2f}\n"
+            f"🎁 Números grátis: {user.numeros_gratis}\n"
+            f"👥 Indicador: {user.indicador_id or 'Nenhum'}\n"
+            f"🔗 Código indicação: {user.codigo_indicacao or 'Não criado'}\n"
+            f"📅 Registro: {user.data_registro[:10] if user.data_registro else 'N/A'}\n"
+            f"💵 Total depositado: R$ {user.total_depositado:.2f}\n"
+            f"📊 Indicações válidas: {user.indicacoes_validas}\n"
+            f"📱 Total compras: {user.total_compras}\n"
+            f"💸 Total gasto: R$ {user.total_gasto:.2f}\n"
+            f"💎 Total economizado: R$ {user.total_economizado:.2f}\n\n"
+            f"🧾 Últimos movimentos:{extrato or ' nenhum'}"
         )
         store_message_id(update.effective_user.id, sent_message.message_id)
 
@@ -2366,7 +5745,7 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Apagar mensagem do comando
     try:
-        await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
     except Exception as e:
         logger.error(f"Erro ao apagar mensagem: {e}")
 
@@ -2380,11 +5759,7 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     mensagem = " ".join(context.args)
 
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM usuarios")
-    usuarios = cursor.fetchall()
-    conn.close()
+    usuarios = await async_db.get_all_user_ids()
 
     enviados = 0
     erros = 0
@@ -2395,7 +5770,7 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     store_message_id(update.effective_user.id, status_message.message_id)
 
-    for (user_id,) in usuarios:
+    for user_id in usuarios:
         try:
             await context.bot.send_message(user_id, mensagem)
             enviados += 1
@@ -2413,6 +5788,102 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     store_message_id(update.effective_user.id, sent_message.message_id)
 
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /backup - Gera um snapshot do banco na hora"""
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ ACESSO NEGADO! Você não tem permissão para este comando.")
+        return
+
+    status_message = await update.message.reply_text("⏳ Gerando backup do banco de dados...")
+    store_message_id(update.effective_user.id, status_message.message_id)
+
+    try:
+        resultado = await async_db.backup()
+    except Exception as e:
+        logger.error(f"❌ Erro no backup: {e}")
+        await status_message.edit_text(f"❌ BACKUP FALHOU\n\n{e}")
+        return
+
+    await status_message.edit_text(
+        f"✅ BACKUP CONCLUÍDO!\n\n"
+        f"📁 Arquivo: {os.path.basename(resultado['arquivo'])}\n"
+        f"💾 Tamanho: {resultado['bytes'] / 1024 / 1024:.2f} MB\n"
+        f"⏱️ Duração: {resultado['segundos']:.2f}s ({resultado['passos']} passos)\n"
+        f"🔍 Integridade: ok\n"
+        f"🗂️ Snapshots mantidos: {resultado['mantidos']}"
+    )
+
+async def metricas_banco(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /metricas_banco [reset] - Latência, linhas e contenção por consulta"""
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ ACESSO NEGADO! Você não tem permissão para este comando.")
+        return
+
+    if context.args and context.args[0] == "reset":
+        db_metrics.reset()
+        sent_message = await update.message.reply_text("🔄 Métricas do banco zeradas!")
+        store_message_id(update.effective_user.id, sent_message.message_id)
+        return
+
+    resumo = db_metrics.resumo(top=10)
+    texto = f"🗄️ MÉTRICAS DO BANCO\n📅 Desde: {resumo['desde'][:16]}\n\n"
+
+    if not resumo["consultas"]:
+        texto += "Nenhuma consulta registrada ainda.\n"
+    for consulta in resumo["consultas"]:
+        texto += (
+            f"• {consulta['nome']}: {consulta['calls']}x, {consulta['rows']} linhas\n"
+            f"  p50 {consulta['p50_ms']:.1f} / p95 {consulta['p95_ms']:.1f} / p99 {consulta['p99_ms']:.1f} ms"
+            f" (máx {consulta['max_ms']:.1f})\n"
+        )
+        if consulta["errors"]:
+            texto += f"  ⚠️ {consulta['errors']} erros ({consulta['locked']} por database is locked)\n"
+
+    if resumo["esperas"]:
+        texto += "\n⏳ ESPERAS (lock/pool)\n"
+        for nome, espera in sorted(resumo["esperas"].items(), key=lambda item: item[1]["total_ms"], reverse=True)[:8]:
+            texto += f"• {nome}: {espera['count']}x, total {espera['total_ms']:.0f}ms, máx {espera['max_ms']:.1f}ms\n"
+
+    fila = getattr(async_db, "queue_stats", {})
+    if fila:
+        pior = max(fila.items(), key=lambda item: item[1]["queued_max"])
+        texto += (
+            f"\n📥 Fila do executor: {async_db.pending} pendentes, {async_db.rejected} rejeitadas\n"
+            f"  maior espera: {pior[0]} {pior[1]['queued_max'] * 1000:.0f}ms\n"
+        )
+
+    texto += f"\n🐢 Log de consultas lentas acima de {DB_SLOW_QUERY_MS:.0f}ms"
+    sent_message = await update.message.reply_text(texto)
+    store_message_id(update.effective_user.id, sent_message.message_id)
+
+async def metricas_rotas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /metricas_rotas [reset] - Chamadas, erros e latência por tela (callback)"""
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ ACESSO NEGADO! Você não tem permissão para este comando.")
+        return
+
+    if context.args and context.args[0] == "reset":
+        callback_router.reset()
+        sent_message = await update.message.reply_text("🔄 Métricas das rotas zeradas!")
+        store_message_id(update.effective_user.id, sent_message.message_id)
+        return
+
+    resumo = callback_router.resumo(top=15)
+    texto = f"🧭 MÉTRICAS DAS ROTAS\n📅 Desde: {resumo['desde'][:16]}\n\n"
+
+    if not resumo["rotas"]:
+        texto += "Nenhum callback registrado ainda.\n"
+    for rota in resumo["rotas"]:
+        texto += f"• {rota['nome']}: {rota['calls']}x, média {rota['media_ms']:.1f}ms (máx {rota['max_ms']:.1f})\n"
+        faixas = [f"{faixa} {quantidade}" for faixa, quantidade in rota["histograma"].items() if quantidade]
+        if faixas:
+            texto += f"  {' | '.join(faixas)}\n"
+        if rota["errors"] or rota["invalid"]:
+            texto += f"  ⚠️ {rota['errors']} erros, {rota['invalid']} inválidos\n"
+
+    sent_message = await update.message.reply_text(texto)
+    store_message_id(update.effective_user.id, sent_message.message_id)
+
 async def confirmar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /confirmar - Confirmar pagamento manualmente"""
     if not update.effective_user or not is_admin(update.effective_user.id):
@@ -2421,7 +5892,7 @@ async def confirmar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Apagar mensagem do comando
     try:
-        await delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
+        delete_previous_messages(context, update.message.chat_id, update.effective_user.id, update.message.message_id)
     except Exception as e:
         logger.error(f"Erro ao apagar mensagem: {e}")
 
@@ -2441,24 +5912,16 @@ async def confirmar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE
         bonus = calcular_bonus(valor)
 
         # Processar depósito separando saldo base e bônus corretamente
-        db.processar_deposito(user_id, valor, bonus)
+        await async_db.processar_deposito(user_id, valor, bonus, tipo="deposito_manual")
 
         # Verificar se é elegível para recompensa de indicação (R$ 20+)
-        user_data = db.get_user(user_id)
-        if user_data and valor >= 20.0:
-            indicador_id = user_data[5]  # campo indicador_id
+        user = await async_db.get_user_snapshot(user_id)
+        if user and valor >= 20.0:
+            indicador_id = user.indicador_id
 
             if indicador_id:
                 # Dar números grátis para o usuário indicado
-                conn = sqlite3.connect(db.db_path)
-                cursor = conn.cursor()
-                cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + 2 WHERE user_id = ?', (user_id,))
-                # Dar números grátis para o indicador
-                cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + 2 WHERE user_id = ?', (indicador_id,))
-                # Atualizar contador de indicações válidas
-                cursor.execute('UPDATE usuarios SET indicacoes_validas = indicacoes_validas + 1 WHERE user_id = ?', (indicador_id,))
-                conn.commit()
-                conn.close()
+                await async_db.recompensar_indicacao(user_id, indicador_id)
 
                 # Notificar indicador
                 try:
@@ -2531,76 +5994,19 @@ async def confirmar_pagamento(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         store_message_id(update.effective_user.id, sent_message.message_id)
 
-async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gerenciador de callbacks do admin"""
-    query = update.callback_query
-    if not query or not query.from_user or not is_admin(query.from_user.id):
-        await query.answer("❌ Acesso negado!")
-        return
-
-    data = query.data
-
-    if data == "admin_stats":
-        await admin_stats(update, context)
-    elif data == "admin_payments":
-        await admin_payments(update, context)
-    elif data == "admin_promos":
-        await admin_promos(update, context)
-    elif data == "admin_users":
-        await admin_users(update, context)
-    elif data == "admin_config":
-        await admin_config(update, context)
-    elif data == "admin_broadcast":
-        await admin_broadcast_menu(update, context)
-    elif data == "admin_give_balance":
-        await admin_give_balance(update, context)
-    elif data == "admin_give_numbers":
-        await admin_give_numbers(update, context)
-    elif data == "admin_pending":
-        await admin_pending_payments(update, context)
-    elif data == "admin_confirmed":
-        await admin_confirmed_payments(update, context)
-    elif data == "admin_menu":
-        await admin_main_menu(update, context)
-
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Estatísticas do sistema"""
     query = update.callback_query
     await query.answer()
 
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-
-    # Estatísticas básicas
-    cursor.execute("SELECT COUNT(*) FROM usuarios")
-    total_usuarios = cursor.fetchone()[0]
-
-    cursor.execute("SELECT SUM(total_starts) FROM usuarios")
-    total_starts = cursor.fetchone()[0] or 0
-
-    cursor.execute("SELECT COUNT(*) FROM transacoes WHERE status = 'confirmado'")
-    total_vendas = cursor.fetchone()[0]
-
-    cursor.execute("SELECT SUM(valor) FROM transacoes WHERE status = 'confirmado'")
-    total_faturamento = cursor.fetchone()[0] or 0
-
-    cursor.execute("SELECT COUNT(*) FROM numeros_sms")
-    total_numeros = cursor.fetchone()[0]
-
-    # Estatísticas do dia
-    cursor.execute("""
-        SELECT COUNT(*) FROM usuarios 
-        WHERE DATE(data_registro) = DATE('now')
-    """)
-    novos_hoje = cursor.fetchone()[0]
-
-    cursor.execute("""
-        SELECT COUNT(*) FROM transacoes 
-        WHERE DATE(data_transacao) = DATE('now') AND status = 'confirmado'
-    """)
-    vendas_hoje = cursor.fetchone()[0]
-
-    conn.close()
+    stats = await async_db.get_admin_stats()
+    total_usuarios = stats['total_usuarios']
+    total_starts = stats['total_starts']
+    total_vendas = stats['total_vendas']
+    total_faturamento = stats['total_faturamento']
+    total_numeros = stats['total_numeros']
+    novos_hoje = stats['novos_hoje']
+    vendas_hoje = stats['vendas_hoje']
 
     keyboard = [
         [InlineKeyboardButton("🔄 ATUALIZAR", callback_data="admin_stats")],
@@ -2626,28 +6032,7 @@ async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-
-    # Pagamentos pendentes
-    cursor.execute("""
-        SELECT COUNT(*) FROM transacoes 
-        WHERE status = 'pendente'
-    """)
-    pendentes = cursor.fetchone()[0]
-
-    # Últimos pagamentos
-    cursor.execute("""
-        SELECT u.first_name, t.valor, t.data_transacao 
-        FROM transacoes t 
-        JOIN usuarios u ON t.user_id = u.user_id 
-        WHERE t.status = 'confirmado'
-        ORDER BY t.data_transacao DESC 
-        LIMIT 5
-    """)
-    ultimos = cursor.fetchall()
-
-    conn.close()
+    pendentes, ultimos = await async_db.get_payments_overview()
 
     ultimos_text = ""
     for nome, valor, data in ultimos:
@@ -2706,7 +6091,8 @@ async def admin_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [
             InlineKeyboardButton("🔧 CONFIGURAÇÕES", callback_data="admin_config"),
             InlineKeyboardButton("📤 BROADCAST", callback_data="admin_broadcast")
-        ]
+        ],
+        [InlineKeyboardButton("🏆 INDICADORES", callback_data="admin_ranking")]
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2739,7 +6125,10 @@ async def admin_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• /dar_numeros [user_id] [quantidade]\n"
         f"• /info [user_id]\n"
         f"• /confirmar [user_id] [valor]\n"
-        f"• /broadcast [mensagem]\n\n"
+        f"• /broadcast [mensagem]\n"
+        f"• /backup\n"
+        f"• /metricas_banco [reset]\n"
+        f"• /metricas_rotas [reset]\n\n"
         f"💡 Use os comandos no chat para gerenciar o sistema",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -2800,38 +6189,64 @@ async def admin_give_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+def ler_cursor(data):
+    """Decodifica o callback_data de uma lista paginada: `rota|n ou p|posição|chave...`
+
+    Retorna (anteriores, posição da primeira linha, chave) — chave None na primeira página.
+    """
+    partes = data.split("|")
+    if len(partes) < 4:
+        return False, 1, None
+    return partes[1] == "p", int(partes[2]), tuple(partes[3:])
+
+def botoes_paginacao(rota, linhas, chave, posicao, limit, tem_anteriores, tem_seguintes):
+    """Linha de botões ⬅️/➡️ com o cursor (chave da primeira/última linha) no callback_data"""
+    botoes = []
+    if linhas and tem_anteriores:
+        cursor = "|".join(str(valor) for valor in chave(linhas[0]))
+        botoes.append(InlineKeyboardButton(
+            "⬅️ ANTERIORES", callback_data=f"{rota}|p|{max(posicao - limit, 1)}|{cursor}"
+        ))
+    if linhas and tem_seguintes:
+        cursor = "|".join(str(valor) for valor in chave(linhas[-1]))
+        botoes.append(InlineKeyboardButton(
+            "PRÓXIMOS ➡️", callback_data=f"{rota}|n|{posicao + len(linhas)}|{cursor}"
+        ))
+    return [botoes] if botoes else []
+
+async def listar_pagina(query, rota, buscar, limit, tipos_chave, chave):
+    """Busca a página pedida no callback_data e monta os botões de navegação"""
+    anteriores, posicao, cursor = ler_cursor(query.data)
+    if cursor is not None:
+        cursor = tuple(tipo(valor) for tipo, valor in zip(tipos_chave, cursor))
+    linhas, mais = await buscar(limit, cursor, anteriores)
+    tem_anteriores = mais if anteriores else cursor is not None
+    tem_seguintes = True if anteriores else mais
+    navegacao = botoes_paginacao(rota, linhas, chave, posicao, limit, tem_anteriores, tem_seguintes)
+    return linhas, posicao, navegacao
+
 async def admin_pending_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Pagamentos pendentes"""
+    """Pagamentos pendentes (paginados por data_transacao, id)"""
     query = update.callback_query
     await query.answer()
 
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao, t.invoice_id
-        FROM transacoes t 
-        JOIN usuarios u ON t.user_id = u.user_id 
-        WHERE t.status = 'pendente' OR t.status IS NULL
-        ORDER BY t.data_transacao DESC 
-        LIMIT 10
-    """)
-    pendentes = cursor.fetchall()
-    conn.close()
+    pendentes, posicao, navegacao = await listar_pagina(
+        query, "admin_pending", async_db.get_pending_payments, 10, (str, int), lambda p: (p[4], p[6])
+    )
 
     if not pendentes:
         pendentes_text = "✅ Nenhum pagamento pendente!"
     else:
-        pendentes_text = ""
-        for user_id, nome, valor, moeda, data, invoice_id in pendentes:
+        pendentes_text = f"📄 Mostrando {posicao}–{posicao + len(pendentes) - 1}\n\n"
+        for user_id, nome, valor, moeda, data, invoice_id, _ in pendentes:
             data_formatada = data[:16] if data else "N/A"
             pendentes_text += f"• {nome or 'N/A'} (ID: {user_id})\n"
             pendentes_text += f"  💰 Valor: R$ {valor:.2f} ({moeda or 'N/A'})\n"
             pendentes_text += f"  📅 Data: {data_formatada}\n"
             pendentes_text += f"  🆔 Invoice: {invoice_id or 'N/A'}\n\n"
 
-    keyboard = [
-        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data="admin_pending")],
+    keyboard = navegacao + [
+        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data=query.data)],
         [InlineKeyboardButton("🔙 VOLTAR", callback_data="admin_payments")]
     ]
 
@@ -2843,30 +6258,20 @@ async def admin_pending_payments(update: Update, context: ContextTypes.DEFAULT_T
     )
 
 async def admin_confirmed_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Pagamentos confirmados"""
+    """Pagamentos confirmados (paginados por data_transacao, id)"""
     query = update.callback_query
     await query.answer()
 
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT t.user_id, u.first_name, t.valor, t.moeda, t.data_transacao, t.invoice_id
-        FROM transacoes t 
-        JOIN usuarios u ON t.user_id = u.user_id 
-        WHERE t.status = 'confirmado'
-        ORDER BY t.data_transacao DESC 
-        LIMIT 15
-    """)
-    confirmados = cursor.fetchall()
-    conn.close()
+    confirmados, posicao, navegacao = await listar_pagina(
+        query, "admin_confirmed", async_db.get_confirmed_payments, 15, (str, int), lambda p: (p[4], p[6])
+    )
 
     if not confirmados:
         confirmados_text = "❌ Nenhum pagamento confirmado ainda!"
     else:
-        confirmados_text = ""
+        confirmados_text = f"📄 Mostrando {posicao}–{posicao + len(confirmados) - 1}\n\n"
         total_confirmados = 0
-        for user_id, nome, valor, moeda, data, invoice_id in confirmados:
+        for user_id, nome, valor, moeda, data, invoice_id, _ in confirmados:
             data_formatada = data[:16] if data else "N/A"
             confirmados_text += f"✅ {nome or 'N/A'} (ID: {user_id})\n"
             confirmados_text += f"   💰 R$ {valor:.2f} ({moeda or 'N/A'})\n"
@@ -2874,10 +6279,10 @@ async def admin_confirmed_payments(update: Update, context: ContextTypes.DEFAULT
             total_confirmados += valor
 
         confirmados_text += f"━━━━━━━━━━━━━━━━━━━━\n"
-        confirmados_text += f"💰 Total confirmado: R$ {total_confirmados:.2f}"
+        confirmados_text += f"💰 Total nesta página: R$ {total_confirmados:.2f}"
 
-    keyboard = [
-        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data="admin_confirmed")],
+    keyboard = navegacao + [
+        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data=query.data)],
         [InlineKeyboardButton("🔙 VOLTAR", callback_data="admin_payments")]
     ]
 
@@ -2888,30 +6293,22 @@ async def admin_confirmed_payments(update: Update, context: ContextTypes.DEFAULT
     )
 
 async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Gerenciar usuários"""
+    """Gerenciar usuários (paginados por saldo, user_id)"""
     query = update.callback_query
     await query.answer()
 
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-
     # Top usuários por saldo
-    cursor.execute("""
-        SELECT first_name, saldo, total_depositado 
-        FROM usuarios 
-        ORDER BY saldo DESC 
-        LIMIT 10
-    """)
-    top_users = cursor.fetchall()
-
-    conn.close()
+    top_users, posicao, navegacao = await listar_pagina(
+        query, "admin_users", async_db.get_top_users, 10, (float, int), lambda u: (u[2], u[0])
+    )
 
     users_text = ""
-    for i, (nome, saldo, depositado) in enumerate(top_users, 1):
-        users_text += f"{i}. {nome}: R$ {saldo:.2f} (dep: R$ {depositado:.2f})\n"
+    # A ordem segue o saldo consolidado; o valor mostrado é o saldo atual (com o livro)
+    for i, (user_id, nome, _, _, saldo, depositado) in enumerate(top_users, posicao):
+        users_text += f"{i}. {nome} ({user_id}): R$ {saldo:.2f} (dep: R$ {depositado:.2f})\n"
 
-    keyboard = [
-        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data="admin_users")],
+    keyboard = navegacao + [
+        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data=query.data)],
         [InlineKeyboardButton("🔙 VOLTAR", callback_data="admin_menu")]
     ]
 
@@ -2922,6 +6319,67 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+async def admin_ranking_indicadores(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Top indicadores pelo volume depositado na rede (lido de indicacoes_resumo)"""
+    query = update.callback_query
+    await query.answer()
+
+    ranking = await async_db.get_ranking_indicadores(10)
+
+    ranking_text = ""
+    for i, (user_id, nome, diretas, indiretas, depositantes, volume) in enumerate(ranking, 1):
+        ranking_text += (
+            f"{i}. {nome} ({user_id}): R$ {volume:.2f}\n"
+            f"   👥 {diretas} diretas + {indiretas} indiretas | 💳 {depositantes} depositantes\n"
+        )
+
+    keyboard = [
+        [InlineKeyboardButton("🔄 ATUALIZAR", callback_data="admin_ranking")],
+        [InlineKeyboardButton("🔙 VOLTAR", callback_data="admin_menu")]
+    ]
+
+    await query.edit_message_text(
+        f"🏆 TOP INDICADORES POR VOLUME DA REDE\n\n"
+        f"{ranking_text or 'Nenhuma indicação registrada ainda.'}\n"
+        f"💡 Use /info [user_id] para ver detalhes",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Tabela de rotas dos botões (chaves terminadas em "_" são prefixos com payload)
+for _nome, _handler, _parse in (
+    ("menu_servicos", menu_servicos, None),
+    ("menu_recarga", menu_recarga, None),
+    ("menu_indicacao", menu_indicacao, None),
+    ("estrategias_indicacao", estrategias_indicacao, None),
+    ("menu_ajuda", menu_ajuda, None),
+    ("menu_principal", start, None),
+    ("notificar_disponivel", notificar_disponivel, None),
+    ("servico_", selecionar_servico, _opcao_de(PRECOS_SERVICOS)),
+    ("pais_", selecionar_pais, _opcao_de(PAISES_DISPONIVEIS)),
+    ("recarga_", selecionar_valor_recarga, _valor_recarga),
+    ("moeda_", processar_pagamento, _opcao_de({moeda["code"] for moeda in MOEDAS_CRYPTO})),
+    ("compartilhar_", compartilhar_indicacao, int),
+    ("copiar_texto_", copiar_texto_indicacao, int),
+    ("copiar_link_", copiar_link_indicacao, int),
+):
+    callback_router.registrar(_nome, _handler, _parse)
+
+for _nome, _handler in (
+    ("admin_menu", admin_main_menu),
+    ("admin_stats", admin_stats),
+    ("admin_payments", admin_payments),
+    ("admin_promos", admin_promos),
+    ("admin_users", admin_users),
+    ("admin_ranking", admin_ranking_indicadores),
+    ("admin_config", admin_config),
+    ("admin_broadcast", admin_broadcast_menu),
+    ("admin_give_balance", admin_give_balance),
+    ("admin_give_numbers", admin_give_numbers),
+    ("admin_pending", admin_pending_payments),
+    ("admin_confirmed", admin_confirmed_payments),
+):
+    callback_router.registrar(_nome, _handler, admin=True)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Tratamento global de erros"""
     logger.error(f"Erro capturado: {context.error}")
@@ -2929,7 +6387,14 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     # Se há um update, tentar responder ao usuário
     if isinstance(update, Update):
         try:
-            if update.message:
+            if isinstance(context.error, UpstreamUnavailableError):
+                # Circuito aberto: a API externa está instável, não é um erro do bot
+                aviso = "⚠️ Um parceiro externo está instável no momento. Tente novamente em alguns minutos!"
+                if update.message:
+                    await update.message.reply_text(aviso)
+                elif update.callback_query:
+                    await update.callback_query.answer(aviso, show_alert=True)
+            elif update.message:
                 await update.message.reply_text(
                     "⚠️ Ocorreu um erro temporário. Tente novamente em alguns segundos.\n"
                     "Se o problema persistir, entre em contato com o suporte."
@@ -2990,16 +6455,21 @@ async def status_handler(request):
     """Handler para verificar status do sistema"""
     try:
         # Verificar database
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM usuarios")
-        total_users = cursor.fetchone()[0]
-        conn.close()
+        total_users = await async_db.count_users()
 
         status_info = {
             "status": "healthy",
             "service": "Bot SMS Premium",
             "users": total_users,
+            "starts_buffer": starts_buffer.metrics(),
+            "user_cache": async_db.cache.metrics(),
+            "db_queries": db_metrics.resumo(top=5),
+            "callbacks": callback_router.resumo(top=5),
+            "rate_limit": rate_limiter.metrics(),
+            "sessions": {sessao.nome: sessao.metrics() for sessao in SESSOES},
+            "message_cleanup": limpeza_mensagens.metrics(),
+            "upstreams": {upstream.nome: upstream.metrics() for upstream in UPSTREAMS},
+            "cotacoes": crypto_oracle.metrics(),
             "timestamp": datetime.now().isoformat(),
             "version": "2.0",
             "features": ["SMS Sales", "Crypto Payments", "Auto Bonus", "Rate Limiting"]
@@ -3014,56 +6484,55 @@ async def status_handler(request):
 async def processar_pagamento_webhook(invoice_id, amount, currency):
     """Processa pagamento recebido via webhook COM VALIDAÇÃO DE VALOR EXATO"""
     try:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-
         # Buscar transação pendente com dados da invoice
-        cursor.execute("""
-            SELECT user_id, valor, moeda FROM transacoes 
-            WHERE invoice_id = ? AND status = 'pendente'
-        """, (invoice_id,))
+        transacao = await async_db.get_transacao_pendente(invoice_id)
 
-        transacao = cursor.fetchone()
         if not transacao:
             logger.warning(f"⚠️ Transação não encontrada para invoice {invoice_id}")
-            conn.close()
-            return
-
-        user_id, valor_esperado_brl, moeda_esperada = transacao
-
-        # VALIDAÇÃO CRÍTICA: Verificar se o valor pago é EXATAMENTE o esperado
-        # Converter valor esperado em BRL para crypto
-        try:
-            valor_crypto_esperado = await crypto_pay.get_crypto_price_async(valor_esperado_brl, currency)
-            if not valor_crypto_esperado:
-                # Tentar método síncrono como fallback
-                valor_crypto_esperado = crypto_pay.get_crypto_price(valor_esperado_brl, currency)
-        except Exception as e:
-            logger.error(f"Erro ao converter valor esperado: {e}")
-            valor_crypto_esperado = crypto_pay.get_crypto_price(valor_esperado_brl, currency)
-
-        if not valor_crypto_esperado:
-            logger.error(f"❌ Não foi possível validar valor para invoice {invoice_id}")
-            conn.close()
             return
 
-        # Verificar se valores coincidem (com margem de erro de 1% para flutuações de preço)
-        margem_erro = 0.01  # 1% de tolerância
-        valor_minimo = valor_crypto_esperado * (1 - margem_erro)
-        valor_maximo = valor_crypto_esperado * (1 + margem_erro)
+        user_id, valor_esperado_brl, moeda_esperada, valor_crypto_esperado = transacao
 
-        if not (valor_minimo <= amount <= valor_maximo):
-            logger.warning(f"🚫 VALOR INCORRETO! Esperado: {valor_crypto_esperado:.8f} {currency}, Recebido: {amount:.8f} {currency}")
+        # VALIDAÇÃO CRÍTICA: o valor pago tem que ser EXATAMENTE o cobrado na fatura,
+        # gravado na criação (a cotação atual pode ter mudado desde então)
+        if valor_crypto_esperado is None:
+            # Fatura criada antes da migração que grava o valor: consultar o próprio CryptoPay
+            try:
+                fatura = await crypto_pay.get_invoice_async(invoice_id)
+            except UpstreamUnavailableError:
+                fatura = None
+            if fatura and fatura.get("asset") == moeda_esperada and fatura.get("amount"):
+                valor_crypto_esperado = float(fatura["amount"])
+            else:
+                logger.error(f"❌ Invoice {invoice_id} sem valor em cripto gravado nem confirmado no CryptoPay")
+                await async_db.marcar_valor_incorreto(
+                    invoice_id, f"Sem valor esperado gravado, Recebido: {amount:.8f} {currency}"
+                )
+                if ADMIN_ID:
+                    try:
+                        bot = Bot(token=BOT_TOKEN)
+                        async with bot:
+                            await bot.send_message(
+                                chat_id=ADMIN_ID,
+                                text=f"⚠️ PAGAMENTO SEM VALOR PARA CONFERIR!\n\n"
+                                     f"👤 Usuário: {user_id}\n"
+                                     f"🆔 Invoice: {invoice_id}\n"
+                                     f"💵 Fatura: R$ {valor_esperado_brl:.2f} em {moeda_esperada}\n"
+                                     f"💳 Recebido: {amount:.8f} {currency}\n\n"
+                                     f"A fatura é anterior ao registro do valor em cripto e o CryptoPay não respondeu.\n"
+                                     f"⚠️ Se o valor estiver certo: /confirmar {user_id} {valor_esperado_brl:.2f}"
+                            )
+                    except Exception as e:
+                        logger.error(f"Erro ao notificar admin: {e}")
+                return
+
+        if currency != moeda_esperada or abs(amount - valor_crypto_esperado) > 1e-8:
+            logger.warning(f"🚫 VALOR INCORRETO! Esperado: {valor_crypto_esperado:.8f} {moeda_esperada}, Recebido: {amount:.8f} {currency}")
 
             # Marcar como valor incorreto
-            cursor.execute("""
-                UPDATE transacoes 
-                SET status = 'valor_incorreto', 
-                    observacoes = ? 
-                WHERE invoice_id = ?
-            """, (f"Esperado: {valor_crypto_esperado:.8f}, Recebido: {amount:.8f}", invoice_id))
-            conn.commit()
-            conn.close()
+            await async_db.marcar_valor_incorreto(
+                invoice_id, f"Esperado: {valor_crypto_esperado:.8f}, Recebido: {amount:.8f}"
+            )
 
             # Notificar admin sobre pagamento com valor incorreto
             if ADMIN_ID:
@@ -3076,7 +6545,7 @@ async def processar_pagamento_webhook(invoice_id, amount, currency):
                             text=f"🚫 PAGAMENTO COM VALOR INCORRETO!\n\n"
                                  f"👤 Usuário: {user_id}\n"
                                  f"🆔 Invoice: {invoice_id}\n"
-                                 f"💰 Esperado: {valor_crypto_esperado:.8f} {currency}\n"
+                                 f"💰 Esperado: {valor_crypto_esperado:.8f} {moeda_esperada}\n"
                                  f"💳 Recebido: {amount:.8f} {currency}\n"
                                  f"📊 Diferença: {((amount - valor_crypto_esperado) / valor_crypto_esperado * 100):.2f}%\n\n"
                                  f"⚠️ Pagamento NÃO foi processado automaticamente!"
@@ -3091,9 +6560,6 @@ async def processar_pagamento_webhook(invoice_id, amount, currency):
         # Calcular bônus
         bonus = calcular_bonus(valor_esperado_brl)
 
-        # Processar depósito separando saldo base e bônus
-        db.processar_deposito(user_id, valor_esperado_brl, bonus)
-
         # Adicionar números grátis baseado no valor
         if valor_esperado_brl >= 200:
             numeros_gratis = 20
@@ -3104,49 +6570,29 @@ async def processar_pagamento_webhook(invoice_id, amount, currency):
         else:
             numeros_gratis = 0
 
-        if numeros_gratis > 0:
-            cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + ? WHERE user_id = ?', (numeros_gratis, user_id))
-
-        # Verificar se é elegível para recompensa de indicação (R$ 20+)
-        if valor_esperado_brl >= 20.0:
-            cursor.execute("SELECT indicador_id FROM usuarios WHERE user_id = ?", (user_id,))
-            indicador_result = cursor.fetchone()
-
-            if indicador_result and indicador_result[0]:
-                indicador_id = indicador_result[0]
-
-                # Dar números grátis para ambos
-                cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + 2 WHERE user_id = ?', (user_id,))
-                cursor.execute('UPDATE usuarios SET numeros_gratis = numeros_gratis + 2 WHERE user_id = ?', (indicador_id,))
-                cursor.execute('UPDATE usuarios SET indicacoes_validas = indicacoes_validas + 1 WHERE user_id = ?', (indicador_id,))
-
-                # Notificar indicador
-                try:
-                    # Para v20+, usar Bot importado
-                    bot = Bot(token=BOT_TOKEN)
-                    async with bot:
-                        await bot.send_message(
-                            indicador_id,
-                            f"🎉 RECOMPENSA DE INDICAÇÃO!\n\n"
-                            f"💰 Sua indicação depositou R$ {valor_esperado_brl:.2f}!\n"
-                            f"🎁 Você ganhou 2 números GRÁTIS!\n"
-                            f"👤 Acesse /start para ver seus números!"
-                        )
-                except Exception as e:
-                    logger.error(f"Erro ao notificar indicador: {e}")
-
-        # Marcar transação como confirmada
-        cursor.execute("""
-            UPDATE transacoes 
-            SET status = 'confirmado', 
-                data_confirmacao = ?,
-                valor_crypto_pago = ?,
-                moeda_paga = ?
-            WHERE invoice_id = ?
-        """, (datetime.now().isoformat(), amount, currency, invoice_id))
+        # Creditar depósito, números grátis e indicação e confirmar a transação de uma vez
+        processado, indicador_id = await async_db.confirmar_deposito_fatura(
+            invoice_id, user_id, valor_esperado_brl, bonus, numeros_gratis, amount, currency
+        )
+        if not processado:
+            logger.warning(f"⚠️ Invoice {invoice_id} já foi processada, ignorando webhook repetido")
+            return
 
-        conn.commit()
-        conn.close()
+        # Notificar indicador
+        if indicador_id:
+            try:
+                # Para v20+, usar Bot importado
+                bot = Bot(token=BOT_TOKEN)
+                async with bot:
+                    await bot.send_message(
+                        indicador_id,
+                        f"🎉 RECOMPENSA DE INDICAÇÃO!\n\n"
+                        f"💰 Sua indicação depositou R$ {valor_esperado_brl:.2f}!\n"
+                        f"🎁 Você ganhou 2 números GRÁTIS!\n"
+                        f"👤 Acesse /start para ver seus números!"
+                    )
+            except Exception as e:
+                logger.error(f"Erro ao notificar indicador: {e}")
 
         logger.info(f"✅ Pagamento processado automaticamente: User {user_id}, R${valor_esperado_brl}, Bônus: R${bonus}")
 
@@ -3221,12 +6667,20 @@ async def start_web_server():
         logger.error(f"❌ Erro ao iniciar servidor web: {e}")
         raise
 
-async def main():
-    """Função principal com servidor híbrido"""
+async def main(manager=None, storage=None):
+    """Função principal com servidor híbrido.
+
+    `manager`/`storage` vêm de criar_storage(); sem eles o backend é escolhido aqui.
+    """
+    global db, async_db
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN não configurado nos secrets!")
         return
 
+    if storage is None:
+        manager, storage = criar_storage()
+    db, async_db = manager, storage
+
     try:
         # Criar aplicação com configurações específicas para v20+
         application = (
@@ -3245,11 +6699,36 @@ async def main():
         application.add_handler(CommandHandler("dar_numeros", dar_numeros))
         application.add_handler(CommandHandler("info", info_usuario))
         application.add_handler(CommandHandler("broadcast", broadcast))
+        application.add_handler(CommandHandler("backup", backup_command))
+        application.add_handler(CommandHandler("metricas_banco", metricas_banco))
+        application.add_handler(CommandHandler("metricas_rotas", metricas_rotas))
         application.add_handler(CallbackQueryHandler(handle_callback))
 
         # Adicionar handler de erros
         application.add_error_handler(error_handler)
 
+        # Conectar ao backend de armazenamento e aplicar migrações pendentes
+        await async_db.open()
+
+        # Fluxos em andamento gravados no último desligamento
+        carregar_sessoes()
+
+        # Sessões HTTP compartilhadas com CryptoPay, 5sim e CoinGecko
+        for upstream in UPSTREAMS:
+            await upstream.open()
+
+        # Conferir se alguma consulta passou a varrer tabelas grandes
+        for nome, detalhe in await async_db.check_query_plans():
+            logger.warning(f"⚠️ Consulta {nome} sem índice: {detalhe}")
+
+        # Gravação em lote do contador de starts e consolidação periódica dos saldos
+        starts_task = asyncio.create_task(starts_buffer.run())
+        ledger_task = asyncio.create_task(compactar_saldos_periodicamente())
+        arquivo_task = asyncio.create_task(arquivar_periodicamente())
+        limpeza_task = asyncio.create_task(limpeza_mensagens.run(application.bot))
+        cotacoes_task = asyncio.create_task(crypto_oracle.run())
+        backup_task = asyncio.create_task(backup_periodicamente()) if db is not None and BACKUP_INTERVALO_SECONDS > 0 else None
+
         # Iniciar servidor web em paralelo
         web_runner = await start_web_server()
 
@@ -3275,18 +6754,41 @@ async def main():
         
         # Manter o bot rodando usando o método correto da v20+
         import signal
+        # O sinal só acorda o loop abaixo; o desligamento acontece no finally
+        parar = asyncio.Event()
         stop_signals = (signal.SIGTERM, signal.SIGINT)
         for sig in stop_signals:
-            asyncio.get_running_loop().add_signal_handler(sig, lambda: application.stop())
+            asyncio.get_running_loop().add_signal_handler(sig, parar.set)
         
         # Aguardar indefinidamente até parar
         try:
-            while application.running:
-                await asyncio.sleep(1)
+            await parar.wait()
+            logger.info("🛑 Sinal de parada recebido, desligando...")
         except KeyboardInterrupt:
             logger.info("Bot interrompido pelo usuário")
         finally:
-            await application.stop()
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            try:
+                salvar_sessoes()
+            except Exception as e:
+                logger.error(f"Erro ao salvar sessões no desligamento: {e}")
+            starts_task.cancel()
+            ledger_task.cancel()
+            arquivo_task.cancel()
+            limpeza_task.cancel()
+            cotacoes_task.cancel()
+            if backup_task:
+                backup_task.cancel()
+            try:
+                await starts_buffer.flush()
+            except Exception as e:
+                logger.error(f"Erro ao gravar contadores no desligamento: {e}")
+            for upstream in UPSTREAMS:
+                await upstream.close()
+            await async_db.close()
 
     except Exception as e:
         logger.error(f"Erro crítico ao iniciar bot: {e}")
@@ -3296,28 +6798,97 @@ async def main():
         import sys
         sys.exit(1)
 
+async def compactar_saldos_periodicamente():
+    """Consolida o livro de movimentos nos saldos a cada LEDGER_COMPACTAR_SECONDS"""
+    while True:
+        await asyncio.sleep(LEDGER_COMPACTAR_SECONDS)
+        try:
+            consolidados = await async_db.compactar_saldos()
+            if consolidados:
+                logger.info(f"🧾 {consolidados} movimentos de saldo consolidados")
+        except Exception as e:
+            logger.error(f"Erro ao consolidar saldos: {e}")
+
+async def arquivar_periodicamente():
+    """Move transações e números antigos para o arquivo a cada ARQUIVO_INTERVALO_SECONDS"""
+    while True:
+        await asyncio.sleep(ARQUIVO_INTERVALO_SECONDS)
+        try:
+            transacoes, numeros = await async_db.arquivar_antigos()
+            if transacoes or numeros:
+                logger.info(f"🗃️ Arquivados: {transacoes} transações e {numeros} números com mais de {ARQUIVO_RETENCAO_DIAS} dias")
+        except Exception as e:
+            logger.error(f"Erro ao arquivar registros antigos: {e}")
+
+async def backup_periodicamente():
+    """Snapshot do SQLite a cada BACKUP_INTERVALO_SECONDS"""
+    while True:
+        await asyncio.sleep(BACKUP_INTERVALO_SECONDS)
+        try:
+            resultado = await async_db.backup()
+            logger.info(
+                f"💾 Backup {resultado['arquivo']}: {resultado['bytes'] / 1024 / 1024:.2f} MB em {resultado['segundos']:.2f}s"
+            )
+        except Exception as e:
+            logger.error(f"Erro no backup automático: {e}")
+
 async def configurar_webhook_cryptopay():
     """Configura webhook do CryptoPay para pagamentos automáticos"""
     try:
         webhook_url = f"{RENDER_URL}/webhook"
 
-        async with aiohttp.ClientSession() as session:
-            url = f"{CRYPTOPAY_API_BASE}/setWebhook"
-            headers = {
-                "Crypto-Pay-API-Token": CRYPTOPAY_API_TOKEN
-            }
-            data = {
-                "webhook_url": webhook_url
-            }
+        url = f"{CRYPTOPAY_API_BASE}/setWebhook"
+        headers = {
+            "Crypto-Pay-API-Token": CRYPTOPAY_API_TOKEN
+        }
+        data = {
+            "webhook_url": webhook_url
+        }
 
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    logger.info(f"✅ Webhook CryptoPay configurado: {webhook_url}")
-                else:
-                    logger.warning(f"⚠️ Falha ao configurar webhook CryptoPay: {response.status}")
+        async with cryptopay_http.request("POST", url, headers=headers, json=data) as response:
+            if response.status == 200:
+                logger.info(f"✅ Webhook CryptoPay configurado: {webhook_url}")
+            else:
+                logger.warning(f"⚠️ Falha ao configurar webhook CryptoPay: {response.status}")
 
     except Exception as e:
         logger.error(f"❌ Erro ao configurar webhook CryptoPay: {e}")
 
+async def verificar_consultas(storage):
+    """Modo `python main.py --verificar-consultas`: falha se alguma consulta fizer SCAN em tabela grande"""
+    await storage.open()
+    try:
+        problemas = await storage.check_query_plans()
+    finally:
+        await storage.close()
+    consultas = PG_SQL if isinstance(storage, PostgresStorage) else SQL
+    for nome, detalhe in problemas:
+        print(f"❌ {nome}: {detalhe}")
+    print(f"{len(consultas) - len(problemas)}/{len(consultas)} consultas usando índices ou com scan permitido")
+    return 1 if problemas else 0
+
+async def reconciliar_saldos(storage):
+    """Modo `python main.py --reconciliar-saldos`: consolida o livro e confere contra os saldos"""
+    await storage.open()
+    try:
+        await storage.compactar_saldos()
+        divergentes = await storage.reconciliar_saldos()
+    finally:
+        await storage.close()
+    for user_id, saldo, saldo_livro, bonus, bonus_livro, depositado, depositado_livro in divergentes:
+        print(
+            f"❌ {user_id}: saldo {saldo:.2f} x livro {saldo_livro:.2f}, "
+            f"bônus {bonus:.2f} x {bonus_livro:.2f}, depositado {depositado:.2f} x {depositado_livro:.2f}"
+        )
+    print(f"{len(divergentes)} usuários com saldo divergente do livro de movimentos")
+    return 1 if divergentes else 0
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if "--migrar-postgres" in sys.argv:
+        sys.exit(asyncio.run(migrar_para_postgres()))
+    manager, storage = criar_storage()
+    if "--verificar-consultas" in sys.argv:
+        sys.exit(asyncio.run(verificar_consultas(storage)))
+    if "--reconciliar-saldos" in sys.argv:
+        sys.exit(asyncio.run(reconciliar_saldos(storage)))
+    asyncio.run(main(manager, storage))
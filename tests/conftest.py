@@ -0,0 +1,70 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+# main.py fica na raiz do repositório
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _binarios_postgres():
+    """Pasta com initdb/pg_ctl: PG_BIN, `pg_config --bindir`, o PATH ou /usr/lib/postgresql/*/bin"""
+    candidatas = [os.getenv("PG_BIN")]
+    pg_config = shutil.which("pg_config")
+    if pg_config:
+        candidatas.append(subprocess.run([pg_config, "--bindir"], capture_output=True, text=True).stdout.strip())
+    initdb = shutil.which("initdb")
+    if initdb:
+        candidatas.append(os.path.dirname(initdb))
+    candidatas += sorted(glob.glob("/usr/lib/postgresql/*/bin"), reverse=True)
+    for pasta in filter(None, candidatas):
+        if os.path.exists(os.path.join(pasta, "initdb")) and os.path.exists(os.path.join(pasta, "pg_ctl")):
+            return pasta
+    return None
+
+
+@pytest.fixture(scope="session")
+def postgres_dsn():
+    """DSN de um PostgreSQL para os testes.
+
+    Com DATABASE_URL usa esse servidor (os testes só mexem em schemas próprios).
+    Sem ela sobe um cluster descartável com initdb/pg_ctl num diretório
+    temporário, ouvindo só num socket Unix. Sem binários do PostgreSQL os testes
+    falham: o backend PostgreSQL nunca é pulado em silêncio.
+    """
+    if os.getenv("DATABASE_URL"):
+        yield os.environ["DATABASE_URL"]
+        return
+
+    pasta_bin = _binarios_postgres()
+    if pasta_bin is None:
+        pytest.fail("PostgreSQL não encontrado: instale-o, aponte PG_BIN para initdb/pg_ctl ou configure DATABASE_URL")
+
+    # O PostgreSQL não roda como root: nesse caso o cluster pertence a PG_TEST_USER
+    prefixo = []
+    if os.geteuid() == 0:
+        import pwd
+        usuario = pwd.getpwnam(os.getenv("PG_TEST_USER", "postgres"))
+        prefixo = ["runuser", "-u", usuario.pw_name, "--"]
+
+    pasta = tempfile.mkdtemp(prefix="pgteste_")
+    dados = os.path.join(pasta, "dados")
+    if prefixo:
+        os.chmod(pasta, 0o755)
+        os.chown(pasta, usuario.pw_uid, usuario.pw_gid)
+
+    def executar(*comando):
+        subprocess.run(prefixo + [os.path.join(pasta_bin, comando[0]), *comando[1:]], check=True, capture_output=True)
+
+    executar("initdb", "-D", dados, "-U", "postgres", "--auth=trust", "--no-sync")
+    executar("pg_ctl", "-D", dados, "-l", os.path.join(pasta, "log"), "-w", "start",
+             "-o", f"-c listen_addresses='' -k {pasta} -c fsync=off")
+    try:
+        yield f"postgresql://postgres@/postgres?host={pasta}"
+    finally:
+        executar("pg_ctl", "-D", dados, "-m", "fast", "-w", "stop")
+        shutil.rmtree(pasta, ignore_errors=True)
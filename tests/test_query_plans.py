@@ -0,0 +1,34 @@
+"""As consultas de SQL usam índices num banco criado só pelas MIGRATIONS (o mesmo que `--verificar-consultas`)"""
+import pytest
+
+import main
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = main.DatabaseManager(str(tmp_path / "planos.db"), pool_size=1)
+    yield manager
+    manager.pool.close_all()
+
+
+def test_migracoes_deixam_todas_as_consultas_com_indice(manager):
+    assert manager.check_query_plans() == []
+
+
+@pytest.mark.parametrize("consulta", [
+    # Índice que não serve o filtro: varre o índice inteiro mesmo com LIMIT
+    "SELECT user_id FROM movimentos WHERE delta_saldo > ? LIMIT ?",
+    "SELECT user_id FROM usuarios WHERE saldo + 1 > ? LIMIT ?",
+    # O índice não está na ordem do ORDER BY (o SQLite ordena numa B-tree temporária)
+    "SELECT user_id, saldo FROM usuarios ORDER BY first_name LIMIT ?",
+    "SELECT id FROM transacoes WHERE observacoes = ?",
+])
+def test_scan_que_so_menciona_indice_nao_passa(manager, monkeypatch, consulta):
+    monkeypatch.setattr(main, "SQL", {"consulta_nova": consulta})
+    assert [nome for nome, _ in manager.check_query_plans()] == ["consulta_nova"]
+
+
+def test_indice_na_ordem_do_order_by_com_limit_passa(manager, monkeypatch):
+    consulta = "SELECT user_id, saldo FROM usuarios ORDER BY saldo DESC, user_id DESC LIMIT ?"
+    monkeypatch.setattr(main, "SQL", {"pagina": consulta})
+    assert manager.check_query_plans() == []
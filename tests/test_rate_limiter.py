@@ -0,0 +1,92 @@
+"""RateLimiter com relógio simulado: reposição de fichas, rajada e remoção de baldes ociosos"""
+import pytest
+
+import main
+
+
+class Relogio:
+    def __init__(self):
+        self.agora = 0.0
+
+    def __call__(self):
+        return self.agora
+
+
+@pytest.fixture
+def relogio():
+    return Relogio()
+
+
+def test_rajada_gasta_a_capacidade_e_depois_bloqueia(relogio):
+    limiter = main.RateLimiter(capacidade=5, janela=60.0, intervalo_minimo=0.0, relogio=relogio)
+    assert [limiter.verificar(1) for _ in range(6)] == ["ok"] * 5 + ["minuto"]
+    # Outro usuário tem o próprio balde
+    assert limiter.verificar(2) == "ok"
+
+
+def test_custo_maior_gasta_mais_fichas_e_custo_zero_nao_limita(relogio):
+    limiter = main.RateLimiter(capacidade=5, janela=60.0, intervalo_minimo=0.0, relogio=relogio)
+    assert limiter.verificar(1, custo=5) == "ok"
+    assert limiter.verificar(1, custo=0) == "ok"
+    assert limiter.verificar(1) == "minuto"
+
+
+def test_fichas_sao_repostas_proporcionalmente_ao_tempo(relogio):
+    limiter = main.RateLimiter(capacidade=6, janela=60.0, intervalo_minimo=0.0, relogio=relogio)
+    for _ in range(6):
+        limiter.verificar(1)
+    assert limiter.verificar(1) == "minuto"
+
+    relogio.agora += 9.9  # 0.1 ficha/s: ainda falta um pouco para a primeira
+    assert limiter.verificar(1) == "minuto"
+    relogio.agora += 0.1
+    assert limiter.verificar(1) == "ok"
+    assert limiter.verificar(1) == "minuto"
+
+    relogio.agora += 600  # a reposição para na capacidade
+    assert [limiter.verificar(1) for _ in range(7)] == ["ok"] * 6 + ["minuto"]
+
+
+def test_intervalo_minimo_entre_comandos(relogio):
+    limiter = main.RateLimiter(capacidade=10, janela=60.0, intervalo_minimo=0.5, relogio=relogio)
+    assert limiter.verificar(1) == "ok"
+    relogio.agora += 0.4
+    assert limiter.verificar(1) == "intervalo"
+    relogio.agora += 0.1
+    assert limiter.verificar(1) == "ok"
+    assert limiter.stats["bloqueados_intervalo"] == 1
+
+
+def test_baldes_ociosos_sao_removidos_sem_mudar_decisoes(relogio):
+    limiter = main.RateLimiter(capacidade=3, janela=60.0, intervalo_minimo=0.0, relogio=relogio)
+    for user_id in range(100):
+        limiter.verificar(user_id)
+    for _ in range(2):
+        limiter.verificar(0)
+    assert limiter.metrics()["usuarios_ativos"] == 100
+
+    relogio.agora += 59
+    limiter.verificar(1000)
+    assert len(limiter._baldes) == 101
+
+    # Depois de uma janela parado o balde estaria cheio: pode sair da memória
+    relogio.agora += 1
+    limiter.verificar(1000)
+    assert len(limiter._baldes) == 101 - main.RateLimiter.REMOCOES_POR_CHAMADA
+    assert limiter.metrics()["usuarios_ativos"] == 1
+    assert limiter.stats["removidos"] == 100
+    # Usuário removido volta com o balde cheio, como se nunca tivesse saído
+    assert [limiter.verificar(0) for _ in range(4)] == ["ok"] * 3 + ["minuto"]
+
+
+def test_custo_acima_da_capacidade_gasta_o_balde_inteiro_sem_bloquear_para_sempre(relogio):
+    limiter = main.RateLimiter(capacidade=5, janela=60.0, intervalo_minimo=0.0, relogio=relogio)
+    assert limiter.verificar(1, custo=50) == "ok"
+    assert limiter.verificar(1) == "minuto"
+    relogio.agora += 60
+    assert limiter.verificar(1, custo=50) == "ok"
+
+
+def test_custos_configurados_sao_validados_e_limitados_a_capacidade():
+    custos = main.ler_custos_callback("pais_=x, moeda_, =3, recarga_=2.5, admin_=100, menu_=-1", capacidade=30)
+    assert custos == {"recarga_": 2.5, "admin_": 30, "menu_": 0}
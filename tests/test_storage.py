@@ -0,0 +1,223 @@
+"""Os mesmos cenários de armazenamento contra os dois backends.
+
+SQLite roda sobre um arquivo temporário (AsyncDatabase). PostgreSQL usa o
+servidor do fixture `postgres_dsn` (conftest.py): cada teste usa um schema
+próprio, criado e removido aqui, então o banco apontado não é alterado.
+"""
+import asyncio
+import uuid
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+import pytest
+
+import main
+
+async def _executar_pg(dsn, comando):
+    conn = await main.asyncpg.connect(dsn)
+    try:
+        await conn.execute(comando)
+    finally:
+        await conn.close()
+
+
+def _dsn_com_schema(dsn, schema):
+    # Parâmetros desconhecidos na URL viram configurações da sessão no asyncpg
+    partes = urlsplit(dsn)
+    query = "&".join(filter(None, [partes.query, urlencode({"search_path": schema})]))
+    return urlunsplit(partes._replace(query=query))
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        yield main.AsyncDatabase(main.DatabaseManager(str(tmp_path / "teste.db"), pool_size=2))
+        return
+
+    dsn = request.getfixturevalue("postgres_dsn")
+    schema = f"teste_{uuid.uuid4().hex[:12]}"
+    asyncio.run(_executar_pg(dsn, f"CREATE SCHEMA {schema}"))
+    try:
+        yield main.PostgresStorage(_dsn_com_schema(dsn, schema))
+    finally:
+        asyncio.run(_executar_pg(dsn, f"DROP SCHEMA {schema} CASCADE"))
+
+
+def rodar(storage, cenario):
+    """Abre o backend, executa `cenario(storage)` e fecha, tudo no mesmo event loop"""
+    async def executar():
+        await storage.open()
+        try:
+            return await cenario(storage)
+        finally:
+            await storage.close()
+
+    return asyncio.run(executar())
+
+
+async def sql(storage, comando):
+    """Comando direto no banco, para preparar cenários que o bot não produz (ex.: datas antigas)"""
+    if isinstance(storage, main.PostgresStorage):
+        await storage.pool.execute(comando)
+    else:
+        with storage.manager.connection() as conn:
+            conn.execute(comando)
+
+
+def envelhecer(storage, tabela, coluna, dias):
+    if isinstance(storage, main.PostgresStorage):
+        return f"UPDATE {tabela} SET {coluna} = {coluna} - interval '{dias} days'"
+    return f"UPDATE {tabela} SET {coluna} = datetime({coluna}, '-{dias} days')"
+
+
+def test_deposito_soma_saldo_e_confirma_fatura_uma_vez(storage):
+    async def cenario(s):
+        await s.create_user(1, "ana", "Ana")
+        assert await s.get_saldo(1) == pytest.approx(0.5)  # bônus de boas-vindas
+
+        await s.processar_deposito(1, 20.0, 2.0, numeros_gratis=1)
+        assert await s.get_saldo(1) == pytest.approx(22.5)
+        assert await s.get_numeros_gratis(1) == 1
+
+        await s.criar_transacao_pendente(1, 15.0, "USDT", "inv-1", 3.0)
+        assert tuple(await s.get_transacao_pendente("inv-1")) == (1, 15.0, "USDT", 3.0)
+        confirmada, _ = await s.confirmar_deposito_fatura("inv-1", 1, 15.0, 1.5, 0, 3.0, "USDT")
+        repetida, _ = await s.confirmar_deposito_fatura("inv-1", 1, 15.0, 1.5, 0, 3.0, "USDT")
+        assert (confirmada, repetida) == (True, False)
+        assert await s.get_saldo(1) == pytest.approx(39.0)
+
+        await s.compactar_saldos()
+        assert await s.reconciliar_saldos() == []
+        assert await s.get_saldo(1) == pytest.approx(39.0)
+
+    rodar(storage, cenario)
+
+
+def test_debito_usa_bonus_primeiro_e_nunca_fica_negativo(storage):
+    async def cenario(s):
+        await s.create_user(1, "ana", "Ana")
+        await s.processar_deposito(1, 10.0, 0.0)
+
+        assert tuple(await s.deduzir_saldo(1, 4.0)) == pytest.approx((6.5, 0.0))
+        assert await s.deduzir_saldo(1, 100.0) is None
+
+        resultados = await asyncio.gather(*(s.deduzir_saldo(1, 1.0) for _ in range(10)))
+        assert sum(r is not None for r in resultados) == 6
+        assert await s.get_saldo(1) == pytest.approx(0.5)
+
+    rodar(storage, cenario)
+
+
+def test_indicacoes_contam_rede_direta_e_indireta(storage):
+    async def cenario(s):
+        await s.create_user(1, "a", "A")
+        await s.create_user(2, "b", "B", indicador_id=1)
+        await s.create_user(3, "c", "C", indicador_id=2)
+        await s.create_user(3, "c", "C", indicador_id=2)  # /start repetido não conta de novo
+
+        await s.processar_deposito(3, 10.0, 0.0)
+        await s.processar_deposito(3, 5.0, 0.0)
+        await s.processar_deposito(2, 7.0, 0.0)
+
+        assert tuple(await s.get_resumo_indicacoes(1)) == (1, 1, 2, pytest.approx(22.0))
+        assert tuple(await s.get_resumo_indicacoes(2)) == (1, 0, 1, pytest.approx(15.0))
+        assert tuple(await s.get_resumo_indicacoes(3)) == (0, 0, 0, 0.0)
+        assert [linha[0] for linha in await s.get_ranking_indicadores()] == [1, 2]
+
+    rodar(storage, cenario)
+
+
+def test_paginacao_por_cursor_percorre_tudo_sem_repetir(storage):
+    async def cenario(s):
+        await s.create_user(1, "ana", "Ana")
+        for i in range(7):
+            await s.criar_transacao_pendente(1, 10.0 + i, "USDT", f"inv-{i}")
+
+        paginas, cursor, mais = [], None, True
+        while mais:
+            linhas, mais = await s.get_pending_payments(3, cursor)
+            paginas.append([linha[5] for linha in linhas])
+            cursor = (linhas[-1][4], linhas[-1][6])
+        assert paginas == [["inv-6", "inv-5", "inv-4"], ["inv-3", "inv-2", "inv-1"], ["inv-0"]]
+
+        linhas, mais = await s.get_pending_payments(3, cursor, anteriores=True)
+        assert [linha[5] for linha in linhas] == ["inv-3", "inv-2", "inv-1"]
+        assert mais
+
+    rodar(storage, cenario)
+
+
+def test_top_usuarios_mostram_saldo_atual_antes_da_compactacao(storage):
+    async def cenario(s):
+        for user_id in (1, 2, 3):
+            await s.create_user(user_id, f"u{user_id}", f"U{user_id}")
+        await s.processar_deposito(1, 30.0, 0.0)
+        await s.processar_deposito(3, 20.0, 0.0)
+        await s.compactar_saldos()
+
+        # Depósito ainda no livro: a ordem (consolidada) não muda, o valor mostrado sim
+        await s.processar_deposito(2, 50.0, 0.0)
+        linhas, _ = await s.get_top_users(10)
+        assert [linha[0] for linha in linhas] == [1, 3, 2]
+        for linha in linhas:
+            assert linha[4] == pytest.approx((await s.get_user_snapshot(linha[0])).saldo_base)
+        assert linhas[2][5] - linhas[2][3] == pytest.approx(50.0)
+
+        linhas, mais = await s.get_top_users(1, (linhas[0][2], linhas[0][0]))
+        assert [linha[0] for linha in linhas] == [3] and mais
+
+        await s.compactar_saldos()
+        linhas, _ = await s.get_top_users(10)
+        assert [linha[0] for linha in linhas] == [2, 1, 3]
+        assert all(linha[2] == pytest.approx(linha[4]) for linha in linhas)
+
+    rodar(storage, cenario)
+
+
+def test_arquivo_move_finalizados_e_preserva_totais(storage):
+    async def cenario(s):
+        for user_id in (1, 2):
+            await s.create_user(user_id, "u", f"U{user_id}")
+        for i in range(6):
+            user_id = i % 2 + 1
+            await s.registrar_numero(user_id, "wa", "br", f"55{i}", 2.0 + i, 0.5)
+            await s.criar_transacao_pendente(user_id, 10.0 + i, "USDT", f"inv-{i}")
+            if i % 3:
+                await s.confirmar_deposito_fatura(f"inv-{i}", user_id, 10.0 + i, 0.0, 0, 1.0, "USDT")
+        await sql(s, envelhecer(s, "numeros_sms", "data_compra", 200))
+        await sql(s, envelhecer(s, "transacoes", "data_transacao", 200))
+        # Comprado agora: ainda aguardando SMS, fica fora do arquivo
+        await s.registrar_numero(1, "wa", "br", "55novo", 3.0)
+
+        antes = [await s.get_user_stats(u) for u in (1, 2)], await s.get_admin_stats()
+        assert await s.arquivar_antigos(90, 2) == (4, 6)
+        assert await s.arquivar_antigos(90, 2) == (0, 0)
+        s.cache.invalidate(1, 2)
+        depois = [await s.get_user_stats(u) for u in (1, 2)], await s.get_admin_stats()
+
+        assert depois == antes
+        pendentes, _ = await s.get_pending_payments(10)
+        assert sorted(linha[5] for linha in pendentes) == ["inv-0", "inv-3"]
+        confirmados, _ = await s.get_confirmed_payments(10)
+        assert confirmados == []
+        assert (await s.get_user_stats(1))[0] == 4
+
+    rodar(storage, cenario)
+
+
+def test_consultas_do_backend_usam_indices(storage):
+    async def cenario(s):
+        assert await s.check_query_plans() == []
+
+    rodar(storage, cenario)
+
+
+def test_plano_aponta_scan_sem_indice(storage, monkeypatch):
+    if isinstance(storage, main.PostgresStorage):
+        monkeypatch.setattr(main, "PG_SQL", {"consulta_nova": "SELECT id FROM transacoes WHERE observacoes = $1"})
+    else:
+        monkeypatch.setattr(main, "SQL", {"consulta_nova": "SELECT id FROM transacoes WHERE observacoes = ?"})
+
+    async def cenario(s):
+        assert [nome for nome, _ in await s.check_query_plans()] == ["consulta_nova"]
+
+    rodar(storage, cenario)